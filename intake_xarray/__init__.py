@@ -7,5 +7,5 @@ import intake
 from .netcdf import NetCDFSource
 from .opendap import OpenDapSource
 from .raster import RasterIOSource
-#from .xzarr import ZarrSource
-from .image import ImageSource
+from .xzarr import ZarrSource
+from .image import ImageSource, VideoSource
@@ -1,13 +1,379 @@
+import os
+
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+
+from intake.readers.utils import pattern_to_glob
+
+AUTO_ALIGNED = 'auto-aligned'
+
+
+def _expand_paths(url, storage_options=None):
+    """Filesystem and list of concrete paths for a path, glob, pattern or list"""
+    url = pattern_to_glob(url) if isinstance(url, str) else list(url)
+    fs, _, paths = fsspec.get_fs_token_paths(url, **(storage_options or {}))
+    if isinstance(url, str) and isinstance(fs, LocalFileSystem):
+        # '{{ CATALOG_DIR }}/' in catalogs makes double slashes, which globs
+        # do not match
+        paths = fsspec.get_fs_token_paths(
+            os.path.normpath(fs._strip_protocol(url)))[2]
+    if not paths:
+        raise FileNotFoundError('No files found matching %s' % (url, ))
+    return fs, paths
+
+
+def _stored_chunks(var):
+    """Stored chunk size of a variable along each of its dimensions, from
+    the ``preferred_chunks`` encoding that the zarr, netCDF4/h5netcdf and
+    rasterio backends set, or else from the zarr ``chunks`` or netCDF4
+    ``chunksizes`` encoding; for sharded Zarr arrays, the shards"""
+    shards = var.encoding.get('shards')
+    if shards and len(shards) == var.ndim:
+        return dict(zip(var.dims, shards))
+    preferred = var.encoding.get('preferred_chunks')
+    if not preferred:
+        stored = var.encoding.get('chunksizes') or var.encoding.get('chunks')
+        if not stored or len(stored) != var.ndim:
+            return {}
+        preferred = dict(zip(var.dims, stored))
+    return {dim: min(size, var.sizes[dim]) for dim, size in preferred.items()
+            if isinstance(size, int) and dim in var.dims}
+
+
+def _info_version(info):
+    """What of an ``fs.info`` dict tells a rewritten file apart: size and,
+    as the filesystem has them, ETag and modification time"""
+    return tuple(str(info[k]) for k in ('size', 'ETag', 'etag', 'mtime',
+                                        'LastModified', 'last_modified',
+                                        'generation') if k in info)
+
+
+def _file_version(fs, path):
+    return _info_version(fs.info(path))
+
+
+def _file_infos(fs, paths):
+    """``fs.info`` of each of ``paths``, as a dict
+
+    Directories holding several of the paths are listed once, rather than
+    asking for each file in turn; files the listing does not describe are
+    asked for on their own.
+    """
+    by_parent = {}
+    for path in paths:
+        by_parent.setdefault(fs._parent(path), []).append(path)
+    infos = {}
+    for parent, group in by_parent.items():
+        if len(group) < 2:
+            continue
+        try:
+            listing = fs.ls(parent, detail=True)
+        except (OSError, NotImplementedError, ValueError):
+            continue
+        infos.update({fs._strip_protocol(i['name']): i for i in listing
+                      if i.get('size') is not None})
+    return {p: infos[p] if p in infos else fs.info(p) for p in paths}
+
+
+def _as_dataset(ds):
+    return ds.to_dataset(name=ds.name or 'data') \
+        if not hasattr(ds, 'data_vars') else ds
+
+
+def storage_chunks(ds):
+    """Chunk size along each dimension that the stored chunks of every
+    variable of ``ds`` fit in a whole number of times
+
+    Where variables differ, the least common multiple is taken, capped at
+    the dimension's length. Indexes are left out.
+    """
+    import math
+
+    ds = _as_dataset(ds)
+    sizes = {}
+    for name, var in ds.variables.items():
+        if name in ds.indexes:
+            # loaded into memory on open
+            continue
+        for dim, size in _stored_chunks(var).items():
+            sizes[dim] = min(math.lcm(sizes.get(dim, 1), size),
+                             ds.sizes[dim])
+    return sizes
+
+
+def aligned_chunks(ds, chunks=None, target_bytes=None):
+    """Chunks for ``ds`` rounded to multiples of its storage chunks
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+    chunks: dict, optional
+        Requested size of each dimension; by default, sizes are picked as
+        for dask's ``'auto'``, up to ``target_bytes`` for the largest
+        variable.
+    target_bytes: int or str, optional
+        Defaults to dask's ``array.chunk-size`` config.
+
+    Returns
+    -------
+    dict of the size of each dimension with storage chunks, the nearest
+    multiple of those chunks to the request
+    """
+    import dask
+    from dask.array.core import normalize_chunks
+    from dask.utils import parse_bytes
+
+    ds = _as_dataset(ds)
+    stored = storage_chunks(ds)
+    if chunks is None:
+        target = parse_bytes(target_bytes or
+                             dask.config.get('array.chunk-size'))
+        largest = max((v for v in ds.data_vars.values() if v.ndim),
+                      key=lambda v: v.size * v.dtype.itemsize, default=None)
+        chunks = {}
+        if largest is not None:
+            auto = normalize_chunks(
+                'auto', largest.shape, limit=target, dtype=largest.dtype,
+                previous_chunks=tuple(stored.get(d, n) for d, n in
+                                      largest.sizes.items()))
+            chunks = {d: c[0] for d, c in zip(largest.dims, auto)}
+    out = {}
+    for dim, size in stored.items():
+        request = chunks.get(dim, size)
+        if request in (None, -1):
+            out[dim] = ds.sizes[dim]
+            continue
+        multiple = max(round(request / size), 1) * size
+        out[dim] = min(multiple, ds.sizes[dim])
+    return out
+
+
+def misaligned_dims(ds):
+    """Dimensions along which some dask chunk of ``ds`` splits a stored
+    chunk, which then gets read and decoded by more than one task"""
+    import numpy as np
+
+    dims = set()
+    for var in _as_dataset(ds).variables.values():
+        if var.chunks is None:
+            continue
+        stored = _stored_chunks(var)
+        for dim, chunks in zip(var.dims, var.chunks):
+            if dim in stored and np.any(np.cumsum(chunks[:-1]) % stored[dim]):
+                dims.add(dim)
+    return sorted(dims)
+
+
+# encoding kept when exporting; storage settings of the source are dropped
+_CF_ENCODING = ('dtype', '_FillValue', 'missing_value', 'scale_factor',
+                'add_offset', 'units', 'calendar')
+
+
+def _uniform_chunks(ds, chunks=None):
+    """``ds`` rechunked to ``chunks``, and along each dimension that they do
+    not name so that all chunks but the last have the size of the first, as
+    Zarr needs"""
+    ds = ds.unify_chunks()
+    if chunks is not None and not isinstance(chunks, dict):
+        return ds.chunk(chunks)
+    if chunks:
+        ds = ds.chunk(chunks)
+    uniform = {}
+    for dim, sizes in ds.chunks.items():
+        if dim in (chunks or {}):
+            continue
+        if any(c != sizes[0] for c in sizes[:-1]) or sizes[-1] > sizes[0]:
+            uniform[dim] = max(sizes)
+    return ds.chunk(uniform) if uniform else ds
+
+
+def _export_regions(ds):
+    """Groups of dask-backed variables sharing dimensions, each with the
+    regions, one per dask chunk, that together cover them"""
+    import itertools
+    import numpy as np
+
+    groups = {}
+    for name, var in ds.data_vars.items():
+        if var.chunks is not None:
+            groups.setdefault(var.dims, []).append(name)
+    for dims, names in groups.items():
+        edges = [np.cumsum((0, ) + ds.chunks[d]) for d in dims]
+        for block in itertools.product(*[range(len(e) - 1) for e in edges]):
+            yield names, {d: slice(int(e[i]), int(e[i + 1]))
+                          for d, e, i in zip(dims, edges, block)}
+
+
+def _write_region(ds, store, region, marker=None, storage_options=None):
+    """Write ``ds``, one region of the dataset, to an existing Zarr store,
+    then leave a marker file telling that it is done"""
+    ds.drop_vars(list(ds.coords)).to_zarr(
+        store, region=region, mode='r+', storage_options=storage_options)
+    if marker is not None:
+        with fsspec.open(marker, 'wb', **(storage_options or {})):
+            pass
+
+
 class IntakeXarraySourceAdapter:
     container = "xarray"
     name = "xarray"
     version = ""
+    # whether the reader itself handles chunks='auto-aligned'
+    aligns_chunks = False
+
+    def _opening(self):
+        """Called as the source is read or opened, before its reader"""
 
     def to_dask(self):
+        self._opening()
+        chunks = self.reader.kwargs.get("chunks", {})
+        if chunks == AUTO_ALIGNED and not self.aligns_chunks:
+            ds = self.reader(chunks={}).read()
+            return ds.chunk(aligned_chunks(ds))
         if "chunks" not in self.reader.kwargs:
             return self.reader(chunks={}).read()
-        else:
-            return self.reader.read()
+        import warnings
+
+        with warnings.catch_warnings():
+            # xarray's own warning for some backends, superseded by ours
+            warnings.filterwarnings(
+                'ignore', 'The specified chunks separate the stored chunks',
+                UserWarning)
+            ds = self.reader.read()
+        misaligned = misaligned_dims(ds)
+        if misaligned:
+            requested = {d: chunks if isinstance(chunks, int) else
+                         chunks.get(d) if isinstance(chunks, dict) else None
+                         for d in misaligned}
+            requested = {d: c for d, c in requested.items()
+                         if isinstance(c, int)}
+            suggested = {d: c for d, c in aligned_chunks(ds, requested).items()
+                         if d in misaligned}
+            warnings.warn(
+                "chunks=%r split stored chunks along %s, so those get decoded "
+                "by several tasks; consider %r for those dimensions, or "
+                "chunks=%r" % (chunks, misaligned, suggested, AUTO_ALIGNED),
+                stacklevel=2)
+        return ds
+
+    def export_zarr(self, target, chunks=None, compressor=None,
+                    zarr_format=None, scheduler='dask', max_workers=None,
+                    storage_options=None, shards=None):
+        """Write this source's data to a Zarr store
+
+        The metadata, coordinates and any variables not held by dask are
+        written first. Then every dask chunk of the data is written as an
+        independent region, in parallel; since Zarr chunks are made the
+        same as the dask chunks, no two regions share a Zarr chunk and no
+        locking is needed. Each finished region is recorded in a
+        ``<target>.progress`` directory, removed on success, and calling
+        again after an interruption skips the regions already written.
+
+        Parameters
+        ----------
+        target: str
+            Location of the new store, local or remote
+        chunks: dict or int, optional
+            Chunks of the output, and so of the regions written by each
+            task; along dimensions not given, those of ``to_dask()``, made
+            uniform. With ``shards``, the inner chunks of each shard
+            instead.
+        compressor: codec, optional
+            Such as ``zarr.codecs.BloscCodec(cname='zstd')`` or a numcodecs
+            codec for ``zarr_format=2``; by default Zarr's.
+        zarr_format: 2 or 3, optional
+            By default, Zarr's default.
+        scheduler: 'dask' or 'processes'
+            Write the regions as tasks of the current dask scheduler, or
+            in a pool of processes.
+        max_workers: int, optional
+            Size of the process pool.
+        storage_options: dict, optional
+            For a remote ``target``.
+        shards: dict or int, optional
+            Write Zarr v3 sharded arrays, with shards of this size, each
+            holding whole ``chunks`` and written by one task, so that the
+            store has one object per shard rather than per chunk. Needs
+            zarr>=3.
+
+        Returns
+        -------
+        ZarrSource of the new store
+        """
+        from intake_xarray.xzarr import (ZarrSource, _require_zarr3,
+                                         _zarr_major)
+
+        if scheduler not in ('dask', 'processes'):
+            raise ValueError("scheduler must be 'dask' or 'processes'")
+        if shards is not None and zarr_format == 2:
+            raise ValueError('Sharding needs zarr_format=3')
+        if shards is not None:
+            _require_zarr3('shards')
+        if zarr_format == 3:
+            _require_zarr3('zarr_format=3')
+        fmt = {} if zarr_format is None else {'zarr_format': zarr_format}
+        ds = _uniform_chunks(_as_dataset(self.to_dask()),
+                             chunks if shards is None else shards)
+        for var in ds.variables.values():
+            var.encoding = {k: v for k, v in var.encoding.items()
+                            if k in _CF_ENCODING}
+        encoding = {}
+        for name, var in ds.variables.items():
+            enc = {}
+            if var.chunks is not None:
+                outer = tuple(c[0] for c in var.chunks)
+                enc['chunks'] = outer
+                if shards is not None:
+                    enc['shards'] = outer
+                    enc['chunks'] = tuple(min(
+                        chunks if isinstance(chunks, int) else
+                        (chunks or {}).get(d, n), n)
+                        for d, n in zip(var.dims, outer))
+            if compressor is not None and _zarr_major() >= 3:
+                enc['compressors'] = [compressor]
+            elif compressor is not None:
+                enc['compressor'] = compressor
+            encoding[name] = enc
+
+        so = storage_options or {}
+        fs, path = fsspec.core.url_to_fs(target, **so)
+        progress = path.rstrip('/') + '.progress'
+        if not fs.exists(progress):
+            # coordinates may not be split into regions
+            ds = ds.assign_coords({k: v.variable.load()
+                                   for k, v in ds.coords.items()})
+            ds.to_zarr(target, mode='w', compute=False, encoding=encoding,
+                       consolidated=True, storage_options=storage_options,
+                       **fmt)
+            fs.makedirs(progress, exist_ok=True)
+        done = {p.rstrip('/').rsplit('/', 1)[-1]
+                for p in fs.ls(progress, detail=False)}
+
+        import dask
+        from dask.base import tokenize
+
+        tasks = []
+        for names, region in _export_regions(ds):
+            key = tokenize(names, region)
+            if key not in done:
+                marker = fs.unstrip_protocol(progress + '/' + key)
+                # only the chunks of this region, not the whole variables
+                part, = dask.optimize(ds[names].isel(region))
+                tasks.append((part, target, region, marker, storage_options))
+        if scheduler == 'dask':
+            # each task is given its region loaded
+            dask.compute(*[dask.delayed(_write_region, pure=False)(*task)
+                           for task in tasks])
+        elif tasks:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # forked children would inherit zarr's and dask's threads stuck
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers, mp_context=context) as pool:
+                list(pool.map(_write_region, *zip(*tasks)))
+        fs.rm(progress, recursive=True)
+        return ZarrSource(target, storage_options=storage_options)
 
     def __call__(self, *args, **kwargs):
         return self
@@ -15,6 +381,7 @@ class IntakeXarraySourceAdapter:
     get = __call__
 
     def read(self):
+        self._opening()
         return self.reader(chunks=None).read()
 
     discover = read
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import struct
+import tempfile
+
+import fsspec
+
+from intake_xarray.base import _file_infos, _file_version, _info_version
+
+INDEX_SUFFIX = '.index.json'
+# local copies of indexes, without an explicit index path, and of selected
+# messages
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'intake_xarray_grib')
+
+# code table 4.4, in seconds
+_TIME_UNITS = {0: 60, 1: 3600, 2: 86400, 10: 3 * 3600, 11: 6 * 3600,
+               12: 12 * 3600, 13: 1}
+# product definition templates with a statistical period: octet where the
+# end of the overall time interval starts
+_PERIOD_END = {8: 35, 9: 48, 10: 36, 11: 38, 12: 37}
+
+
+def _signed(raw):
+    """GRIB2 sign-and-magnitude integer, or None if all bits are set"""
+    value = int.from_bytes(raw, 'big')
+    if value == (1 << 8 * len(raw)) - 1:
+        return None
+    sign = 1 << (8 * len(raw) - 1)
+    return -(value & ~sign) if value & sign else value
+
+
+def _time(raw):
+    year, month, day, hour, minute, second = struct.unpack('>HBBBBB', raw)
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+def _product(section, reference):
+    """Parameter, level and valid time of a product definition section"""
+    template = struct.unpack('>H', section[7:9])[0]
+    out = dict(template=template, category=section[9], number=section[10],
+               level_type=None, level=None, valid_time=None)
+    if template > 15:
+        # the layout below is common to templates 4.0 to 4.15 only
+        return out
+    if section[22] != 255:
+        out['level_type'] = section[22]
+        scale, value = _signed(section[23:24]), _signed(section[24:28])
+        if value is not None:
+            out['level'] = value * 10. ** -(scale or 0)
+    if template in _PERIOD_END:
+        start = _PERIOD_END[template] - 1
+        out['valid_time'] = _time(section[start:start + 7])
+    else:
+        unit, step = _TIME_UNITS.get(section[17]), _signed(section[18:22])
+        if unit is not None and step is not None:
+            out['valid_time'] = reference + datetime.timedelta(
+                seconds=unit * step)
+    return out
+
+
+def scan_messages(f):
+    """Index entries of the messages of the open GRIB file ``f``
+
+    One entry per field: a GRIB2 message holding several fields gives as
+    many entries, with the same offset and length. Of GRIB1 messages only
+    the offset and length are given.
+    """
+    entries = []
+    offset = 0
+    while True:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 16:
+            break
+        if header[:4] != b'GRIB':
+            raise ValueError('No GRIB message at offset %d' % offset)
+        edition = header[7]
+        if edition != 2:
+            length = int.from_bytes(header[4:7], 'big')
+            entries.append(dict(offset=offset, length=length,
+                                edition=edition))
+            offset += length
+            continue
+        length = struct.unpack('>Q', header[8:16])[0]
+        discipline = header[6]
+        reference = None
+        position = offset + 16
+        while position < offset + length:
+            f.seek(position)
+            start = f.read(5)
+            if start[:4] == b'7777':
+                break
+            size, number = struct.unpack('>IB', start)
+            if number in (1, 4):
+                section = start + f.read(size - 5)
+                if number == 1:
+                    reference = _time(section[12:19])
+                else:
+                    product = _product(section, reference)
+                    entries.append(dict(
+                        offset=offset, length=length, edition=2,
+                        parameter='%d.%d.%d' % (discipline,
+                                                product.pop('category'),
+                                                product.pop('number')),
+                        reference_time=reference, **product))
+            position += size
+        offset += length
+    return entries
+
+
+def _encode(entries):
+    return [{k: v.isoformat() if isinstance(v, datetime.datetime) else v
+             for k, v in entry.items()} for entry in entries]
+
+
+def _decode(messages):
+    return [{k: datetime.datetime.fromisoformat(v)
+             if k.endswith('_time') and v else v for k, v in entry.items()}
+            for entry in messages]
+
+
+def _indexed(fs, path, version, known=None):
+    """Index of ``path`` as stored: ``known``, if made for the file at its
+    current ``version``, or else scanned anew"""
+    if known is not None and known.get('version') == version:
+        return known
+    with fs.open(path, 'rb') as f:
+        return {'version': version, 'messages': _encode(scan_messages(f))}
+
+
+def message_index(fs, path, version=None):
+    """Index entries of the GRIB file at ``path`` of ``fs``
+
+    Kept in the local cache, and read from there by later calls until the
+    file changes size, ETag or modification time; ``version``, from
+    ``_file_version``, is asked of ``fs`` if not given.
+    """
+    from dask.base import tokenize
+
+    if version is None:
+        version = _file_version(fs, path)
+    version = list(version)
+    local = os.path.join(CACHE_DIR,
+                         tokenize(fs.unstrip_protocol(path)) + INDEX_SUFFIX)
+    try:
+        with open(local) as f:
+            known = json.load(f)
+    except (OSError, ValueError):
+        known = None
+    index = _indexed(fs, path, version, known)
+    if index is not known:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(local, 'w') as f:
+            json.dump(index, f)
+    return _decode(index['messages'])
+
+
+def message_indexes(fs, paths, index_path=None, storage_options=None):
+    """Index entries of each of the GRIB files at ``paths`` of ``fs``
+
+    If ``index_path`` is given, the JSON file there holds the indexes of
+    all the files: it is loaded, only files not in it or changed since are
+    scanned, and it is rewritten if anything changed. Otherwise, each
+    file's index is kept in the local cache. The versions of all the files
+    are gathered up front, listing each directory once.
+    """
+    infos = _file_infos(fs, paths)
+    versions = {p: list(_info_version(infos[p])) for p in paths}
+    if index_path is None:
+        return [message_index(fs, path, versions[path]) for path in paths]
+    ifs, ipath = fsspec.core.url_to_fs(index_path, **(storage_options or {}))
+    stored = {}
+    if ifs.exists(ipath):
+        with ifs.open(ipath, 'r') as f:
+            stored = json.load(f)
+    updated = {}
+    for path in paths:
+        url = fs.unstrip_protocol(path)
+        updated[url] = _indexed(fs, path, versions[path], stored.get(url))
+    if updated != stored:
+        with ifs.open(ipath, 'w') as f:
+            json.dump(updated, f)
+    return [_decode(updated[fs.unstrip_protocol(path)]['messages'])
+            for path in paths]
+
+
+def select(index, **criteria):
+    """Rows of the ``index`` DataFrame matching all ``criteria``: a value,
+    a list of values, or a slice of values, inclusive, for each column"""
+    mask = True
+    for key, value in criteria.items():
+        column = index[key]
+        if isinstance(value, slice):
+            match = column.between(
+                value.start if value.start is not None else column.min(),
+                value.stop if value.stop is not None else column.max())
+        elif isinstance(value, (list, tuple, set)):
+            match = column.isin(list(value))
+        else:
+            match = column == value
+        mask = mask & match
+    return index[mask] if criteria else index
+
+
+def extract_messages(fs, rows, target):
+    """Write the messages of ``rows`` of an index to the local ``target``
+
+    The messages are fetched in one batch of range reads, one per run of
+    messages adjacent in their file.
+    """
+    ranges = []
+    for url, offset, length in sorted(set(zip(rows['url'], rows['offset'],
+                                              rows['length']))):
+        if ranges and ranges[-1][0] == url and ranges[-1][2] == offset:
+            ranges[-1][2] = offset + length
+        else:
+            ranges.append([url, offset, offset + length])
+    paths, starts, ends = zip(*ranges)
+    blocks = fs.cat_ranges([fs._strip_protocol(p) for p in paths],
+                           list(starts), list(ends))
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    partial = target + '.part'
+    with open(partial, 'wb') as f:
+        for block in blocks:
+            f.write(block)
+    os.replace(partial, target)
+    return target
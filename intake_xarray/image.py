@@ -6,50 +6,85 @@ from intake import readers
 from intake_xarray.base import IntakeXarraySourceAdapter
 
 
-def _coerce_shape(array, shape):
-    """ Trim or pad array to match desired shape"""
-    import numpy as np
-
+def _check_shape(shape):
     if len(shape) != 2:
         raise ValueError('coerce_shape must be an iterable of len 2')
+    return tuple(shape)
 
-    target_shape = tuple(shape)
-    actual_shape = array.shape
-    ndims = len(actual_shape)
 
-    if actual_shape[:2] == target_shape:
-        # no trimming or padding needed
-        return array
+def _coerce_into(array, out, mode='trim'):
+    """ Trim or pad array into the preallocated ``out``, in place
 
-    # do any necessary trimming first
-    for i, (a, t) in enumerate(zip(actual_shape[:2], target_shape)):
-        if a > t:
-            if i == 0:
-                if ndims == 2:
-                    array = array[:t, :]
-                else:
-                    array = array[:t, :, :]
-            else:
-                if ndims == 2:
-                    array = array[:, :t]
-                else:
-                    array = array[:, :t, :]
+    Only the overlapping region is copied and only the margins that it
+    does not cover are zeroed, so no intermediate array is allocated
+    (except for ``mode='resize'``, which has to interpolate).
+
+    Parameters
+    ----------
+    array : numpy array
+        Image of shape (height, width) or (height, width, channel)
+    out : numpy array
+        Destination, with the target (height, width) as its first two
+        dimensions and any further dimensions matching ``array``.
+    mode : {'trim', 'center', 'resize'}
+        'trim' keeps the top-left corner of the image, padding at the bottom
+        and right; 'center' crops or pads equally on both sides; 'resize'
+        rescales the image to the target shape.
+    """
+    if mode == 'resize':
+        import numpy as np
+        from skimage.transform import resize
+
+        resized = resize(array, out.shape[:2] + array.shape[2:],
+                         preserve_range=True, anti_aliasing=True)
+        if np.issubdtype(out.dtype, np.integer):
+            # round rather than truncate, within the range of the dtype
+            info = np.iinfo(out.dtype)
+            resized = np.clip(np.rint(resized), info.min, info.max)
+        out[...] = resized
+        return out
+    if mode not in ('trim', 'center'):
+        raise ValueError("coerce_mode must be one of 'trim', 'center' "
+                         "or 'resize', got %r" % mode)
+
+    src = []
+    dst = []
+    for a, t in zip(array.shape[:2], out.shape[:2]):
+        n = min(a, t)
+        if mode == 'center':
+            src.append(slice((a - n) // 2, (a - n) // 2 + n))
+            dst.append(slice((t - n) // 2, (t - n) // 2 + n))
+        else:
+            src.append(slice(0, n))
+            dst.append(slice(0, n))
+    (sy, sx), (dy, dx) = src, dst
+
+    out[dy, dx] = array[sy, sx]
+    # zero only the margins not covered by the copy
+    out[:dy.start] = 0
+    out[dy.stop:] = 0
+    out[dy, :dx.start] = 0
+    out[dy, dx.stop:] = 0
+    return out
+
+
+def _coerce_shape(array, shape, mode='trim'):
+    """ Trim or pad array to match desired shape"""
+    import numpy as np
+
+    target_shape = _check_shape(shape)
 
     if array.shape[:2] == target_shape:
-        # only needed trimming
+        # no trimming or padding needed
         return array
 
-    # create array of zeros and fill with trimmed value array
-    if ndims == 2:
-        new_array = np.zeros(target_shape, dtype=array.dtype)
-        new_array[:array.shape[0], :array.shape[1]] = array
-    else:
-        new_array = np.zeros((target_shape[0],
-                              target_shape[1],
-                              actual_shape[2]), dtype=array.dtype)
-        new_array[:array.shape[0], :array.shape[1], :] = array
+    if mode == 'trim' and all(a >= t for a, t in zip(array.shape[:2],
+                                                     target_shape)):
+        # only needs trimming, which is a view
+        return array[:target_shape[0], :target_shape[1]]
 
-    return new_array
+    new_array = np.empty(target_shape + array.shape[2:], dtype=array.dtype)
+    return _coerce_into(array, new_array, mode)
 
 
 def _add_leading_dimension(x):
@@ -57,64 +92,404 @@ def _add_leading_dimension(x):
     return x[None, ...]
 
 
-def _dask_imread(files, imread=None, preprocess=None, coerce_shape=None):
+def _imread_file(open_file, imread=None):
+    if not imread:
+        from skimage.io import imread
+
+    with open_file as f:
+        return imread(f)
+
+
+def _read_block(files, shape, dtype, imread=None, preprocess=None,
+                coerce_shape=None, coerce_mode='trim', out=None):
+    """ Read a batch of images into one block
+
+    Each image is decoded and then coerced directly into its slot of the
+    output, so there is no per-image intermediate and no concatenation.
+    The block is newly allocated unless given as ``out``.
+    """
+    import numpy as np
+
+    if out is None and len(files) == 1 and coerce_shape is None:
+        # nothing to coerce or gather, avoid the copy into a block
+        image = _imread_file(files[0], imread)
+        if preprocess:
+            image = preprocess(image)
+        return _add_leading_dimension(image)
+
+    if out is None:
+        out = np.empty((len(files), ) + tuple(shape), dtype=dtype)
+    for i, f in enumerate(files):
+        image = _imread_file(f, imread)
+        if preprocess:
+            if coerce_shape is not None:
+                image = _coerce_shape(image, coerce_shape, coerce_mode)
+            out[i] = preprocess(image)
+        elif coerce_shape is not None:
+            _coerce_into(image, out[i], coerce_mode)
+        else:
+            out[i] = image
+    return out
+
+
+_process_pools = {}
+
+
+def _get_process_pool(processes):
+    """ Process pool with the given number of workers, shared per process """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    if processes not in _process_pools:
+        # spawn, since forking the threads of a dask scheduler is unsafe
+        _process_pools[processes] = ProcessPoolExecutor(
+            max_workers=processes, mp_context=get_context('spawn'))
+    return _process_pools[processes]
+
+
+def _attach_shared_memory(name):
+    from multiprocessing import shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always tracks; the creating process unlinks
+        return shared_memory.SharedMemory(name=name)
+
+
+def _read_block_shared(name, files, shape, dtype, **kwargs):
+    """ Read a block in a worker process, into the named shared memory """
+    import numpy as np
+
+    shm = _attach_shared_memory(name)
+    try:
+        out = np.ndarray((len(files), ) + tuple(shape), dtype=dtype,
+                         buffer=shm.buf)
+        _read_block(files, shape, dtype, out=out, **kwargs)
+        del out
+    finally:
+        shm.close()
+
+
+def _read_block_in_process(files, shape, dtype, processes, **kwargs):
+    """ Read a block in a pool of worker processes
+
+    The worker decodes straight into shared memory allocated here, so the
+    pixels are never pickled; the returned array is a view on that memory,
+    which is released when the array is garbage collected.
+    """
+    import weakref
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    block_shape = (len(files), ) + tuple(shape)
+    nbytes = int(np.prod(block_shape)) * np.dtype(dtype).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    try:
+        _get_process_pool(processes).submit(
+            _read_block_shared, shm.name, files, shape, dtype, **kwargs
+        ).result()
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    # the mapping stays valid after unlinking, until closed
+    shm.unlink()
+    out = np.ndarray(block_shape, dtype=dtype, buffer=shm.buf)
+    weakref.finalize(out, shm.close)
+    return out
+
+
+def _dask_imread(files, imread=None, preprocess=None, coerce_shape=None,
+                 coerce_mode='trim', batch_size=1, processes=None):
     """ Read a stack of images into a dask array """
     from dask.array import Array
     from dask.base import tokenize
     from functools import partial
 
-    if not imread:
-        from skimage.io import imread
-
-    def _imread(open_file):
-        with open_file as f:
-            return imread(f)
-
     filenames = [f.path for f in files]
 
-    name = 'imread-%s' % tokenize(filenames)
+    name = 'imread-%s' % tokenize(filenames, coerce_shape, coerce_mode,
+                                  batch_size)
 
     if coerce_shape is not None:
-        reshape = partial(_coerce_shape, shape=coerce_shape)
+        coerce_shape = _check_shape(coerce_shape)
 
-    with files[0] as f:
-        sample = imread(f)
+    sample = _imread_file(files[0], imread)
     if coerce_shape is not None:
-        sample = reshape(sample)
+        sample = _coerce_shape(sample, coerce_shape, coerce_mode)
     if preprocess:
         sample = preprocess(sample)
 
-    keys = [(name, i) + (0,) * len(sample.shape)
-            for i in range(len(files))]
-
-    if coerce_shape is not None:
-        if preprocess:
-            values = [(_add_leading_dimension,
-                       (preprocess,
-                        (reshape,
-                         (_imread, f))))
-                      for f in files]
-        else:
-            values = [(_add_leading_dimension,
-                       (reshape,
-                        (_imread, f)))
-                      for f in files]
-    elif preprocess:
-        values = [(_add_leading_dimension,
-                   (preprocess,
-                    (_imread, f)))
-                  for f in files]
+    if processes:
+        if processes is True:
+            import os
+            processes = os.cpu_count()
+        read = partial(_read_block_in_process, processes=processes)
     else:
-        values = [(_add_leading_dimension,
-                   (_imread, f))
-                  for f in files]
+        read = _read_block
+    read = partial(read, shape=sample.shape, dtype=sample.dtype,
+                   imread=imread, preprocess=preprocess,
+                   coerce_shape=coerce_shape, coerce_mode=coerce_mode)
+
+    batch_size = max(int(batch_size), 1)
+    starts = range(0, len(files), batch_size)
+    keys = [(name, i) + (0,) * len(sample.shape)
+            for i in range(len(starts))]
+    values = [(read, files[s:s + batch_size]) for s in starts]
     dsk = dict(zip(keys, values))
 
-    chunks = ((1, ) * len(files), ) + tuple((d, ) for d in sample.shape)
+    chunks = (tuple(len(v[1]) for v in values), ) + tuple(
+        (d, ) for d in sample.shape)
 
     return Array(dsk, name, chunks, sample.dtype)
 
 
+def _tiff_page_offsets(open_file):
+    """ Walk the IFD chain of a TIFF once
+
+    Returns the file offsets of the IFD of every page, with the shape and
+    dtype of the first page, which all pages must share.
+    """
+    from tifffile import TiffFile
+
+    with open_file as f, TiffFile(f) as tif:
+        keyframe = tif.pages.first
+        if keyframe.axes not in ('YX', 'YXS'):
+            raise ValueError('Only pages with axes YX or YXS (channel last) '
+                             'can be stacked, got %r' % keyframe.axes)
+        tif.pages.useframes = True
+        offsets = [page.offset for page in tif.pages]
+        return offsets, keyframe.shape, keyframe.dtype
+
+
+def _read_tiff_pages(open_file, offsets, start, shape, dtype):
+    """ Read a run of pages from a TIFF into one block
+
+    Each page is located directly from its known IFD offset, so no other
+    part of the IFD chain is read.
+    """
+    import numpy as np
+    from tifffile import TiffFile, TiffPage
+
+    out = np.empty((1, len(offsets)) + tuple(shape), dtype=dtype)
+    with open_file as f, TiffFile(f) as tif:
+        for i, offset in enumerate(offsets):
+            tif.filehandle.seek(offset)
+            page = TiffPage(tif, index=start + i)
+            page.asarray(out=out[0, i])
+    return out
+
+
+def _dask_tiffpages(files, pages_per_chunk=1):
+    """ Read the pages of a set of multi-page TIFFs into a dask array
+
+    The result has shape (file, page, y, x[, channel]).
+    """
+    from dask import compute, delayed
+    from dask.array import Array
+    from dask.base import tokenize
+
+    parsed = compute(*[delayed(_tiff_page_offsets)(f) for f in files])
+    npages = len(parsed[0][0])
+    shape, dtype = parsed[0][1:]
+    for f, (offsets, fshape, fdtype) in zip(files, parsed):
+        if (len(offsets), fshape, fdtype) != (npages, shape, dtype):
+            raise ValueError('All files must have the same number of pages, '
+                             'with the same shape and dtype; %s differs'
+                             % f.path)
+
+    filenames = [f.path for f in files]
+    name = 'tiffpages-%s' % tokenize(filenames, pages_per_chunk)
+
+    pages_per_chunk = max(int(pages_per_chunk), 1)
+    starts = range(0, npages, pages_per_chunk)
+    dsk = {}
+    for i, (f, (offsets, _, _)) in enumerate(zip(files, parsed)):
+        for j, s in enumerate(starts):
+            dsk[(name, i, j) + (0, ) * len(shape)] = (
+                _read_tiff_pages, f, offsets[s:s + pages_per_chunk], s,
+                shape, dtype)
+
+    chunks = ((1, ) * len(files),
+              tuple(min(pages_per_chunk, npages - s) for s in starts)) + \
+        tuple((d, ) for d in shape)
+    return Array(dsk, name, chunks, dtype)
+
+
+def _read_image_shape(open_file, imread=None, preprocess=None):
+    """ Shape of a single image, from its header when possible
+
+    Decoding is only needed when the pixels are transformed by a custom
+    ``imread`` or ``preprocess``, or for palette images, which
+    ``skimage.io.imread`` expands to RGB(A).
+    """
+    if imread is None and preprocess is None:
+        try:
+            from PIL import Image
+
+            with open_file as f:
+                im = Image.open(f)
+                if im.mode not in ('P', 'PA'):
+                    nbands = len(im.getbands())
+                    width, height = im.size
+                    return (height, width) + ((nbands, ) if nbands > 1 else ())
+        except Exception:
+            pass
+    image = _imread_file(open_file, imread)
+    if preprocess:
+        image = preprocess(image)
+    return image.shape
+
+
+def _read_flat_block(files, shapes, dtype, imread=None, preprocess=None):
+    """ Read a batch of images into one flat, preallocated pixel buffer """
+    import numpy as np
+
+    tail = shapes[0][2:]
+    sizes = [shape[0] * shape[1] for shape in shapes]
+    out = np.empty((sum(sizes), ) + tail, dtype=dtype)
+    offset = 0
+    for f, shape, size in zip(files, shapes, sizes):
+        image = _imread_file(f, imread)
+        if preprocess:
+            image = preprocess(image)
+        if image.shape != shape:
+            raise ValueError('Image %s has shape %s, but its header gave %s'
+                             % (f.path, image.shape, shape))
+        out[offset:offset + size] = image.reshape((size, ) + tail)
+        offset += size
+    return out
+
+
+def ragged_reader(files, chunks, concat_dim, ragged, exif_tags=None,
+                  field_values=None, imread=None, preprocess=None):
+    """Read images of differing shapes into a dask xarray Dataset
+
+    Unlike ``coerce_shape``, no image is padded or trimmed. Image shapes
+    are taken from the file headers where possible, without decoding.
+
+    Parameters
+    ----------
+    files : iter
+        List of file objects
+    chunks : int or dict
+        Chunks is used to load the new dataset into dask arrays. An int
+        for ``concat_dim`` sets the number of images read per task.
+    concat_dim : str
+        Dimension over which to concatenate.
+    ragged : {'flat', 'bucket'}
+        With 'flat', the pixels of all images are packed into the 1-D (or
+        2-D, with channels) variable 'raster' along dimension 'pixel', and
+        each image is located by the coordinates 'offset', 'height' and
+        'width' along ``concat_dim``, i.e., image ``i`` is
+        ``raster[offset[i]:offset[i] + height[i] * width[i]]``, reshaped
+        to ``(height[i], width[i])``.
+        With 'bucket', images are grouped by shape into one variable per
+        shape, named like ``raster_<height>x<width>``, stacked along a
+        dimension of the same suffix, ``<concat_dim>_<height>x<width>``.
+        The coordinate ``file_index_<height>x<width>`` gives the position
+        of each image in the full list of files.
+    exif_tags : boolean or list of str (optional)
+        As for ``multireader``; only supported with ``ragged='flat'``.
+    field_values : dict (optional)
+        Values of the path pattern fields of each file, to add as
+        coordinates along the concatenated dimension(s).
+    imread : function (optional)
+        Optionally provide custom imread function.
+    preprocess : function (optional)
+        Optionally provide custom function to preprocess the image.
+
+    Returns
+    -------
+    A Dask xarray.Dataset
+    """
+    import numpy as np
+    from dask import compute, delayed
+    from dask.array import Array
+    from dask.base import tokenize
+    from functools import partial
+    from xarray import DataArray, Dataset
+
+    if ragged not in ('flat', 'bucket'):
+        raise ValueError("ragged must be one of 'flat' or 'bucket', got %r"
+                         % ragged)
+    if not isinstance(concat_dim, str):
+        raise ValueError('ragged images can only be concatenated along a '
+                         'single dimension')
+    if exif_tags and ragged == 'bucket':
+        raise ValueError("exif_tags are only supported with ragged='flat'")
+
+    shapes = compute(*[delayed(_read_image_shape)(f, imread, preprocess)
+                       for f in files])
+    if len({shape[2:] for shape in shapes}) > 1:
+        raise ValueError('Ragged images must all have the same number of '
+                         'channels')
+    sample = _imread_file(files[0], imread)
+    if preprocess:
+        sample = preprocess(sample)
+    dtype = sample.dtype
+    tail = shapes[0][2:]
+    channel_dims = ('channel', ) if tail else ()
+
+    batch_size = 1
+    if isinstance(chunks, dict) and isinstance(chunks.get(concat_dim), int):
+        batch_size = max(chunks[concat_dim], 1)
+    filenames = [f.path for f in files]
+    field_values = field_values or {}
+
+    if ragged == 'flat':
+        name = 'imread-ragged-%s' % tokenize(filenames, shapes, batch_size)
+        read = partial(_read_flat_block, dtype=dtype, imread=imread,
+                       preprocess=preprocess)
+        starts = range(0, len(files), batch_size)
+        dsk = {}
+        block_sizes = []
+        for i, s in enumerate(starts):
+            part = list(shapes[s:s + batch_size])
+            dsk[(name, i) + (0, ) * len(tail)] = (
+                read, files[s:s + batch_size], part)
+            block_sizes.append(sum(shape[0] * shape[1] for shape in part))
+        raster = Array(dsk, name, (tuple(block_sizes), ) +
+                       tuple((d, ) for d in tail), dtype)
+
+        heights = np.array([shape[0] for shape in shapes], dtype='int64')
+        widths = np.array([shape[1] for shape in shapes], dtype='int64')
+        offsets = np.concatenate([[0], np.cumsum(heights * widths)[:-1]])
+        coords = {concat_dim: np.arange(len(files)),
+                  'height': (concat_dim, heights),
+                  'width': (concat_dim, widths),
+                  'offset': (concat_dim, offsets)}
+        coords.update({k: (concat_dim, v) for k, v in field_values.items()})
+        if tail:
+            coords['channel'] = np.arange(tail[0])
+        data_vars = {'raster': (('pixel', ) + channel_dims, raster)}
+        if exif_tags:
+            exif_dict = _dask_exifread(files, exif_tags)
+            data_vars.update({tag: (concat_dim, arr)
+                              for tag, arr in exif_dict.items()})
+        return Dataset(data_vars, coords=coords)
+
+    buckets = {}
+    for i, shape in enumerate(shapes):
+        buckets.setdefault(shape, []).append(i)
+    data_vars = {}
+    coords = {'channel': np.arange(tail[0])} if tail else {}
+    for shape, indices in buckets.items():
+        suffix = '%dx%d' % shape[:2]
+        dim = '%s_%s' % (concat_dim, suffix)
+        arr = _dask_imread([files[i] for i in indices], imread=imread,
+                           preprocess=preprocess, batch_size=batch_size)
+        data_vars['raster_' + suffix] = DataArray(
+            arr, dims=(dim, 'y_%d' % shape[0], 'x_%d' % shape[1])
+            + channel_dims)
+        coords.update({'%s_%s' % (k, suffix): (dim, np.asarray(v)[indices])
+                       for k, v in field_values.items()})
+        coords.setdefault(dim, np.arange(len(indices)))
+        coords['file_index_' + suffix] = (dim, np.array(indices))
+    return Dataset(data_vars, coords=coords)
+
+
 def _dask_exifread(files, exif_tags):
     """Construct a dask Array to read each tag in `exif_tags` (list of
     str) from the EXIF data of the images in `files`
@@ -159,7 +534,102 @@ def _dask_exifread(files, exif_tags):
     return {'EXIF ' + tag: exif_data[:,i] for i, tag in enumerate(exif_tags)}
 
 
-def multireader(files, chunks, concat_dim, exif_tags, **kwargs):
+def _video_index(open_file, stream=0, format='rgb24'):
+    """ Demux (without decoding) a video stream to index its frames
+
+    Returns the presentation timestamps of all frames and of the keyframes,
+    in stream time-base units and sorted, the time base, and the first
+    frame, decoded in the given pixel format, as a sample.
+    """
+    import av
+
+    with open_file as f, av.open(f) as container:
+        vstream = container.streams.video[stream]
+        sample = next(container.decode(vstream)).to_ndarray(format=format)
+        container.seek(0, stream=vstream, backward=True)
+        pts = []
+        keyframes = []
+        for packet in container.demux(vstream):
+            if packet.pts is None:
+                # flushing packet
+                continue
+            pts.append(packet.pts)
+            if packet.is_keyframe:
+                keyframes.append(packet.pts)
+        return sorted(pts), sorted(keyframes), vstream.time_base, sample
+
+
+def _read_video_frames(open_file, seek_pts, pts, shape, dtype, stream=0,
+                       format='rgb24'):
+    """ Decode the frames with the given timestamps into one block
+
+    Decoding starts from the keyframe at ``seek_pts`` and stops as soon as
+    the last wanted frame is out, so only the GOPs covering ``pts`` are
+    decoded.
+    """
+    import av
+    import numpy as np
+
+    out = np.empty((len(pts), ) + tuple(shape), dtype=dtype)
+    wanted = {p: i for i, p in enumerate(pts)}
+    found = 0
+    with open_file as f, av.open(f) as container:
+        vstream = container.streams.video[stream]
+        container.seek(seek_pts, stream=vstream, backward=True)
+        for frame in container.decode(vstream):
+            if frame.pts in wanted:
+                out[wanted[frame.pts]] = frame.to_ndarray(format=format)
+                found += 1
+                if found == len(pts):
+                    return out
+            elif frame.pts is not None and frame.pts > pts[-1]:
+                break
+    raise ValueError('Could not decode frames %s to %s of %s'
+                     % (pts[0], pts[-1], open_file.path))
+
+
+def _dask_videoread(open_file, frames_per_chunk=None, stream=0,
+                    format='rgb24'):
+    """ Read the frames of a video into a dask array
+
+    Returns the array, of shape (frame, y, x[, channel]), and the timestamp
+    of every frame in seconds. Unless ``frames_per_chunk`` is given, each
+    chunk is one GOP, i.e., runs from one keyframe to the next.
+    """
+    import bisect
+    import numpy as np
+    from dask.array import Array
+    from dask.base import tokenize
+
+    pts, keyframes, time_base, sample = _video_index(open_file, stream,
+                                                     format)
+    shape, dtype = sample.shape, sample.dtype
+    keyframes = keyframes or pts[:1]
+
+    if frames_per_chunk:
+        starts = list(range(0, len(pts), int(frames_per_chunk)))
+    else:
+        starts = sorted({bisect.bisect_left(pts, k) for k in keyframes}
+                        | {0})
+    stops = starts[1:] + [len(pts)]
+
+    name = 'videoread-%s' % tokenize(open_file.path, frames_per_chunk,
+                                     stream, format)
+    dsk = {}
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        # nearest keyframe at or before the first frame of the chunk
+        k = bisect.bisect_right(keyframes, pts[start]) - 1
+        seek_pts = keyframes[max(k, 0)]
+        dsk[(name, i) + (0, ) * len(shape)] = (
+            _read_video_frames, open_file, seek_pts, pts[start:stop], shape,
+            dtype, stream, format)
+    chunks = (tuple(b - a for a, b in zip(starts, stops)), ) + tuple(
+        (d, ) for d in shape)
+    times = np.array(pts, dtype='float64') * float(time_base)
+    return Array(dsk, name, chunks, dtype), times
+
+
+def multireader(files, chunks, concat_dim, exif_tags, pages=None, **kwargs):
     """Read a stack of images into a dask xarray object
 
     NOTE: copied from dask.array.image.imread but altering the input to accept
@@ -188,6 +658,17 @@ def multireader(files, chunks, concat_dim, exif_tags, **kwargs):
     coerce_shape : iterable of len 2 (optional)
         Optionally coerce the shape of the height and width of the image
         by setting `coerce_shape` to desired shape.
+    coerce_mode : {'trim', 'center', 'resize'} (optional)
+        How images are brought to ``coerce_shape``: 'trim' (default) keeps
+        the top-left corner and pads at the bottom and right, 'center'
+        crops or pads equally on both sides, 'resize' rescales the image.
+    processes : int or bool (optional)
+        Decode images in a pool of this many worker processes (all cores,
+        if True), for decoders that hold the GIL and so do not run in
+        parallel under dask's threaded scheduler. Decoded blocks are
+        returned through shared memory rather than pickled. A custom
+        ``imread`` or ``preprocess`` must then be picklable, e.g., a
+        module-level function.
     exif_tags : boolean or list of str (optional)
         Controls whether exif tags are extracted from the images. If a
         list, the elements are treated as the particular tags to
@@ -197,6 +678,13 @@ def multireader(files, chunks, concat_dim, exif_tags, **kwargs):
         each exif tag in a corresponding data variable of the Dataset,
         (of type `Optional[exifread.classes.IfdTag]`), and the image
         data in a data variable 'raster'.
+    pages : bool or int (optional)
+        Treat each file as a multi-page TIFF, such as a z-stack or
+        time-lapse, stacking its pages along a new dimension 'page'. If an
+        int, the number of pages per chunk, otherwise each page is a chunk.
+        The IFD chain of each file is walked once, up front, so that every
+        chunk reads only its own pages. The options for reading whole
+        images, ``imread`` to ``processes``, then raise ValueError.
 
     Returns
     -------
@@ -208,11 +696,28 @@ def multireader(files, chunks, concat_dim, exif_tags, **kwargs):
     import numpy as np
     from xarray import DataArray, Dataset
 
-    dask_array = _dask_imread(files, **kwargs)
-
-    ny, nx = dask_array.shape[1:3]
+    if pages:
+        # every other option is for reading whole images
+        unsupported = sorted(k for k, v in kwargs.items() if v is not None)
+        if unsupported:
+            raise ValueError('pages cannot be combined with %s'
+                             % ', '.join(unsupported))
+        pages_per_chunk = 1 if pages is True else pages
+        dask_array = _dask_tiffpages(files, pages_per_chunk)
+    else:
+        if (isinstance(chunks, dict) and isinstance(concat_dim, str)
+                and isinstance(chunks.get(concat_dim), int)):
+            # build blocks of the requested size directly, rather than
+            # reading single images and concatenating them on rechunk
+            kwargs.setdefault('batch_size', chunks[concat_dim])
+        dask_array = _dask_imread(files, **kwargs)
+    page_dims = ('page', ) if pages else ()
+
+    ny, nx = dask_array.shape[1 + len(page_dims):3 + len(page_dims)]
     coords = {'y': np.arange(ny),
               'x': np.arange(nx)}
+    if pages:
+        coords['page'] = np.arange(dask_array.shape[1])
     if isinstance(concat_dim, list):
         dims = ('dim_0',)
     else:
@@ -220,9 +725,9 @@ def multireader(files, chunks, concat_dim, exif_tags, **kwargs):
         coords = {concat_dim: np.arange(dask_array.shape[0]),
                   **coords}
 
-    raster_dims = dims + ('y', 'x')
-    if len(dask_array.shape) == 4:
-        nchannel = dask_array.shape[3]
+    raster_dims = dims + page_dims + ('y', 'x')
+    if len(dask_array.shape) == 4 + len(page_dims):
+        nchannel = dask_array.shape[-1]
         coords['channel'] = np.arange(nchannel)
         raster_dims += ('channel',)
 
@@ -278,6 +783,17 @@ class ImageReader(readers.BaseReader):
     coerce_shape : iterable of len 2 (optional)
         Optionally coerce the shape of the height and width of the image
         by setting `coerce_shape` to desired shape.
+    coerce_mode : {'trim', 'center', 'resize'} (optional)
+        How images are brought to ``coerce_shape``: 'trim' (default) keeps
+        the top-left corner and pads at the bottom and right, 'center'
+        crops or pads equally on both sides, 'resize' rescales the image.
+    processes : int or bool (optional)
+        Decode images in a pool of this many worker processes (all cores,
+        if True), for decoders that hold the GIL and so do not run in
+        parallel under dask's threaded scheduler. Decoded blocks are
+        returned through shared memory rather than pickled. A custom
+        ``imread`` or ``preprocess`` must then be picklable, e.g., a
+        module-level function.
     exif_tags : boolean or list of str (optional)
         Controls whether exif tags are extracted from the images. If a
         list, the elements are treated as the particular tags to
@@ -287,6 +803,21 @@ class ImageReader(readers.BaseReader):
         each exif tag in a corresponding data variable of the Dataset,
         (of type `Optional[exifread.classes.IfdTag]`), and the image
         data in a data variable 'raster'.
+    ragged : {'flat', 'bucket'} (optional)
+        Read a collection of images with differing shapes without padding
+        them, as an xarray Dataset. 'flat' packs all pixels into a single
+        1-D variable with per-image 'offset', 'height' and 'width'
+        coordinates; 'bucket' makes one variable per distinct image shape.
+        See ``ragged_reader`` for the layout. Cannot be combined with
+        ``coerce_shape``, ``coerce_mode``, ``processes`` or ``pages``.
+    pages : bool or int (optional)
+        Treat each file as a multi-page TIFF (e.g., a microscopy z-stack or
+        time-lapse), with its pages along a new dimension 'page'. If an int,
+        the number of pages per chunk, otherwise each page is a chunk. Page
+        offsets are parsed once from the IFD chain, so reading any page
+        costs a direct seek. Requires ``tifffile``. Cannot be combined
+        with ``imread``, ``preprocess``, ``coerce_shape``, ``coerce_mode``
+        or ``processes``.
 
     """
     output_instance = "xarray:Dataset"
@@ -294,7 +825,8 @@ class ImageReader(readers.BaseReader):
 
     def _read(self, urlpath, chunks=None, concat_dim='concat_dim',
               metadata=None, path_as_pattern=None,
-              storage_options=None, exif_tags=None, **kwargs):
+              storage_options=None, exif_tags=None, ragged=None,
+              **kwargs):
         """
         This function is called when the data source refers to more
         than one file either as a list or a glob. It sets up the
@@ -321,6 +853,19 @@ class ImageReader(readers.BaseReader):
 
         files = fsspec.open_files(paths, **(storage_options or {}))
 
+        if ragged:
+            unsupported = sorted(k for k, v in kwargs.items()
+                                 if v is not None and k not in
+                                 ('imread', 'preprocess'))
+            if unsupported:
+                raise ValueError('ragged and %s are exclusive'
+                                 % ', '.join(unsupported))
+            return ragged_reader(
+                files, chunks, concat_dim, ragged, exif_tags,
+                field_values=field_values if path_as_pattern else None,
+                **kwargs
+            )
+
         out = multireader(
             files, chunks, concat_dim, exif_tags, **kwargs
         )
@@ -361,3 +906,66 @@ class ImageSource(IntakeXarraySourceAdapter):
 
     def __init__(self, *ar, **kw):
         self.reader = ImageReader(*ar, **kw)
+
+
+class VideoReader(readers.BaseReader):
+    """Open a video file as an xarray DataArray of frames.
+
+    Decoding is done with PyAV (``av``), so any container and codec
+    supported by FFmpeg can be read, e.g., MP4 or AVI. The output has
+    dimensions (frame, y, x, channel), with the presentation time of each
+    frame as the coordinate of 'frame', so that a time window can be
+    selected with, e.g., ``video.sel(frame=slice('10s', '20s'))``.
+
+    The packets of the file are indexed once, without decoding. Each chunk
+    is a contiguous range of frames, decoded starting from the nearest
+    preceding keyframe, so a selection only decodes the GOPs it needs.
+
+    Parameters
+    ----------
+    urlpath : str
+        Location of the video file, which may be remote if including a
+        protocol specifier such as ``'s3://'``.
+    chunks : int or dict
+        Chunks is used to rechunk the output dask array; prefer
+        ``frames_per_chunk`` to set the chunking along 'frame'.
+    frames_per_chunk : int (optional)
+        Number of frames per chunk. By default, each chunk is one GOP,
+        i.e., runs from one keyframe to the next.
+    stream : int
+        Index of the video stream to read, default the first.
+    format : str
+        Pixel format of the output, as understood by
+        ``av.VideoFrame.to_ndarray``. Default 'rgb24'; 'gray' gives
+        frames without a channel dimension.
+    storage_options : dict
+        Parameters passed to the backend file-system.
+    """
+    output_instance = "xarray:DataArray"
+
+    def _read(self, urlpath, chunks=None, frames_per_chunk=None, stream=0,
+              format='rgb24', storage_options=None, metadata=None):
+        import numpy as np
+        from xarray import DataArray
+
+        open_file = fsspec.open(urlpath, **(storage_options or {}))
+        array, times = _dask_videoread(open_file, frames_per_chunk, stream,
+                                       format)
+        dims = ('frame', 'y', 'x', 'channel')[:array.ndim]
+        coords = {'frame': (times * 1e9).astype('timedelta64[ns]'),
+                  'y': np.arange(array.shape[1]),
+                  'x': np.arange(array.shape[2])}
+        if array.ndim == 4:
+            coords['channel'] = np.arange(array.shape[3])
+        out = DataArray(array, dims=dims, coords=coords)
+        if chunks:
+            out = out.chunk(chunks)
+        return out
+
+
+class VideoSource(IntakeXarraySourceAdapter):
+    name = 'xarray_video'
+    container = "xarray"
+
+    def __init__(self, *ar, **kw):
+        self.reader = VideoReader(*ar, **kw)
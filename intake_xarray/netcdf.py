@@ -1,7 +1,220 @@
 # -*- coding: utf-8 -*-
+import collections
+import contextlib
+import threading
+import uuid
+import weakref
+
+from fsspec.implementations.local import LocalFileSystem
+
 from intake import readers
+from intake.readers.utils import pattern_to_glob
+
+from intake_xarray.base import IntakeXarraySourceAdapter, _expand_paths
+
+
+# options of combining several files, not of opening one
+_COMBINE_KWARGS = ('concat_dim', 'combine', 'parallel', 'preprocess', 'join',
+                   'data_vars', 'coords', 'compat', 'combine_attrs', 'pattern')
+
+
+class FileHandlePool(collections.abc.MutableMapping):
+    """LRU pool of the files a source keeps open, bounded by their number
+
+    Used as the cache of xarray's file managers in place of the global
+    one, whose size, ``xarray.set_options(file_cache_maxsize=...)``, is
+    shared by all sources. Opening a file beyond ``max_open`` closes the
+    least recently used one, unless a read is in progress on it.
+
+    A pool is pickled by name: file managers sent to workers of a process
+    or distributed scheduler share one pool per worker process, so that
+    tasks reading chunks of the same file reuse its open handle.
+
+    Parameters
+    ----------
+    max_open: int
+        Most files held open at once.
+    name: str, optional
+        Identifies the pool across processes; random by default.
+    """
+    _pools = weakref.WeakValueDictionary()
+
+    def __init__(self, max_open=128, name=None):
+        self.max_open = max_open
+        self.name = name or uuid.uuid4().hex
+        self.opens = 0
+        self.reopens = 0
+        self.evictions = 0
+        self._files = collections.OrderedDict()
+        self._evicted = set()
+        # files being read, by id, with their number of readers, and those
+        # of them evicted, to close when the last read ends
+        self._pins = {}
+        self._unpinned_close = {}
+        self._lock = threading.RLock()
+        FileHandlePool._pools[self.name] = self
+
+    @classmethod
+    def shared(cls, name, max_open=128):
+        """The pool of this process called ``name``, made if needed"""
+        pool = cls._pools.get(name)
+        return cls(max_open, name) if pool is None else pool
+
+    def __getitem__(self, key):
+        with self._lock:
+            file = self._files[key]
+            self._files.move_to_end(key)
+            return file
+
+    def __setitem__(self, key, file):
+        with self._lock:
+            if key not in self._files:
+                self.opens += 1
+                if key in self._evicted:
+                    self._evicted.discard(key)
+                    self.reopens += 1
+            self._files[key] = file
+            self._files.move_to_end(key)
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._files[key]
+
+    def __iter__(self):
+        return iter(list(self._files))
+
+    def __len__(self):
+        return len(self._files)
+
+    def resize(self, max_open):
+        """Change the bound, closing files as needed"""
+        with self._lock:
+            self.max_open = max_open
+            self._evict()
+
+    def _evict(self):
+        while len(self._files) > self.max_open:
+            key, file = self._files.popitem(last=False)
+            self._evicted.add(key)
+            self.evictions += 1
+            if id(file) in self._pins:
+                self._unpinned_close[id(file)] = file
+            else:
+                file.close()
+
+    def _pin(self, file):
+        with self._lock:
+            self._pins[id(file)] = self._pins.get(id(file), 0) + 1
+
+    def _unpin(self, file):
+        with self._lock:
+            count = self._pins.pop(id(file)) - 1
+            if count:
+                self._pins[id(file)] = count
+                return
+            file = self._unpinned_close.pop(id(file), None)
+        if file is not None:
+            file.close()
+
+    def manager(self, opener, *args, mode='r', kwargs=None):
+        """A file manager of ``opener(*args, mode=mode, **kwargs)`` keeping
+        its file in this pool"""
+        return _pooled_manager(self, opener, args, mode, kwargs)
+
+    def __reduce__(self):
+        return FileHandlePool.shared, (self.name, self.max_open)
+
+    def __repr__(self):
+        return '<FileHandlePool: %d/%d open, %d opens, %d reopens>' % (
+            len(self), self.max_open, self.opens, self.reopens)
+
+
+def _pooled_manager(pool, opener, args, mode='r', kwargs=None,
+                    manager_id=None):
+    from xarray.backends import CachingFileManager
+
+    # the same id for the same file, so that copies share its handle
+    manager_id = manager_id or (pool.name, ) + tuple(map(str, args))
+
+    class PooledFileManager(CachingFileManager):
+        # the pool's lock is taken before the manager's, so that evicting
+        # cannot close a file between its acquiring and its pinning
+        def acquire(self, needs_lock=True):
+            with pool._lock:
+                return super().acquire(needs_lock)
 
-from intake_xarray.base import IntakeXarraySourceAdapter
+        @contextlib.contextmanager
+        def acquire_context(self, needs_lock=True):
+            with pool._lock:
+                file = self.acquire(needs_lock)
+                pool._pin(file)
+            try:
+                yield file
+            finally:
+                pool._unpin(file)
+
+        def close(self, needs_lock=True):
+            with pool._lock:
+                super().close(needs_lock)
+
+        # unpickled with the pool of the same name, not the global cache
+        def __reduce__(self):
+            return _pooled_manager, (pool, opener, args, mode, kwargs,
+                                     manager_id)
+
+    return PooledFileManager(opener, *args, mode=mode, kwargs=kwargs,
+                             cache=pool, manager_id=manager_id)
+
+
+def _pooled_store(pool, path, engine='scipy', group=None, mmap=None):
+    """xarray data store of the local file ``path``, open in ``pool``"""
+    from xarray.backends import (H5NetCDFStore, NetCDF4DataStore,
+                                 ScipyDataStore)
+
+    if engine == 'netcdf4':
+        import netCDF4
+
+        return NetCDF4DataStore(pool.manager(netCDF4.Dataset, path),
+                                group=group, mode='r')
+    if engine == 'h5netcdf':
+        import h5netcdf
+
+        return H5NetCDFStore(pool.manager(h5netcdf.File, path), group=group,
+                             mode='r')
+    if engine == 'scipy':
+        from xarray.backends.scipy_ import _open_scipy_netcdf
+
+        store = ScipyDataStore(path, group=group)
+        store._manager = pool.manager(_open_scipy_netcdf, path,
+                                      kwargs=dict(mmap=mmap, version=2))
+        return store
+    raise ValueError('max_open_files does not support engine %r' % engine)
+
+
+class PooledDatasetReader(readers.XArrayDatasetReader):
+    """``XArrayDatasetReader`` opening local files through a
+    ``FileHandlePool``, given as ``handle_pool``"""
+
+    def _read(self, data, handle_pool=None, open_local=False, **kw):
+        fs, paths = _expand_paths(data.url, data.storage_options)
+        if handle_pool is None or not isinstance(fs, LocalFileSystem):
+            return super()._read(data, open_local=open_local, **kw)
+        import xarray as xr
+
+        engine = kw.pop('engine', 'scipy')
+        group = kw.pop('group', None)
+        mmap = kw.pop('mmap', None)
+        stores = [_pooled_store(handle_pool, path, engine, group, mmap)
+                  for path in paths]
+        if len(stores) == 1 and 'concat_dim' not in kw:
+            return xr.open_dataset(stores[0], **kw)
+        return xr.open_mfdataset(stores, **kw)
+
+
+class PooledPatternReader(readers.XArrayPatternReader, PooledDatasetReader):
+    """``XArrayPatternReader`` opening local files through a
+    ``FileHandlePool``, given as ``handle_pool``"""
 
 
 class NetCDFSource(IntakeXarraySourceAdapter):
@@ -19,7 +232,11 @@ class NetCDFSource(IntakeXarraySourceAdapter):
     chunks : int or dict, optional
         Chunks is used to load the new dataset into dask
         arrays. ``chunks={}`` loads the dataset with dask using a single
-        chunk for all arrays.
+        chunk for all arrays. ``chunks='auto-aligned'`` sizes chunks as
+        dask's ``'auto'`` does, rounded to whole multiples of the files'
+        chunking (``encoding['chunksizes']``), so that each stored chunk is
+        decompressed by one task only; other ``chunks`` that split stored
+        chunks give a warning.
     combine : ({'by_coords', 'nested'}, optional)
         Which function is used to concatenate all the files when urlpath
         has a wildcard. It is recommended to set this argument in all
@@ -40,17 +257,200 @@ class NetCDFSource(IntakeXarraySourceAdapter):
     storage_options: dict
         If using a remote fs (whether caching locally or not), these are
         the kwargs to pass to that FS.
+    max_open_files: int, optional
+        Keep at most this many of the (local) files open, in a
+        ``FileHandlePool`` of this source, ``handle_pool``, rather than in
+        xarray's global file cache; least recently read files are closed
+        first and reopened when read again, as counted by the pool. Needs
+        engine ``scipy`` (the default), ``netcdf4`` or ``h5netcdf``.
+    mmap: bool, optional
+        Memory-map the files, which must be uncompressed NetCDF3 (classic or
+        64-bit offset) and local, or cached locally by fsspec. Variables are
+        then views of the mapped file, record variables strided ones, and
+        indexing reads only the pages of the selected values, which alone
+        get copied and byteswapped to native order, rather than the whole
+        file being read through a buffered file object.
+    grib_index_path: str, optional
+        Location of a JSON file holding the ``grib_index()`` of every GRIB
+        file, e.g. ``{{ CATALOG_DIR }}/grib_index.json``. It is written on
+        first use, and afterwards only files added or changed since are
+        scanned. It is brought up to date whenever the source is read or
+        opened with ``to_dask()``, so that the files must then be GRIB.
+        Without it, the index of each file is kept in a local cache
+        directory, and only made by ``grib_index()``.
     """
     name = 'netcdf'
 
     def __init__(self, urlpath,
                  xarray_kwargs=None, metadata=None,
-                 path_as_pattern=True, storage_options=None, **kwargs):
+                 path_as_pattern=True, storage_options=None,
+                 max_open_files=None, mmap=False, grib_index_path=None,
+                 **kwargs):
         data = readers.datatypes.NetCDF3(urlpath, storage_options=storage_options,
                                       metadata=metadata)
+        if mmap:
+            xarray_kwargs = dict(xarray_kwargs or {})
+            engine = xarray_kwargs.pop('engine', None) or \
+                kwargs.pop('engine', None) or 'scipy'
+            if engine != 'scipy':
+                raise ValueError("mmap needs engine 'scipy', not %r" % engine)
+            # paths rather than file objects, which scipy reads eagerly
+            kwargs.update(engine='scipy', mmap=True, open_local=True)
+        self.grib_index_path = grib_index_path
+        self.handle_pool = None
+        if max_open_files is not None:
+            self.handle_pool = FileHandlePool(max_open_files)
+            kwargs['handle_pool'] = self.handle_pool
         if (path_as_pattern is True and "{" in urlpath) or isinstance(path_as_pattern, str):
-            reader = readers.XArrayPatternReader(data, **(xarray_kwargs or {}), metadata=metadata,
-                                                 pattern=path_as_pattern, **kwargs)
+            reader_cls = PooledPatternReader if self.handle_pool is not None else readers.XArrayPatternReader
+            reader = reader_cls(data, **(xarray_kwargs or {}), metadata=metadata,
+                                pattern=path_as_pattern, **kwargs)
         else:
-            reader = readers.XArrayDatasetReader(data, **(xarray_kwargs or {}), metadata=metadata, **kwargs)
+            reader_cls = PooledDatasetReader if self.handle_pool is not None else readers.XArrayDatasetReader
+            reader = reader_cls(data, **(xarray_kwargs or {}), metadata=metadata, **kwargs)
         self.reader = reader
+        self._listing = None
+
+    def _opening(self):
+        # indexed as the source opens, rather than on the first selection
+        if self.grib_index_path is not None:
+            self.grib_index()
+
+    def _list_paths(self):
+        data = self.reader.kwargs['args'][0]
+        url = pattern_to_glob(data.url) if isinstance(data.url, str) \
+            else list(data.url)
+        return _expand_paths(url, data.storage_options)
+
+    def refresh(self):
+        """The lazy dataset, extended by any files added since last called
+
+        The first call opens all the files, as ``to_dask()``. Later calls list
+        the files again and open only those not seen before, concatenating
+        them to the dataset already built along the concatenation dimension:
+        ``concat_dim``, else the (first) field of a path pattern, else the
+        dimension whose coordinate the new files extend. If files were
+        removed, or no such dimension is found, all files are reopened.
+        """
+        fs, paths = self._list_paths()
+        if self._listing is not None and set(self._listing[0]) <= set(paths):
+            known, ds = self._listing
+            new = [p for p in paths if p not in known]
+            if new:
+                ds = self._extend(ds, [fs.unstrip_protocol(p) for p in new])
+            if ds is not None:
+                self._listing = paths, ds
+                return ds
+        ds = self.to_dask()
+        self._listing = paths, ds
+        return ds
+
+    def grib_index(self):
+        """Index of the messages of the source's GRIB files, as a DataFrame
+
+        With a row per field: the ``url`` and the ``offset`` and ``length``
+        of its message, ``parameter`` as ``'discipline.category.number'``
+        (so ``'0.1.8'`` for total precipitation), ``level_type`` and
+        ``level`` of the first fixed surface, and ``reference_time`` and
+        ``valid_time``. Scanning reads only the section headers of each
+        message; the result is kept as JSON, at ``grib_index_path`` or in a
+        local cache, and read from there by later calls, until the file
+        changes.
+        """
+        import pandas as pd
+        from intake_xarray.grib import message_indexes
+
+        fs, paths = self._list_paths()
+        data = self.reader.kwargs['args'][0]
+        indexes = message_indexes(fs, paths, self.grib_index_path,
+                                  data.storage_options)
+        rows = [dict(url=fs.unstrip_protocol(path), **entry)
+                for path, entries in zip(paths, indexes)
+                for entry in entries]
+        index = pd.DataFrame(rows)
+        for column in ('reference_time', 'valid_time'):
+            if column in index:
+                index[column] = pd.to_datetime(index[column])
+        return index
+
+    def select_messages(self, **criteria):
+        """Source of only the GRIB messages matching ``criteria``
+
+        Each criterion names a column of ``grib_index()`` and gives a value,
+        a list of values or an inclusive slice, as in
+        ``select_messages(parameter='0.1.8', valid_time=slice(start, end))``.
+        The matching messages are fetched with range reads and written
+        together to a local GRIB file, reused by later identical
+        selections, which is opened with this source's engine and options.
+        """
+        import os
+        from dask.base import tokenize
+        from intake_xarray.grib import CACHE_DIR, extract_messages, select
+
+        rows = select(self.grib_index(), **criteria)
+        if not len(rows):
+            raise ValueError('No GRIB messages match %r' % (criteria, ))
+        fs, _ = self._list_paths()
+        target = os.path.join(CACHE_DIR, tokenize(
+            rows[['url', 'offset', 'length']].values.tolist()) + '.grib2')
+        if not os.path.exists(target):
+            extract_messages(fs, rows, target)
+        kwargs = {k: v for k, v in self.reader.kwargs.items()
+                  if k not in _COMBINE_KWARGS and
+                  k not in ('args', 'metadata', 'handle_pool')}
+        return NetCDFSource(target, xarray_kwargs=kwargs,
+                            metadata=self.reader.kwargs.get('metadata'),
+                            path_as_pattern=False)
+
+    def _extend(self, ds, urls):
+        """``ds`` concatenated with the datasets of the files at ``urls``, or
+        None if the dimension to concatenate along is not known"""
+        import xarray as xr
+        from intake.source.utils import reverse_formats
+
+        data = self.reader.kwargs['args'][0]
+        kwargs = {k: v for k, v in self.reader.kwargs.items()
+                  if k not in _COMBINE_KWARGS and k != 'args'}
+        kwargs.setdefault('chunks', {})
+        preprocess = self.reader.kwargs.get('preprocess')
+        dim = self.reader.kwargs.get('concat_dim')
+        names = [dim] if isinstance(dim, str) else list(dim or [])
+        fields = {}
+        if isinstance(self.reader, readers.XArrayPatternReader):
+            pattern = self.reader.kwargs.get('pattern')
+            pattern = data.url if pattern in (None, True) else pattern
+            fields = reverse_formats(pattern, urls)
+            fields = dict(zip(names + list(fields)[len(names):],
+                              fields.values()))
+            if len(fields) != 1:
+                # new files may extend any of several dimensions
+                return None
+            names = list(fields)
+
+        added = []
+        for url in urls:
+            new_data = type(data)(url=url, storage_options=data.storage_options,
+                                  metadata=data.metadata)
+            one = PooledDatasetReader(new_data, **kwargs).read()
+            added.append(preprocess(one) if preprocess else one)
+        if names:
+            dim = names[0]
+        else:
+            extending = [d for d in added[0].dims if d in ds.indexes and
+                         d in added[0].indexes and
+                         not added[0].indexes[d].isin(ds.indexes[d]).all()]
+            if len(extending) != 1:
+                return None
+            dim = extending[0]
+        if dim in fields:
+            added = [one.expand_dims({dim: [value]})
+                     for one, value in zip(added, fields[dim])]
+        else:
+            added = [one if dim in one.dims else one.expand_dims(dim)
+                     for one in added]
+        out = xr.concat([ds] + added, dim, data_vars='minimal',
+                        coords='minimal', compat='override', join='override',
+                        combine_attrs='override')
+        if dim in out.indexes and not out.indexes[dim].is_monotonic_increasing:
+            out = out.sortby(dim)
+        return out
@@ -1,8 +1,1108 @@
+import collections
+import contextlib
+import functools
+import io
+import os
+import threading
+
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+
 from intake import readers
-from intake.readers.utils import pattern_to_glob
 from intake.source.utils import reverse_formats
 
-from intake_xarray.base import IntakeXarraySourceAdapter
+from intake_xarray.base import (AUTO_ALIGNED, IntakeXarraySourceAdapter,
+                                 _expand_paths, _file_infos, _info_version)
+
+
+HEADER_BYTES = 2 ** 16
+MERGE_GAP = 2 ** 18
+HANDLES_PER_THREAD = 8
+# chunks values that make chunks of whole blocks
+_ALIGNED_CHUNKS = ('auto', 'tile_aligned', AUTO_ALIGNED)
+
+
+@functools.lru_cache(maxsize=256)
+def _fetch_header(fs, path, header_bytes, version=None):
+    """First bytes of a remote file, in one request
+
+    Cached by ``version``, from ``_info_version``, so that a rewritten file
+    has its header fetched again.
+    """
+    return fs.cat_file(path, start=0, end=header_bytes)
+
+
+def _block_ranges(src, window):
+    """Byte ranges of the TIFF blocks of ``src`` that intersect ``window``
+
+    ``window`` is a pair of (y, x) slices. Returns an empty list for files
+    whose block offsets are not known, i.e., other than (Geo)TIFF.
+    """
+    import math
+    from rasterio.enums import Interleaving
+
+    rows, cols = window
+    bh, bw = src.block_shapes[0]
+    # all bands share each block of pixel-interleaved files
+    bands = [1] if src.interleaving == Interleaving.pixel else src.indexes
+    ranges = []
+    for bidx in bands:
+        for by in range(rows.start // bh, math.ceil(rows.stop / bh)):
+            for bx in range(cols.start // bw, math.ceil(cols.stop / bw)):
+                offset = src.get_tag_item('BLOCK_OFFSET_%d_%d' % (bx, by),
+                                          'TIFF', bidx=bidx)
+                size = src.get_tag_item('BLOCK_SIZE_%d_%d' % (bx, by),
+                                        'TIFF', bidx=bidx)
+                if offset is None or size is None:
+                    return []
+                if int(size):
+                    ranges.append((int(offset), int(offset) + int(size)))
+    return ranges
+
+
+class _PrefetchedFile(io.RawIOBase):
+    """Read-only file serving reads from prefetched byte ranges
+
+    ``parts`` maps (start, end) to bytes, and may be added to between
+    reads; reads not entirely within one of them go to the underlying file
+    ``f``.
+    """
+
+    def __init__(self, f, parts):
+        self.f = f
+        self.parts = parts
+        self.size = f.size
+        self.loc = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, loc, whence=0):
+        if whence == 1:
+            loc += self.loc
+        elif whence == 2:
+            loc += self.size
+        self.loc = loc
+        return loc
+
+    def tell(self):
+        return self.loc
+
+    def readinto(self, b):
+        start = self.loc
+        end = min(start + len(b), self.size)
+        if end <= start:
+            return 0
+        for (p0, p1), data in self.parts.items():
+            if p0 <= start and end <= p1:
+                out = data[start - p0:end - p0]
+                break
+        else:
+            self.f.seek(start)
+            out = self.f.read(end - start)
+        b[:len(out)] = out
+        self.loc = start + len(out)
+        return len(out)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+_local = threading.local()
+
+
+def _handle_pool():
+    """This thread's pooled datasets, least recently used first"""
+    if not hasattr(_local, 'handles'):
+        _local.handles = collections.OrderedDict()
+    return _local.handles
+
+
+def _prefetch(fs, path, src, window, parts, merge_gap=MERGE_GAP):
+    """Add to ``parts`` the blocks of ``src`` that ``window`` needs, fetched
+    in as few requests as possible"""
+    from fsspec.utils import merge_offset_ranges
+
+    ranges = _block_ranges(src, window)
+    if ranges:
+        starts, ends = zip(*ranges)
+        paths, starts, ends = merge_offset_ranges(
+            [path] * len(ranges), list(starts), list(ends), max_gap=merge_gap)
+        data = fs.cat_ranges(paths, starts, ends)
+        parts.update({(s, s + len(d)): d for s, d in zip(starts, data)})
+
+
+@contextlib.contextmanager
+def _open_dataset(fs, path, window=None, header_bytes=None,
+                  merge_gap=MERGE_GAP, handles=0, env=None, infos=None,
+                  **kwargs):
+    """Open a rasterio dataset, through fsspec if the file is not local
+
+    For remote files, the header is fetched in one request of
+    ``header_bytes``, and if a ``window`` (pair of (y, x) slices) is given,
+    the blocks it needs are fetched up front, with ranges closer than
+    ``merge_gap`` coalesced into single requests. All reads of the returned
+    dataset that fall in these ranges are then served from memory.
+
+    With ``handles``, local datasets are kept open in a pool of at most that
+    many per thread and reused by later calls from the same thread, so that
+    threads never share a GDAL handle (and need no lock), nor reopen files.
+    Remote datasets are not pooled, since rasterio only registers their
+    opener for the context they were opened in, which dask does not keep
+    between tasks. Their headers are cached by file version, and opening
+    them needs their size; both come from ``infos``, a dict of path to
+    ``fs.info``, if it has the path, and are otherwise asked of ``fs`` (one
+    request). Reopening a file whose info is given then costs no requests.
+    ``env`` holds GDAL config options, such as ``GDAL_CACHEMAX``, to apply.
+    """
+    import rasterio
+    from dask.base import tokenize
+    from fsspec.implementations.local import LocalFileSystem
+
+    env = dict(env or {})
+    local = isinstance(fs, LocalFileSystem)
+    if not local:
+        # GDAL would otherwise probe for sidecar files, one request each
+        env.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+    pool = _handle_pool() if handles and local else None
+    with rasterio.Env(**env):
+        if pool is not None:
+            # a file rewritten since it was pooled is opened afresh
+            stat = os.stat(path)
+            key = (fs, path, stat.st_mtime_ns, stat.st_size,
+                   tokenize(kwargs))
+            if key not in pool:
+                pool[key] = rasterio.open(path, **kwargs)
+                while len(pool) > handles:
+                    pool.popitem(last=False)[1].close()
+            pool.move_to_end(key)
+            yield pool[key]
+        elif local:
+            with rasterio.open(path, **kwargs) as src:
+                yield src
+        else:
+            info = (infos or {}).get(path) or fs.info(path)
+            header = _fetch_header(fs, path, header_bytes or HEADER_BYTES,
+                                   _info_version(info))
+            parts = {(0, len(header)): header}
+            # known sizes spare the filesystem asking for them again
+            size = {} if info.get('size') is None else {'size': info['size']}
+
+            def opener(path, mode='rb'):
+                return _PrefetchedFile(fs.open(path, 'rb', **size), parts)
+
+            with rasterio.open(path, opener=opener, **kwargs) as src:
+                if window is not None:
+                    _prefetch(fs, path, src, window, parts, merge_gap)
+                yield src
+
+
+def _io_options(header_bytes=None, merge_gap=MERGE_GAP, handles=0,
+                gdal_cache=None, gdal_threads=None):
+    """Keyword arguments of ``_open_dataset`` for the reads of chunk tasks"""
+    env = {}
+    if gdal_cache is not None:
+        env['GDAL_CACHEMAX'] = gdal_cache
+    if gdal_threads is not None:
+        env['GDAL_NUM_THREADS'] = str(gdal_threads)
+    return dict(header_bytes=header_bytes, merge_gap=merge_gap,
+                handles=handles, env=env)
+
+
+def _with_infos(fs, paths, io_options):
+    """``io_options`` with the ``fs.info`` of ``paths`` if they are remote,
+    gathered once when the source is read rather than by every task"""
+    if isinstance(fs, LocalFileSystem):
+        return io_options
+    return dict(io_options, infos=_file_infos(fs, paths))
+
+
+def _for_paths(io_options, paths):
+    """``io_options`` for the tasks reading ``paths``, keeping only their
+    infos so that each task does not carry those of every file"""
+    infos = (io_options or {}).get('infos')
+    if not infos:
+        return io_options
+    return dict(io_options, infos={p: infos[p] for p in paths if p in infos})
+
+
+def _tile_aligned_chunks(src, target_bytes):
+    """Chunks for a rasterio dataset that are whole multiples of its blocks
+
+    Pixel-interleaved files store all bands in each block, so all bands go
+    in one chunk; band-interleaved files get a chunk per band. Along y and x,
+    chunks are grown as evenly as possible, in whole blocks, up to
+    ``target_bytes``.
+    """
+    import math
+    import numpy as np
+    from rasterio.enums import Interleaving
+
+    bh, bw = src.block_shapes[0]
+    nbands = src.count if src.interleaving == Interleaving.pixel else 1
+    itemsize = max(np.dtype(dt).itemsize for dt in src.dtypes)
+    budget = max(target_bytes // (nbands * bh * bw * itemsize), 1)
+    ny = math.ceil(src.height / bh)
+    nx = math.ceil(src.width / bw)
+    my = min(max(math.isqrt(budget), 1), ny)
+    mx = min(max(budget // my, 1), nx)
+    my = min(max(budget // mx, 1), ny)
+    return {'band': nbands, 'y': min(my * bh, src.height),
+            'x': min(mx * bw, src.width)}
+
+
+def _overview_level(src, target_resolution):
+    """Coarsest overview level of ``src`` at least as fine as the target
+
+    Returns None if only full resolution (level 0, the data itself) is
+    fine enough, otherwise an index into the file's overviews, as for
+    GDAL's ``OVERVIEW_LEVEL`` open option.
+    """
+    try:
+        tx, ty = target_resolution
+    except TypeError:
+        tx = ty = target_resolution
+    xres, yres = src.res
+    level = None
+    for i, factor in enumerate(sorted(src.overviews(1))):
+        if xres * factor <= tx and yres * factor <= ty:
+            level = i
+    return level
+
+
+def _bbox_window(transform, shape, crs, bbox, bbox_crs=None):
+    """Pixel window of a raster covering ``bbox``, as (y, x) slices
+
+    ``bbox`` is ``(minx, miny, maxx, maxy)``, in ``bbox_crs`` if given,
+    otherwise in the raster's ``crs``. The window is expanded to whole
+    pixels and clipped to the raster's ``shape``, (height, width).
+    """
+    import math
+    from rasterio.crs import CRS
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import from_bounds
+
+    if bbox_crs is not None and \
+            CRS.from_user_input(bbox_crs) != CRS.from_user_input(crs):
+        bbox = transform_bounds(bbox_crs, crs, *bbox)
+    height, width = shape
+    window = from_bounds(*bbox, transform=transform)
+    # round to limit floating point error before expanding to whole pixels
+    row0 = max(math.floor(round(window.row_off, 6)), 0)
+    col0 = max(math.floor(round(window.col_off, 6)), 0)
+    row1 = min(math.ceil(round(window.row_off + window.height, 6)), height)
+    col1 = min(math.ceil(round(window.col_off + window.width, 6)), width)
+    if row1 <= row0 or col1 <= col0:
+        raise ValueError('bbox %s does not intersect the raster' % (bbox, ))
+    return slice(row0, row1), slice(col0, col1)
+
+
+def _window_chunks(window, size):
+    """Chunks along one dimension of a window, aligned to multiples of size
+    in the coordinates of the whole raster"""
+    edges = [window.start]
+    edges += range((window.start // size + 1) * size, window.stop, size)
+    edges.append(window.stop)
+    return tuple(b - a for a, b in zip(edges[:-1], edges[1:]))
+
+
+def _select_window(ds, window):
+    ds = ds.isel(y=window[0], x=window[1])
+    for var in ds.variables.values():
+        # the stored blocks are no longer relative to the origin
+        var.encoding.pop('preferred_chunks', None)
+    return ds
+
+
+def _tile_header(fs, path, header_bytes=None, infos=None):
+    with _open_dataset(fs, path, header_bytes=header_bytes,
+                       infos=infos) as src:
+        return {'path': path, 'bounds': list(src.bounds),
+                'shape': [src.height, src.width], 'res': list(src.res),
+                'crs': src.crs.to_wkt() if src.crs else None,
+                'count': src.count, 'dtype': src.dtypes[0],
+                'nodata': src.nodata, 'attrs': _band_attrs(src)}
+
+
+def _tile_index(fs, paths, index_path=None, storage_options=None,
+                header_bytes=None, infos=None):
+    """Bounds of every tile of a mosaic, read once and optionally persisted
+
+    If ``index_path`` exists, it is loaded and only tiles not yet in it, or
+    whose file has changed since (by ``_info_version``), are opened (and
+    tiles no longer listed are dropped), after which it is rewritten if
+    anything changed. ``infos``, the ``fs.info`` of each path, is gathered
+    here if not given.
+    """
+    import json
+    from dask import compute, delayed
+
+    if infos is None:
+        infos = _file_infos(fs, paths)
+    versions = {p: list(_info_version(infos[p])) for p in paths}
+
+    index = None
+    if index_path is not None:
+        ifs, ipath = fsspec.core.url_to_fs(index_path, **(storage_options or {}))
+        if ifs.exists(ipath):
+            with ifs.open(ipath, 'r') as f:
+                index = json.load(f)
+    common = {k: (index or {}).get(k)
+              for k in ('crs', 'res', 'count', 'dtype', 'nodata', 'attrs')}
+    known = {t['path']: dict(common, **t)
+             for t in (index or {}).get('tiles', [])}
+    new = [p for p in paths
+           if known.get(p, {}).get('version') != versions[p]]
+    headers = compute(*[delayed(_tile_header)(fs, p, header_bytes,
+                                              {p: infos[p]})
+                        for p in new])
+    known.update({h['path']: dict(h, version=versions[h['path']])
+                  for h in headers})
+    tiles = [known[p] for p in paths]
+
+    first = tiles[0]
+    for t in tiles:
+        if t['crs'] != first['crs'] or t['res'] != first['res'] or \
+                t['count'] != first['count']:
+            raise ValueError('All tiles of a mosaic must share their CRS, '
+                             'resolution and number of bands; %s differs'
+                             % t['path'])
+    updated = {'crs': first['crs'], 'res': first['res'],
+               'count': first['count'], 'dtype': first['dtype'],
+               'nodata': first['nodata'], 'attrs': first['attrs'],
+               'tiles': [{k: t[k] for k in ('path', 'version', 'bounds',
+                                            'shape')}
+                         for t in tiles]}
+    if index_path is not None and updated != index:
+        with ifs.open(ipath, 'w') as f:
+            json.dump(updated, f)
+    return updated
+
+
+def _read_mosaic_chunk(fs, tiles, rows, cols, count, dtype, fill,
+                       io_options=None):
+    """Composite the tiles overlapping one chunk of the mosaic grid
+
+    ``tiles`` holds ``(path, row0, col0, row1, col1)`` of each tile in grid
+    pixels; tiles later in the list take precedence where valid.
+    """
+    import numpy as np
+    from rasterio.windows import Window
+
+    out = np.full((count, rows.stop - rows.start, cols.stop - cols.start),
+                  fill, dtype=dtype)
+    for path, tr0, tc0, tr1, tc1 in tiles:
+        r0, r1 = max(rows.start, tr0), min(rows.stop, tr1)
+        c0, c1 = max(cols.start, tc0), min(cols.stop, tc1)
+        window = (slice(r0 - tr0, r1 - tr0), slice(c0 - tc0, c1 - tc0))
+        with _open_dataset(fs, path, window, **(io_options or {})) as src:
+            data = src.read(window=Window.from_slices(*window), masked=True)
+        target = out[:, r0 - rows.start:r1 - rows.start,
+                     c0 - cols.start:c1 - cols.start]
+        np.copyto(target, data.data, where=~np.ma.getmaskarray(data))
+    return out
+
+
+def _spatial_coords(transform, crs, rows, cols):
+    """Pixel-centre y and x coordinates of a window of a north-up grid, and
+    its ``spatial_ref``, as rioxarray would make them"""
+    import numpy as np
+    import xarray as xr
+    from affine import Affine
+
+    xs = transform.c + (np.arange(cols.start, cols.stop) + 0.5) * transform.a
+    ys = transform.f + (np.arange(rows.start, rows.stop) + 0.5) * transform.e
+    window_transform = transform * Affine.translation(cols.start, rows.start)
+    spatial_ref = xr.DataArray(0, attrs={
+        'crs_wkt': crs, 'spatial_ref': crs,
+        'GeoTransform': ' '.join(str(v) for v in window_transform.to_gdal())})
+    return {'y': ys, 'x': xs, 'spatial_ref': spatial_ref}
+
+
+def _band_attrs(src):
+    """Attributes of the bands of ``src`` as rioxarray reads them, before
+    decoding, but for ``_FillValue``: the file's tags, scale and offset"""
+    attrs = {}
+    for key, value in {**src.tags(), **src.tags(1)}.items():
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        attrs[key] = value
+    attrs['scale_factor'] = src.scales[0]
+    attrs['add_offset'] = src.offsets[0]
+    return attrs
+
+
+def _masked_dtype(dtype):
+    """Type of values of ``dtype`` once masked, as rioxarray makes it"""
+    import numpy as np
+
+    if dtype.kind == 'f':
+        return dtype
+    return np.dtype('float32' if dtype.itemsize <= 2 else 'float64')
+
+
+def _decoded(ds, mask_and_scale=True):
+    """``ds`` with nodata masked and values scaled, as rioxarray reads them
+    with ``mask_and_scale``: integers become floats, with NaN for nodata"""
+    import numpy as np
+
+    if not mask_and_scale:
+        return ds
+    var = ds.band_data
+    attrs = dict(var.attrs)
+    encoding = dict({'dtype': str(var.dtype)}, **var.encoding)
+    for key in ('_FillValue', 'scale_factor', 'add_offset'):
+        if key in attrs:
+            encoding[key] = attrs.pop(key)
+    dtype = _masked_dtype(var.dtype)
+    data = var.astype(dtype)
+    fill = encoding.get('_FillValue')
+    if fill is not None and not np.isnan(fill):
+        data = data.where(var != fill)
+    scale = encoding.get('scale_factor', 1.)
+    offset = encoding.get('add_offset', 0.)
+    if scale != 1 or offset != 0:
+        data = data * dtype.type(scale) + dtype.type(offset)
+    data.attrs, data.encoding = attrs, encoding
+    return ds.assign(band_data=data)
+
+
+def _mosaic(fs, index, chunks=None, bbox=None, bbox_crs=None,
+            io_options=None, mask_and_scale=True):
+    """Lazy dataset of all tiles in ``index`` on one (band, y, x) grid
+
+    Each chunk only opens the tiles that intersect it, found by mapping
+    every tile onto the chunks it overlaps when the graph is built. Values
+    are masked and scaled, with the attributes of the first tile, as
+    rioxarray would with ``mask_and_scale``.
+    """
+    import numpy as np
+    import xarray as xr
+    from affine import Affine
+    from dask.array import Array
+    from dask.base import tokenize
+    from functools import partial
+
+    xres, yres = index['res']
+    bounds = np.array([t['bounds'] for t in index['tiles']])
+    left, top = bounds[:, 0].min(), bounds[:, 3].max()
+    transform = Affine(xres, 0, left, 0, -yres, top)
+    height = int(round((top - bounds[:, 1].min()) / yres))
+    width = int(round((bounds[:, 2].max() - left) / xres))
+    # tile extents in grid pixels
+    rects = np.stack([np.round((top - bounds[:, 3]) / yres),
+                      np.round((bounds[:, 0] - left) / xres),
+                      np.round((top - bounds[:, 1]) / yres),
+                      np.round((bounds[:, 2] - left) / xres)],
+                     axis=1).astype(int)
+
+    rows, cols = slice(0, height), slice(0, width)
+    if bbox is not None:
+        rows, cols = _bbox_window(transform, (height, width), index['crs'],
+                                  bbox, bbox_crs)
+
+    chunks = chunks if isinstance(chunks, dict) else {}
+    th, tw = index['tiles'][0]['shape']
+    row_chunks = _window_chunks(rows, chunks.get('y', th))
+    col_chunks = _window_chunks(cols, chunks.get('x', tw))
+    row_edges = np.cumsum((rows.start, ) + row_chunks)
+    col_edges = np.cumsum((cols.start, ) + col_chunks)
+
+    per_chunk = {}
+    for n, (tr0, tc0, tr1, tc1) in enumerate(rects):
+        i0 = max(np.searchsorted(row_edges, tr0, 'right') - 1, 0)
+        i1 = min(np.searchsorted(row_edges, tr1, 'left'), len(row_chunks))
+        j0 = max(np.searchsorted(col_edges, tc0, 'right') - 1, 0)
+        j1 = min(np.searchsorted(col_edges, tc1, 'left'), len(col_chunks))
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                per_chunk.setdefault((i, j), []).append(
+                    (index['tiles'][n]['path'], tr0, tc0, tr1, tc1))
+
+    count, dtype = index['count'], np.dtype(index['dtype'])
+    attrs = dict(index.get('attrs') or {})
+    fill = index['nodata']
+    if fill is not None:
+        attrs['_FillValue'] = dtype.type(fill)
+    elif mask_and_scale:
+        # read as the floats decoding makes, with NaN where no tile is
+        dtype, fill = _masked_dtype(dtype), np.nan
+    else:
+        fill = np.nan if dtype.kind == 'f' else 0
+        attrs['_FillValue'] = dtype.type(fill)
+    name = 'mosaic-%s' % tokenize(index, rows, cols, row_chunks, col_chunks,
+                                  (io_options or {}).get('infos'))
+    dsk = {}
+    for i, (r0, r1) in enumerate(zip(row_edges[:-1], row_edges[1:])):
+        for j, (c0, c1) in enumerate(zip(col_edges[:-1], col_edges[1:])):
+            tiles = per_chunk.get((i, j), [])
+            read = partial(_read_mosaic_chunk, io_options=_for_paths(
+                io_options, [t[0] for t in tiles]))
+            dsk[(name, 0, i, j)] = (
+                read, fs, tiles,
+                slice(int(r0), int(r1)), slice(int(c0), int(c1)), count,
+                dtype, fill)
+    data = Array(dsk, name, ((count, ), row_chunks, col_chunks), dtype)
+
+    band_data = xr.DataArray(data, dims=('band', 'y', 'x'), attrs=attrs)
+    band_data.encoding['dtype'] = index['dtype']
+    coords = _spatial_coords(transform, index['crs'], rows, cols)
+    coords['band'] = np.arange(1, count + 1)
+    return _decoded(xr.Dataset({'band_data': band_data}, coords=coords),
+                    mask_and_scale)
+
+
+def _read_window(fs, path, bands, rows, cols, io_options=None,
+                 open_kwargs=None, leading=0):
+    """Read a (band, y, x) block of one file, bands as a 0-based slice,
+    with ``leading`` extra length-one dimensions in front"""
+    from rasterio.windows import Window
+
+    with _open_dataset(fs, path, (rows, cols), **(io_options or {}),
+                       **(open_kwargs or {})) as src:
+        data = src.read(indexes=list(range(bands.start + 1, bands.stop + 1)),
+                        window=Window.from_slices(rows, cols))
+    return data.reshape((1, ) * leading + data.shape)
+
+
+def _target_grid(src, dst_crs, dst_resolution=None):
+    """Transform, (height, width) and CRS (as WKT) of the grid covering
+    ``src`` in ``dst_crs``, at ``dst_resolution`` if given"""
+    from rasterio.crs import CRS
+    from rasterio.warp import calculate_default_transform
+
+    dst_crs = CRS.from_user_input(dst_crs)
+    transform, width, height = calculate_default_transform(
+        src.crs, dst_crs, src.width, src.height, *src.bounds,
+        resolution=dst_resolution)
+    return transform, (height, width), dst_crs.to_wkt()
+
+
+def _warp_window(fs, path, bands, rows, cols, src_grid, dst_grid, dtype,
+                 fill, resampling='nearest', io_options=None,
+                 open_kwargs=None, leading=0):
+    """Reproject the part of one file that covers a window of another grid
+
+    ``src_grid`` is the (transform, shape, crs) of the file, ``dst_grid``
+    the (transform, crs) of the output, and ``rows``, ``cols`` the window
+    of the output to make; only the source pixels under it, plus a small
+    margin for the resampling kernel, are read.
+    """
+    import numpy as np
+    from affine import Affine
+    from rasterio.enums import Resampling
+    from rasterio.warp import reproject
+    from rasterio.windows import Window
+
+    src_transform, (src_height, src_width), src_crs = src_grid
+    dst_transform, dst_crs = dst_grid
+    height, width = rows.stop - rows.start, cols.stop - cols.start
+    chunk_transform = dst_transform * Affine.translation(cols.start,
+                                                         rows.start)
+    left, top = chunk_transform * (0, 0)
+    right, bottom = chunk_transform * (width, height)
+    out = np.full((bands.stop - bands.start, height, width), fill,
+                  dtype=dtype)
+    try:
+        r, c = _bbox_window(src_transform, (src_height, src_width), src_crs,
+                            (min(left, right), min(top, bottom),
+                             max(left, right), max(top, bottom)), dst_crs)
+    except ValueError:
+        r = None
+    if r is not None:
+        # wide enough for the kernel of every resampling method
+        margin = 4
+        r = slice(max(r.start - margin, 0), min(r.stop + margin, src_height))
+        c = slice(max(c.start - margin, 0), min(c.stop + margin, src_width))
+        with _open_dataset(fs, path, (r, c), **(io_options or {}),
+                           **(open_kwargs or {})) as src:
+            window = Window.from_slices(r, c)
+            data = src.read(
+                indexes=list(range(bands.start + 1, bands.stop + 1)),
+                window=window)
+            # exact transforms, so that chunks do not depend on where the
+            # warper's approximations happen to fall
+            reproject(data, out, src_transform=src.window_transform(window),
+                      src_crs=src_crs, src_nodata=src.nodata,
+                      dst_transform=chunk_transform, dst_crs=dst_crs,
+                      dst_nodata=fill, resampling=Resampling[resampling],
+                      error_threshold=0)
+    return out.reshape((1, ) * leading + out.shape)
+
+
+def _same_grid_stack(fs, paths, fields, chunks=None, window=None,
+                     io_options=None, open_kwargs=None, grid=None,
+                     resampling='nearest', mask_and_scale=True):
+    """Lazy stack of files that all share the grid of the first one
+
+    Only the first file is opened here; the others are opened by the
+    tasks reading their chunks. ``fields`` maps the name of each stacking
+    dimension to the value of that field for each path; the paths must
+    cover every combination of values exactly once.
+
+    If ``grid``, a (transform, shape, crs) such as from ``_target_grid``,
+    is given, the output is on that grid instead, with every chunk warped
+    from the source pixels under it.
+
+    Values are masked and scaled, with the attributes of the first file, as
+    rioxarray would with ``mask_and_scale``.
+    """
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    from dask.array import Array
+    from dask.base import tokenize
+    from functools import partial
+
+    open_kwargs = open_kwargs or {}
+    with _open_dataset(fs, paths[0], **(io_options or {}),
+                       **open_kwargs) as src:
+        transform, crs = src.transform, src.crs.to_wkt() if src.crs else None
+        height, width, count = src.height, src.width, src.count
+        dtype, nodata = np.dtype(src.dtypes[0]), src.nodata
+        blocks = src.block_shapes[0]
+        attrs = _band_attrs(src)
+    src_grid = (transform, (height, width), crs)
+    if grid is not None:
+        transform, (height, width), crs = grid
+
+    if not fields and len(paths) > 1:
+        fields = {'concat_dim': list(range(len(paths)))}
+    levels = {k: pd.unique(pd.Series(v)) for k, v in fields.items()}
+    shape = tuple(len(v) for v in levels.values())
+    positions = {}
+    for n, path in enumerate(paths):
+        key = tuple(int(np.flatnonzero(levels[k] == v[n])[0])
+                    for k, v in fields.items())
+        positions[key] = path
+    if len(positions) != len(paths) or len(paths) != int(np.prod(shape)):
+        raise ValueError('With assume_same_grid, the files must cover every '
+                         'combination of %s exactly once' % list(fields))
+
+    rows, cols = window or (slice(0, height), slice(0, width))
+    chunks = chunks if isinstance(chunks, dict) else {}
+
+    def _dim_chunks(dim, extent):
+        c = chunks.get(dim, -1)
+        if c in (None, -1):
+            c = extent.stop - extent.start
+        if isinstance(c, int):
+            return _window_chunks(extent, c)
+        return tuple(c)
+
+    band_chunks = _dim_chunks('band', slice(0, count))
+    row_chunks = _dim_chunks('y', rows)
+    col_chunks = _dim_chunks('x', cols)
+    edges = [np.cumsum((w.start, ) + c) for w, c in
+             ((slice(0, count), band_chunks), (rows, row_chunks),
+              (cols, col_chunks))]
+
+    name = 'same-grid-%s' % tokenize(paths, rows, cols, band_chunks,
+                                     row_chunks, col_chunks, open_kwargs,
+                                     grid, resampling,
+                                     (io_options or {}).get('infos'))
+    if grid is None:
+        read = partial(_read_window, open_kwargs=open_kwargs,
+                       leading=len(shape))
+    else:
+        # pixels outside the source need a value
+        if nodata is None:
+            nodata = np.nan if dtype.kind == 'f' else 0
+        read = partial(_warp_window, src_grid=src_grid,
+                       dst_grid=(transform, crs), dtype=dtype, fill=nodata,
+                       resampling=resampling, open_kwargs=open_kwargs,
+                       leading=len(shape))
+    dsk = {}
+    for key, path in positions.items():
+        read_path = partial(read, io_options=_for_paths(io_options, [path]))
+        for b, (b0, b1) in enumerate(zip(edges[0][:-1], edges[0][1:])):
+            for i, (r0, r1) in enumerate(zip(edges[1][:-1], edges[1][1:])):
+                for j, (c0, c1) in enumerate(zip(edges[2][:-1],
+                                                 edges[2][1:])):
+                    dsk[(name, ) + key + (b, i, j)] = (
+                        read_path, fs, path, slice(int(b0), int(b1)),
+                        slice(int(r0), int(r1)), slice(int(c0), int(c1)))
+    data = Array(dsk, name, tuple((1, ) * n for n in shape) +
+                 (band_chunks, row_chunks, col_chunks), dtype)
+
+    dims = tuple(fields) + ('band', 'y', 'x')
+    band_data = xr.DataArray(data, dims=dims, attrs=attrs)
+    if nodata is not None:
+        band_data.attrs['_FillValue'] = dtype.type(nodata)
+    if grid is None and window is None:
+        band_data.encoding['preferred_chunks'] = dict(zip(('y', 'x'), blocks))
+    coords = _spatial_coords(transform, crs, rows, cols)
+    coords['band'] = np.arange(1, count + 1)
+    coords.update({k: np.asarray(v) for k, v in levels.items()})
+    return _decoded(xr.Dataset({'band_data': band_data}, coords=coords),
+                    mask_and_scale)
+
+
+def _moments(data):
+    """Per-band count, min, max, mean and sum of squared deviations from
+    the mean of the valid pixels of a masked (band, ...) array"""
+    import numpy as np
+
+    flat = np.ma.asarray(data, dtype='float64').reshape(data.shape[0], -1)
+    count = flat.count(axis=1).astype('float64')
+    mean = flat.mean(axis=1).filled(0)
+    return {'count': count,
+            'min': flat.min(axis=1).filled(np.inf),
+            'max': flat.max(axis=1).filled(-np.inf),
+            'mean': mean,
+            'm2': ((flat - mean[:, None]) ** 2).sum(axis=1).filled(0)}
+
+
+def _merge_moments(a, b):
+    """Combine two ``_moments``, as if computed over both sets of pixels"""
+    import numpy as np
+
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    frac = np.divide(b['count'], count, out=np.zeros_like(count),
+                     where=count > 0)
+    return {'count': count,
+            'min': np.minimum(a['min'], b['min']),
+            'max': np.maximum(a['max'], b['max']),
+            'mean': a['mean'] + delta * frac,
+            'm2': a['m2'] + b['m2'] + delta ** 2 * a['count'] * frac}
+
+
+def _stored_moments(src):
+    """``_moments`` from the STATISTICS_* tags of every band of ``src``, as
+    written by GDAL, or None if any band lacks them"""
+    import numpy as np
+
+    stats = []
+    for bidx in src.indexes:
+        tags = src.tags(bidx)
+        try:
+            stats.append([float(tags['STATISTICS_' + k]) for k in
+                          ('MINIMUM', 'MAXIMUM', 'MEAN', 'STDDEV')])
+        except KeyError:
+            return None
+        valid = float(tags.get('STATISTICS_VALID_PERCENT', 100))
+        stats[-1].append(src.width * src.height * valid / 100)
+    low, high, mean, std, count = np.array(stats).T
+    return {'count': count, 'min': low, 'max': high, 'mean': mean,
+            'm2': std ** 2 * count}
+
+
+def _histogram(data, edges):
+    """Per-band counts of the valid pixels of a masked (band, ...) array in
+    bins with the given (band, bin + 1) edges"""
+    import numpy as np
+
+    flat = np.ma.asarray(data).reshape(data.shape[0], -1)
+    return np.stack([np.histogram(band.compressed(), bins=e)[0]
+                     for band, e in zip(flat, edges)])
+
+
+def _histogram_percentiles(counts, edges, percentiles, exact_bins=False):
+    """Per-band percentiles from histograms, interpolating within the bin
+    holding each one, or taking its centre if each bin is a single value"""
+    import numpy as np
+
+    out = np.full((len(counts), len(percentiles)), np.nan)
+    for i, (c, e) in enumerate(zip(counts, edges)):
+        cum = np.cumsum(c)
+        if not cum[-1]:
+            continue
+        for j, q in enumerate(percentiles):
+            rank = q / 100 * cum[-1]
+            k = min(np.searchsorted(cum, rank), len(c) - 1)
+            if exact_bins:
+                out[i, j] = (e[k] + e[k + 1]) / 2
+            else:
+                before = cum[k - 1] if k else 0
+                frac = (rank - before) / c[k] if c[k] else 0
+                out[i, j] = e[k] + frac * (e[k + 1] - e[k])
+    return out
+
+
+def _read_stats_window(fs, path, rows, cols, edges=None, io_options=None):
+    """``_moments`` of one window of a file, or its histograms if ``edges``
+    (a list of per-band edges arrays) is given"""
+    from rasterio.windows import Window
+
+    with _open_dataset(fs, path, (rows, cols), **(io_options or {})) as src:
+        data = src.read(window=Window.from_slices(rows, cols), masked=True)
+    if edges is None:
+        return _moments(data)
+    return [_histogram(data, e) for e in edges]
+
+
+def _stats_dataset(moments, count_scale, percentiles, percentile_values,
+                   histogram=None, edges=None, method=None):
+    import numpy as np
+    import xarray as xr
+
+    nbands = len(moments['count'])
+    count = moments['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(moments['m2'] / count)
+    data = {'count': ('band', count * count_scale),
+            'min': ('band', np.where(count > 0, moments['min'], np.nan)),
+            'max': ('band', np.where(count > 0, moments['max'], np.nan)),
+            'mean': ('band', np.where(count > 0, moments['mean'], np.nan)),
+            'std': ('band', std)}
+    coords = {'band': np.arange(1, nbands + 1)}
+    if percentiles:
+        data['percentile'] = (('band', 'quantile'), percentile_values)
+        coords['quantile'] = np.asarray(percentiles, dtype='float64') / 100
+    if histogram is not None:
+        data['histogram'] = (('band', 'bin'), histogram)
+        data['bin_edges'] = (('band', 'bin_edge'), edges)
+    return xr.Dataset(data, coords=coords, attrs={'method': method})
+
+
+def _approximate_stats(fs, paths, percentiles, bins, approx_pixels,
+                       io_options=None):
+    """Statistics from stored tags if they are all that is needed, otherwise
+    from a decimated read of each file, which GDAL serves from the coarsest
+    overview with at least ``approx_pixels`` pixels"""
+    import math
+    import numpy as np
+    from functools import reduce
+    from rasterio.enums import Resampling
+
+    samples, moments, total, sampled = [], [], 0, 0
+    for path in paths:
+        with _open_dataset(fs, path, **(io_options or {})) as src:
+            total += src.width * src.height
+            stored = None if percentiles or bins else _stored_moments(src)
+            if stored is not None:
+                moments.append(stored)
+                sampled += src.width * src.height
+                continue
+            factor = 1
+            for f in sorted(src.overviews(1)):
+                if (src.height / f) * (src.width / f) >= approx_pixels:
+                    factor = f
+            shape = (src.count, math.ceil(src.height / factor),
+                     math.ceil(src.width / factor))
+            data = src.read(out_shape=shape, masked=True,
+                            resampling=Resampling.nearest)
+        samples.append(data.reshape(data.shape[0], -1))
+        moments.append(_moments(data))
+        sampled += shape[1] * shape[2]
+    merged = reduce(_merge_moments, moments)
+    method = 'overview' if samples else 'stored'
+    if not samples:
+        return _stats_dataset(merged, 1, percentiles, None, method=method)
+
+    sample = np.ma.concatenate(samples, axis=1)
+    values = [np.ma.compressed(band) for band in sample]
+    percentile_values = np.array(
+        [np.percentile(v, percentiles) if v.size else
+         np.full(len(percentiles), np.nan) for v in values]) \
+        if percentiles else None
+    histogram = edges = None
+    if bins:
+        edges = np.stack([np.histogram_bin_edges(v, bins=bins)
+                          for v in values])
+        histogram = _histogram(sample, edges) * (total / sampled)
+    return _stats_dataset(merged, total / sampled, percentiles,
+                          percentile_values, histogram, edges, method)
+
+
+def _exact_stats(fs, paths, percentiles, bins, target_bytes,
+                 io_options=None):
+    """Statistics over every pixel, read one tile-aligned window at a time
+    in parallel tasks whose results are merged; memory is bounded by the
+    window size and the number of bins"""
+    import numpy as np
+    from functools import reduce
+    from dask import compute, delayed
+
+    windows = []
+    for path in paths:
+        with _open_dataset(fs, path, **(io_options or {})) as src:
+            chunks = _tile_aligned_chunks(src, target_bytes)
+            dtype = np.dtype(src.dtypes[0])
+            for r0 in range(0, src.height, chunks['y']):
+                for c0 in range(0, src.width, chunks['x']):
+                    windows.append((
+                        path, slice(r0, min(r0 + chunks['y'], src.height)),
+                        slice(c0, min(c0 + chunks['x'], src.width))))
+    read = delayed(_read_stats_window, pure=True)
+    merged = reduce(_merge_moments, compute(*[
+        read(fs, *w, io_options=_for_paths(io_options, w[:1]))
+        for w in windows]))
+    if not percentiles and not bins:
+        return _stats_dataset(merged, 1, percentiles, None, method='exact')
+
+    # second pass, with bins spanning the now known range; integers with
+    # few enough values get a bin each, making their percentiles exact
+    low = np.where(np.isfinite(merged['min']), merged['min'], 0)
+    high = np.where(np.isfinite(merged['max']), merged['max'], 0)
+    exact_bins = dtype.kind in 'iub' and high.max() - low.min() < 2 ** 16
+    if exact_bins:
+        # over the range of all bands, for their histograms to be stacked
+        fine = [np.arange(low.min() - 0.5, high.max() + 1.5)] * len(low)
+    else:
+        fine = [np.linspace(lo, hi, 2 ** 12 + 1) for lo, hi in zip(low, high)]
+    edges = [fine]
+    if bins:
+        edges.append(np.stack([np.linspace(lo, hi, bins + 1)
+                               for lo, hi in zip(low, high)]))
+    parts = compute(*[read(fs, *w, edges=edges,
+                           io_options=_for_paths(io_options, w[:1]))
+                      for w in windows])
+    counts = [sum(p[i] for p in parts) for i in range(len(edges))]
+    percentile_values = _histogram_percentiles(
+        counts[0], fine, percentiles, exact_bins) if percentiles else None
+    return _stats_dataset(merged, 1, percentiles, percentile_values,
+                          counts[1] if bins else None,
+                          edges[1] if bins else None, 'exact')
+
+
+class RasterIOReader(readers.BaseReader):
+    """Open rasters into an xarray Dataset via rioxarray's xarray backend
+
+    Parameters are as for ``RasterIOSource``; ``data`` is a
+    ``readers.datatypes.TIFF`` instance.
+    """
+    output_instance = "xarray:Dataset"
+    imports = {"rioxarray"}
+    implements = {readers.datatypes.TIFF}
+
+    def _read(self, data, chunks=None, path_as_pattern=True,
+              xarray_kwargs=None, chunk_target_bytes=None,
+              overview_level=None, target_resolution=None,
+              bbox=None, bbox_crs=None, mosaic=False, mosaic_index=None,
+              header_bytes=None, merge_gap=MERGE_GAP,
+              assume_same_grid=False, dst_crs=None, dst_resolution=None,
+              resampling='nearest', handles_per_thread=None, gdal_cache=None,
+              gdal_threads=None, **kwargs):
+        from functools import partial
+
+        urlpath = data.url
+        if not (mosaic or assume_same_grid or dst_crs is not None):
+            # rioxarray makes these reads, with its own handles and GDAL
+            # settings, so the options would be silently ignored
+            unsupported = [k for k, v in (
+                ('handles_per_thread', handles_per_thread),
+                ('gdal_cache', gdal_cache), ('gdal_threads', gdal_threads))
+                if v is not None]
+            if unsupported:
+                raise ValueError(
+                    '%s only apply with mosaic, assume_same_grid or dst_crs'
+                    % ', '.join(unsupported))
+        if handles_per_thread is None:
+            handles_per_thread = HANDLES_PER_THREAD
+        io_options = _io_options(header_bytes, merge_gap,
+                                 handles_per_thread, gdal_cache,
+                                 gdal_threads)
+        if mosaic and dst_crs is not None:
+            raise ValueError('dst_crs is not supported with mosaic=True')
+        if mosaic:
+            fs, paths = _expand_paths(urlpath, data.storage_options)
+            io_options = _with_infos(fs, paths, io_options)
+            index = _tile_index(fs, paths, mosaic_index, data.storage_options,
+                                header_bytes, io_options.get('infos'))
+            ds = _mosaic(fs, index, chunks, bbox, bbox_crs, io_options,
+                         dict(xarray_kwargs or {}, **kwargs).get(
+                             'mask_and_scale', True))
+            return ds.load() if chunks is None else ds
+        kwargs = dict(xarray_kwargs or {}, **kwargs)
+        needs_src = (target_resolution is not None and overview_level is None) \
+            or bbox is not None or chunks in _ALIGNED_CHUNKS \
+            or assume_same_grid or dst_crs is not None
+        if needs_src:
+            fs, paths = _expand_paths(urlpath, data.storage_options)
+            io_options = _with_infos(fs, paths, io_options)
+            infos = io_options.get('infos')
+        if dst_crs is not None and len(paths) > 1 and not assume_same_grid:
+            raise ValueError('Reprojecting several files needs '
+                             'assume_same_grid=True')
+        if target_resolution is not None and overview_level is None:
+            with _open_dataset(fs, paths[0], infos=infos) as src:
+                overview_level = _overview_level(src, target_resolution)
+        open_kwargs = dict(kwargs.pop('open_kwargs', None) or {})
+        if overview_level is not None:
+            open_kwargs['overview_level'] = overview_level
+        if open_kwargs:
+            kwargs['open_kwargs'] = open_kwargs
+
+        window = grid = None
+        if bbox is not None or chunks in _ALIGNED_CHUNKS \
+                or dst_crs is not None:
+            with _open_dataset(fs, paths[0], infos=infos,
+                               **open_kwargs) as src:
+                if dst_crs is not None:
+                    grid = _target_grid(src, dst_crs, dst_resolution)
+                if bbox is not None:
+                    window = _bbox_window(
+                        *(grid or (src.transform, src.shape, src.crs)),
+                        bbox, bbox_crs)
+                if chunks in _ALIGNED_CHUNKS:
+                    from dask.utils import parse_bytes
+                    import dask
+
+                    target = parse_bytes(chunk_target_bytes or
+                                         dask.config.get('array.chunk-size'))
+                    chunks = _tile_aligned_chunks(src, target)
+                    if window is not None and len(paths) == 1 \
+                            and grid is None:
+                        chunks.update(y=_window_chunks(window[0], chunks['y']),
+                                      x=_window_chunks(window[1], chunks['x']))
+
+        if assume_same_grid or grid is not None:
+            pattern = urlpath
+            if isinstance(urlpath, str) and isinstance(fs, LocalFileSystem):
+                # as the paths, which _expand_paths normalises
+                pattern = os.path.normpath(fs._strip_protocol(urlpath))
+            fields = self._fields(pattern, paths, path_as_pattern,
+                                  kwargs.pop('concat_dim', None))
+            ds = _same_grid_stack(fs, paths, fields, chunks, window,
+                                  io_options, open_kwargs, grid, resampling,
+                                  kwargs.get('mask_and_scale', True))
+            return ds.load() if chunks is None else ds
+        if window is not None and len(paths) == 1:
+            # open lazily and select the window before making dask arrays,
+            # so that the graph only covers the window
+            ds = self._reader(data, path_as_pattern, **kwargs).read()
+            ds = _select_window(ds, window)
+            return ds if chunks is None else ds.chunk(chunks)
+        if window is not None:
+            # applied to each file before combining
+            kwargs['preprocess'] = partial(_select_window, window=window)
+        if chunks is not None:
+            kwargs['chunks'] = chunks
+        return self._reader(data, path_as_pattern, **kwargs).read()
+
+    @staticmethod
+    def _fields(urlpath, paths, path_as_pattern, concat_dim=None):
+        """Values of the pattern fields for each path, as the pattern reader
+        would find them, renamed after ``concat_dim`` if given"""
+        if isinstance(path_as_pattern, str):
+            fields = reverse_formats(path_as_pattern, paths)
+        elif path_as_pattern is True and isinstance(urlpath, str) \
+                and "{" in urlpath:
+            fields = reverse_formats(urlpath, paths)
+        else:
+            fields = {}
+        if concat_dim is not None:
+            concat_dim = [concat_dim] if isinstance(concat_dim, str) \
+                else concat_dim
+            fields = dict(zip(concat_dim, fields.values()))
+        return fields
+
+    def _reader(self, data, path_as_pattern, **kwargs):
+        urlpath = data.url
+        if (path_as_pattern is True and "{" in urlpath) or isinstance(path_as_pattern, str):
+            return readers.XArrayPatternReader(data, metadata=self.metadata, engine="rasterio",
+                                               pattern=path_as_pattern, **kwargs)
+        return readers.XArrayDatasetReader(data, metadata=self.metadata, engine="rasterio", **kwargs)
 
 
 class RasterIOSource(IntakeXarraySourceAdapter):
@@ -28,25 +1128,173 @@ class RasterIOSource(IntakeXarraySourceAdapter):
             - ``s3://data/landsat8_band{band}.tif``
             - ``s3://data/{location}/landsat8_band{band}.tif``
             - ``{{ CATALOG_DIR }}data/landsat8_{start_date:%Y%m%d}_band{band}.tif``
-    chunks: None or int or dict, optional
+    chunks: None or int or dict or str, optional
         Chunks is used to load the new dataset into dask
         arrays. ``chunks={}`` loads the dataset with dask using a single
         chunk for all arrays. default `None` loads numpy arrays.
+        With ``'auto'``, ``'tile_aligned'`` or ``'auto-aligned'``, the
+        block (tile or strip) shape of the (first) file is read and chunks
+        are made of whole blocks, up to ``chunk_target_bytes`` each, so
+        that no block is decoded by more than one task.
+    chunk_target_bytes: int or str, optional
+        Maximum size of a chunk for ``chunks='auto'``, such as ``"64MiB"``.
+        Defaults to dask's ``array.chunk-size`` config.
     path_as_pattern: bool or str, optional
         Whether to treat the path as a pattern (ie. ``data_{field}.tif``)
         and create new coodinates in the output corresponding to pattern
         fields. If str, is treated as pattern to match on. Default is True.
+    overview_level: int, optional
+        Read from this internal overview (pyramid level) of the files
+        instead of the full resolution data, where 0 is the first (finest)
+        overview. Coordinates are those of the overview's grid.
+    target_resolution: float or (float, float), optional
+        Pick the coarsest overview whose pixel size is no larger than this,
+        in the units of the file's CRS, as ``(xres, yres)`` or one value for
+        both. The full resolution data is read if no overview qualifies.
+        Ignored if ``overview_level`` is given.
+    bbox: (minx, miny, maxx, maxy), optional
+        Only read the pixels within these bounds. The bounds are turned into
+        a pixel window of the (first) file before any array is built, and
+        the same window is applied to every file of a glob or pattern, so
+        only the intersecting blocks are ever fetched.
+    bbox_crs: str or CRS, optional
+        CRS of ``bbox``, e.g. ``"EPSG:4326"``, if not that of the files.
+    mosaic: bool, optional
+        Instead of stacking the files, treat them as adjacent (or
+        overlapping) tiles of one seamless mosaic, on a single (band, y, x)
+        grid spanning all of them. The tiles must share their CRS,
+        resolution and bands. Each chunk (by default, the size of a tile)
+        only opens the tiles that intersect it, and with ``bbox`` only the
+        chunks, and so the tiles, within the bounds are read. Where tiles
+        overlap, valid pixels of later files win. Values are masked and
+        scaled as for ``assume_same_grid``.
+    mosaic_index: str, optional
+        Location of a JSON file holding the bounds of every tile, e.g.
+        ``{{ CATALOG_DIR }}/tiles.json``. It is written on first use, and
+        afterwards only files not already in it, or changed since (by size,
+        ETag or modification time), are opened. Without it, the header of
+        every tile is read on each open.
+    header_bytes: int, optional
+        For remote files, the size of the first request, which should hold
+        the whole TIFF header (IFDs and tile offsets), so that opening a
+        file costs one request; default 64kiB. Within the tasks of
+        ``mosaic``, ``assume_same_grid`` and ``dst_crs`` modes, each read
+        then fetches the tiles it needs up front, with nearby byte ranges
+        coalesced into few requests. Headers are cached by file version
+        (size, ETag, modification time), which, with the size that opening
+        a file needs, is gathered for all files once when the source is
+        read, listing each directory rather than asking for every file, so
+        that tasks make no request for either. This
+        applies only to the files these modes read, and to the first file
+        read for ``chunks='auto'``, ``bbox`` or ``target_resolution``;
+        otherwise, files are opened and read by rioxarray through fsspec
+        file objects, which this does not change.
+    merge_gap: int, optional
+        Byte ranges of tiles closer than this are fetched in one request;
+        default 256kiB. As for ``header_bytes``, only in the reads of the
+        ``mosaic``, ``assume_same_grid`` and ``dst_crs`` modes.
+    assume_same_grid: bool, optional
+        For a pattern (or list) of files that all share one grid, read the
+        transform, CRS and shape of the first file only and build the
+        coordinates from those; the other files are only opened by the
+        tasks that read their chunks, so opening does not get slower as
+        the stack grows. The pattern fields become leading dimensions, and
+        the files must cover every combination of their values. Values are
+        masked and scaled as rioxarray would, unless ``xarray_kwargs`` has
+        ``mask_and_scale=False``, with the attributes of the first file.
+    dst_crs: str or CRS, optional
+        Reproject on the fly to this CRS, e.g. ``"EPSG:4326"``. The output
+        grid covers the source and is known without reading any pixels;
+        each chunk then reads only the source window under it and warps
+        it on its own, so reprojection streams and runs in parallel.
+        ``bbox`` is then taken in ``dst_crs`` unless ``bbox_crs`` is given.
+        Several files need ``assume_same_grid``.
+    dst_resolution: float or (float, float), optional
+        Pixel size of the reprojected grid, in units of ``dst_crs``;
+        by default, about that of the source.
+    resampling: str, optional
+        Name of a ``rasterio.enums.Resampling`` method for reprojecting,
+        default ``"nearest"``.
+    handles_per_thread: int, optional
+        The chunk tasks of ``mosaic``, ``assume_same_grid`` (which may also
+        be used for a single file) and ``dst_crs`` keep up to this many
+        files open in each thread, least recently used closed first, so
+        that threads decode in parallel without sharing, or waiting for,
+        a GDAL handle; default 8, and 0 opens files for every task. A file
+        modified since it was opened is opened again. This applies to
+        local files; remote ones are reopened by each task, from their
+        cached header, at no request. Reads made by rioxarray instead share
+        one handle per file behind its ``lock`` (an ``xarray_kwargs``
+        option), so reading without any of these modes raises ValueError
+        if this, ``gdal_cache`` or ``gdal_threads`` is given; ``stats``
+        uses all three.
+    gdal_cache: int, optional
+        GDAL's block cache size for those reads (``GDAL_CACHEMAX``), in MB
+        if below 100000, otherwise in bytes.
+    gdal_threads: int or str, optional
+        Threads GDAL may use to decode each read (``GDAL_NUM_THREADS``),
+        such as ``4`` or ``"ALL_CPUS"``.
     """
     name = 'rasterio'
     container = "xarray"
+    aligns_chunks = True
 
     def __init__(self, urlpath,
                  xarray_kwargs=None, metadata=None, path_as_pattern=True,
                  storage_options=None, **kwargs):
         data = readers.datatypes.TIFF(urlpath, storage_options=storage_options)
-        if (path_as_pattern is True and "{" in urlpath) or isinstance(path_as_pattern, str):
-            reader = readers.XArrayPatternReader(data, **(xarray_kwargs or {}), metadata=metadata, engine="rasterio",
-                                                 pattern=path_as_pattern, **kwargs)
-        else:
-            reader = readers.XArrayDatasetReader(data, **(xarray_kwargs or {}), metadata=metadata, engine="rasterio", **kwargs)
-        self.reader = reader
+        self.reader = RasterIOReader(data, xarray_kwargs=xarray_kwargs, metadata=metadata,
+                                     path_as_pattern=path_as_pattern, **kwargs)
+
+    def stats(self, exact=False, percentiles=(2, 98), bins=None,
+              approx_pixels=2 ** 18):
+        """Per-band statistics over all the files of this source
+
+        Parameters
+        ----------
+        exact: bool
+            If False (default), statistics are taken from the STATISTICS_*
+            tags stored in the files when they have them and neither
+            ``percentiles`` nor ``bins`` are asked for, or else estimated
+            from the coarsest overview with at least ``approx_pixels``
+            pixels. If True, every pixel is read, chunk by chunk in
+            parallel, with bounded memory; percentiles then come from a
+            fine histogram, and are exact for integer data.
+        percentiles: list of float
+            Percentiles (0-100) to compute; may be empty.
+        bins: int, optional
+            Also compute a histogram with this many equal bins between
+            each band's min and max.
+        approx_pixels: int
+            Minimum number of pixels of the overview used per file when
+            not ``exact``.
+
+        Returns
+        -------
+        xarray.Dataset of ``count``, ``min``, ``max``, ``mean`` and ``std``
+        along ``band``, ``percentile`` along ``band`` and ``quantile``, and
+        ``histogram`` and ``bin_edges``. Pixels masked as nodata are left
+        out. The ``method`` attribute tells whether the values are
+        ``"stored"``, from an ``"overview"`` or ``"exact"``.
+        """
+        import dask
+        from dask.utils import parse_bytes
+
+        kwargs = self.reader.kwargs
+        data = kwargs['args'][0]
+        fs, paths = _expand_paths(data.url, data.storage_options)
+        handles = kwargs.get('handles_per_thread')
+        io_options = _io_options(kwargs.get('header_bytes'),
+                                 kwargs.get('merge_gap', MERGE_GAP),
+                                 HANDLES_PER_THREAD if handles is None
+                                 else handles,
+                                 kwargs.get('gdal_cache'),
+                                 kwargs.get('gdal_threads'))
+        io_options = _with_infos(fs, paths, io_options)
+        percentiles = list(percentiles or [])
+        if not exact:
+            return _approximate_stats(fs, paths, percentiles, bins,
+                                      approx_pixels, io_options)
+        target = parse_bytes(kwargs.get('chunk_target_bytes') or
+                             dask.config.get('array.chunk-size'))
+        return _exact_stats(fs, paths, percentiles, bins, target, io_options)
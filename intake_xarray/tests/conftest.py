@@ -48,3 +48,31 @@ def mock_import_xarray():
         yield
     finally:
         sys.modules['xarray'] = xarray
+
+
+@pytest.fixture
+def make_geotiff(tmp_path):
+    """Factory writing tiled single-band GeoTIFFs with overviews"""
+    rasterio = pytest.importorskip('rasterio')
+    import numpy as np
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_origin
+
+    def make(name='image.tif', width=256, height=256, origin=(1000, 2000),
+             res=10, data=None, overviews=(2, 4, 8), crs='EPSG:32618'):
+        if data is None:
+            data = np.arange(width * height, dtype='uint16').reshape(
+                1, height, width)
+        height, width = data.shape[1:]
+        path = str(tmp_path / name)
+        profile = dict(driver='GTiff', width=width, height=height,
+                       count=data.shape[0], dtype=data.dtype, crs=crs,
+                       transform=from_origin(origin[0], origin[1], res, res),
+                       tiled=True, blockxsize=64, blockysize=64)
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(data)
+            if overviews:
+                dst.build_overviews(list(overviews), Resampling.nearest)
+        return path
+
+    return make
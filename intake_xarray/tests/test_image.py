@@ -3,7 +3,7 @@ import os
 import numpy as np
 import pytest
 
-from intake_xarray.image import _coerce_shape, ImageSource
+from intake_xarray.image import _coerce_shape, _coerce_into, ImageSource
 
 here = os.path.dirname(__file__)
 
@@ -128,6 +128,59 @@ def test_coerce_shape_array_non_int():
     assert expected.dtype == np.float64
 
 
+def test_coerce_shape_2d_center():
+    shape = (2, 4)
+    array = np.array([[1, 2],
+                      [3, 4],
+                      [5, 6],
+                      [7, 8]])
+    expected = np.array([[0, 3, 4, 0],
+                         [0, 5, 6, 0]])
+    actual = _coerce_shape(array, shape, mode='center')
+    assert (expected == actual).all()
+
+
+def test_coerce_shape_3d_resize():
+    pytest.importorskip('skimage')
+    shape = (4, 6)
+    array = np.full((2, 3, 3), 7, dtype=np.uint8)
+    actual = _coerce_shape(array, shape, mode='resize')
+    assert actual.shape == (4, 6, 3)
+    assert actual.dtype == np.uint8
+    assert (actual == 7).all()
+
+
+def test_coerce_shape_resize_rounds_integers():
+    pytest.importorskip('skimage')
+    from skimage.transform import resize
+    array = np.zeros((4, 4), dtype=np.uint8)
+    array[:, 2:] = 255
+    expected = resize(array, (3, 3), preserve_range=True, anti_aliasing=True)
+    actual = _coerce_shape(array, (3, 3), mode='resize')
+    assert actual.dtype == np.uint8
+    assert (actual == np.clip(np.rint(expected), 0, 255)).all()
+    assert not (actual == expected.astype(np.uint8)).all()
+
+
+def test_coerce_shape_raises_error_on_unknown_mode():
+    with pytest.raises(ValueError, match='coerce_mode'):
+        _coerce_shape(np.zeros((2, 2)), (3, 3), mode='stretch')
+
+
+def test_coerce_into_overwrites_margins():
+    out = np.full((2, 3, 4, 3), -1)
+    array = np.arange(2 * 2 * 3).reshape(2, 2, 3)
+    _coerce_into(array, out[0])
+    _coerce_into(array, out[1], mode='center')
+    assert (out[0, :2, :2] == array).all()
+    assert (out[0, 2:] == 0).all()
+    assert (out[0, :, 2:] == 0).all()
+    assert (out[1, :2, 1:3] == array).all()
+    assert (out[1, 2] == 0).all()
+    assert (out[1, :, 0] == 0).all()
+    assert (out[1, :, 3] == 0).all()
+
+
 def test_read_image():
     pytest.importorskip('skimage')
     urlpath = os.path.join(here, 'data', 'images', 'beach57.tif')
@@ -175,3 +228,158 @@ def test_read_images_and_exif_as_glob_with_coerce():
     ds = source.read()
     assert ds['raster'].shape == (3, 256, 256, 3)
     assert ds['EXIF Image ImageWidth'].shape == (3,)
+
+
+def test_read_images_as_glob_with_coerce_in_batches():
+    pytest.importorskip('skimage')
+    urlpath = os.path.join(here, 'data', 'images', '*')
+    source = ImageSource(urlpath=urlpath, coerce_shape=(256, 256),
+                         coerce_mode='center', chunks={'concat_dim': 2})
+    array = source.to_dask()
+    assert array.chunks[0] == (2, 1)
+    expected = ImageSource(urlpath=urlpath, coerce_shape=(256, 256),
+                           coerce_mode='center').read()
+    assert (array.values == expected.values).all()
+
+
+def test_read_ragged_images_flat():
+    skimage_io = pytest.importorskip('skimage.io')
+    urlpath = os.path.join(here, 'data', 'images', '*')
+    source = ImageSource(urlpath=urlpath, ragged='flat',
+                         chunks={'concat_dim': 2})
+    ds = source.to_dask()
+    assert ds.raster.dims == ('pixel', 'channel')
+    assert ds.raster.data.chunks[0] == (256 * 256 + 256 * 252, 247 * 247)
+    assert list(ds.height.values) == [256, 256, 247]
+    assert list(ds.width.values) == [256, 252, 247]
+    i = 1
+    start = int(ds.offset[i])
+    h, w = int(ds.height[i]), int(ds.width[i])
+    image = ds.raster[start:start + h * w].values.reshape(h, w, 3)
+    expected = skimage_io.imread(os.path.join(here, 'data', 'images',
+                                              'beach57.tif'))
+    assert (image == expected).all()
+
+
+def test_read_ragged_images_bucket():
+    pytest.importorskip('skimage')
+    urlpath = os.path.join(here, 'data', 'images', '*')
+    source = ImageSource(urlpath=urlpath, ragged='bucket')
+    ds = source.read()
+    assert set(ds.data_vars) == {'raster_256x256', 'raster_256x252',
+                                 'raster_247x247'}
+    assert ds.raster_256x252.shape == (1, 256, 252, 3)
+    assert list(ds['file_index_256x252'].values) == [1]
+
+
+@pytest.mark.parametrize('kwargs', [{'coerce_shape': (256, 256)},
+                                    {'coerce_mode': 'center'},
+                                    {'processes': 2}])
+def test_read_ragged_images_with_coerce_raises(kwargs):
+    urlpath = os.path.join(here, 'data', 'images', '*')
+    source = ImageSource(urlpath=urlpath, ragged='flat', **kwargs)
+    with pytest.raises(ValueError, match='exclusive'):
+        source.read()
+
+
+def test_read_multipage_tiff(tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    stack = np.arange(5 * 4 * 6, dtype='uint16').reshape(5, 4, 6)
+    tifffile.imwrite(str(tmp_path / 'stack.tif'), stack)
+    source = ImageSource(urlpath=str(tmp_path / 'stack.tif'), pages=2)
+    array = source.to_dask()
+    assert array.dims == ('page', 'y', 'x')
+    assert array.data.chunks[0] == (2, 2, 1)
+    assert (array[3].values == stack[3]).all()
+    assert (array.values == stack).all()
+
+
+@pytest.mark.parametrize('kwargs', [{'coerce_shape': (4, 4)},
+                                    {'coerce_mode': 'center'},
+                                    {'processes': 2}])
+def test_read_multipage_tiff_with_image_options_raises(tmp_path, kwargs):
+    tifffile = pytest.importorskip('tifffile')
+    tifffile.imwrite(str(tmp_path / 'stack.tif'),
+                     np.zeros((3, 4, 6), dtype='uint8'))
+    source = ImageSource(urlpath=str(tmp_path / 'stack.tif'), pages=True,
+                         **kwargs)
+    with pytest.raises(ValueError, match='pages cannot be combined with %s'
+                       % list(kwargs)[0]):
+        source.read()
+
+
+def test_read_multipage_tiffs_with_pattern(tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    stack = np.arange(3 * 4 * 6 * 3, dtype='uint8').reshape(3, 4, 6, 3)
+    for i in range(2):
+        tifffile.imwrite(str(tmp_path / ('stack_%d.tif' % i)), stack + i,
+                         photometric='rgb')
+    source = ImageSource(urlpath=str(tmp_path / 'stack_{num:d}.tif'),
+                         concat_dim='num', pages=True)
+    array = source.read()
+    assert array.dims == ('num', 'page', 'y', 'x', 'channel')
+    assert array.shape == (2, 3, 4, 6, 3)
+    assert (array.sel(num=1).values == stack + 1).all()
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    av = pytest.importorskip('av')
+    path = str(tmp_path / 'video.mp4')
+    try:
+        with av.open(path, 'w') as container:
+            stream = container.add_stream('libx264', rate=10,
+                                          options={'g': '4'})
+            stream.width, stream.height = 32, 24
+            stream.pix_fmt = 'yuv420p'
+            for i in range(11):
+                frame = av.VideoFrame.from_ndarray(
+                    np.full((24, 32, 3), i * 20, dtype=np.uint8),
+                    format='rgb24')
+                container.mux(stream.encode(frame))
+            container.mux(stream.encode())
+    except (av.error.FFmpegError, ValueError):
+        pytest.skip('libx264 encoder not available')
+    return path
+
+
+def test_read_video(video_path):
+    import av
+    from intake_xarray.image import VideoSource
+
+    with av.open(video_path) as container:
+        expected = np.stack([frame.to_ndarray(format='rgb24')
+                             for frame in container.decode(video=0)])
+    source = VideoSource(video_path)
+    video = source.to_dask()
+    assert video.dims == ('frame', 'y', 'x', 'channel')
+    assert video.shape == (11, 24, 32, 3)
+    # one chunk per GOP
+    assert 1 < len(video.data.chunks[0]) < 11
+    assert video.frame.values[1] == np.timedelta64(100, 'ms')
+    assert (video.values == expected).all()
+
+    window = video.sel(frame=slice('0.5s', '0.6s'))
+    assert window.shape[0] == 2
+    assert (window.values == expected[5:7]).all()
+
+
+def test_read_video_frames_per_chunk(video_path):
+    from intake_xarray.image import VideoSource
+
+    source = VideoSource(video_path, frames_per_chunk=3, format='gray')
+    video = source.read()
+    assert video.dims == ('frame', 'y', 'x')
+    assert video.data.chunks[0] == (3, 3, 3, 2)
+    assert video[7].values.shape == (24, 32)
+
+
+def test_read_images_in_process_pool():
+    pytest.importorskip('skimage')
+    urlpath = os.path.join(here, 'data', 'images', '*')
+    expected = ImageSource(urlpath=urlpath, coerce_shape=(256, 256)).read()
+    source = ImageSource(urlpath=urlpath, coerce_shape=(256, 256),
+                         processes=2, chunks={'concat_dim': 2})
+    array = source.to_dask()
+    assert array.data.chunks[0] == (2, 1)
+    assert (array.values == expected.values).all()
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 from unittest.mock import patch
 import tempfile
 
+import fsspec
 import numpy as np
 import pytest
 import xarray as xr
@@ -39,6 +41,173 @@ def test_read_list_of_netcdf_files_with_combine_nested():
                       'concat_dim': 2}
 
 
+@pytest.mark.parametrize('pattern', [False, True])
+def test_netcdf_refresh(dataset, tmp_path, monkeypatch, pattern):
+    import pandas as pd
+    import xarray as xr
+    from intake_xarray.netcdf import NetCDFSource
+
+    def write(day):
+        # with the pattern, the day is only given by the file name
+        time = dataset.time.values if pattern else \
+            [pd.Timestamp('2020-01-%02d' % day)]
+        dataset.assign_coords(time=time).to_netcdf(
+            str(tmp_path / ('day_%d.nc' % day)), engine='scipy')
+
+    for day in (1, 2, 3):
+        write(day)
+    if pattern:
+        source = NetCDFSource(str(tmp_path / 'day_{day:d}.nc'))
+    else:
+        source = NetCDFSource(str(tmp_path / 'day_*.nc'),
+                              concat_dim='time', combine='nested')
+    assert source.refresh().sizes[source.refresh().temp.dims[0]] == 3
+
+    opened = []
+    for name in ('open_dataset', 'open_mfdataset'):
+        def recording(paths, *args, _open=getattr(xr, name), **kwargs):
+            opened.append(paths)
+            return _open(paths, *args, **kwargs)
+        monkeypatch.setattr(xr, name, recording)
+    write(4)
+    ds = source.refresh()
+    assert [os.path.basename(getattr(f, 'path', f)) for f in opened] == \
+        ['day_4.nc']
+    if pattern:
+        assert list(ds.day.values) == [1, 2, 3, 4]
+    else:
+        assert list(ds.time.dt.day.values) == [1, 2, 3, 4]
+    assert ds.temp.shape[0] == 4
+    assert np.all(ds.rh[-1].values == dataset.rh.values)
+    assert source.refresh() is ds
+
+    # removing a file reopens all
+    os.remove(str(tmp_path / 'day_1.nc'))
+    assert source.refresh().temp.shape[0] == 3
+
+
+def test_netcdf_refresh_double_slash(dataset, tmp_path):
+    from intake_xarray.netcdf import NetCDFSource
+    for day in (1, 2):
+        dataset.to_netcdf(str(tmp_path / ('day_%d.nc' % day)),
+                          engine='scipy')
+    # as '{{ CATALOG_DIR }}/day_*.nc' makes in catalogs
+    source = NetCDFSource(str(tmp_path) + '//day_*.nc', concat_dim='time',
+                          combine='nested')
+    assert source.refresh().temp.shape[0] == 2
+    dataset.to_netcdf(str(tmp_path / 'day_3.nc'), engine='scipy')
+    assert source.refresh().temp.shape[0] == 3
+
+
+@pytest.mark.parametrize('pattern', [False, True])
+def test_netcdf_max_open_files(dataset, tmp_path, pattern):
+    import pickle
+    import pandas as pd
+    from intake_xarray.netcdf import NetCDFSource
+
+    for day in range(1, 7):
+        dataset.assign_coords(time=[pd.Timestamp('2020-01-%02d' % day)]
+                              ).to_netcdf(str(tmp_path / ('day_%d.nc' % day)),
+                                          engine='scipy')
+    url = str(tmp_path / ('day_{day:d}.nc' if pattern else 'day_*.nc'))
+    source = NetCDFSource(url, concat_dim='time', combine='nested',
+                          max_open_files=2)
+    pool = source.handle_pool
+    ds = source.to_dask()
+    assert ds.temp.chunks[0] == (1, ) * 6
+    ds.temp.values
+    assert len(pool) <= 2
+    assert pool.opens > 6 and pool.reopens and pool.evictions
+    assert np.all(ds.temp[-1].values == dataset.temp[0].values)
+
+    # copies sent to workers read through the same pool
+    opens = pool.opens
+    assert np.all(pickle.loads(pickle.dumps(ds)).rh.values == ds.rh.values)
+    assert pool.opens > opens and len(pool) <= 2
+
+    # with room for all files, chunk reads reuse the handles
+    source = NetCDFSource(url, concat_dim='time', combine='nested',
+                          max_open_files=10)
+    ds = source.to_dask()
+    ds.load()
+    ds.load()
+    assert len(source.handle_pool) == 6
+    assert source.handle_pool.opens == 6
+    assert source.handle_pool.reopens == 0
+
+
+def test_file_handle_pool_keeps_files_being_read():
+    from intake_xarray.netcdf import FileHandlePool
+
+    class File:
+        def __init__(self, path, mode='r'):
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    pool = FileHandlePool(max_open=1)
+    first, second = pool.manager(File, 'a'), pool.manager(File, 'b')
+    with first.acquire_context() as f:
+        second.acquire()
+        # evicted while read, so only closed after
+        assert len(pool) == 1 and pool.evictions == 1
+        assert not f.closed
+    assert f.closed
+    g = second.acquire()
+    first.acquire()
+    assert g.closed
+    pool.resize(2)
+    second.acquire()
+    first.close()
+    assert len(pool) == 1
+
+
+def test_netcdf_max_open_files_double_slash(dataset, tmp_path):
+    from intake_xarray.netcdf import NetCDFSource
+    for day in (1, 2, 3):
+        dataset.to_netcdf(str(tmp_path / ('day_%d.nc' % day)),
+                          engine='scipy')
+    # as '{{ CATALOG_DIR }}/day_*.nc' makes in catalogs
+    source = NetCDFSource(str(tmp_path) + '//day_*.nc', concat_dim='time',
+                          combine='nested', max_open_files=2)
+    assert source.to_dask().temp.shape[0] == 3
+    assert source.handle_pool.opens
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'max_open_files': 2}])
+def test_netcdf_mmap(dataset, tmp_path, monkeypatch, kwargs):
+    import scipy.io
+    from intake_xarray.netcdf import NetCDFSource
+
+    for day in (1, 2):
+        dataset.to_netcdf(str(tmp_path / ('day_%d.nc' % day)),
+                          engine='scipy', unlimited_dims=['time'])
+    opened = []
+
+    class Recording(scipy.io.netcdf_file):
+        def __init__(self, *args, **kw):
+            super().__init__(*args, **kw)
+            opened.append(self)
+    monkeypatch.setattr(scipy.io, 'netcdf_file', Recording)
+
+    # file objects, as for urls, are read eagerly
+    ds = NetCDFSource('file://' + str(tmp_path / 'day_1.nc')).read()
+    assert not any(f.use_mmap for f in opened)
+
+    combine = dict(concat_dim='time', combine='nested')
+    for url, kw in [('file://' + str(tmp_path / 'day_1.nc'), {}),
+                    (str(tmp_path / 'day_*.nc'), combine)]:
+        opened.clear()
+        source = NetCDFSource(url, mmap=True, **kw, **kwargs)
+        ds = source.to_dask()
+        assert np.all(ds.temp[-1].values == dataset.temp[-1].values)
+        assert opened and all(f.use_mmap for f in opened)
+
+    with pytest.raises(ValueError):
+        NetCDFSource(url, mmap=True, engine='netcdf4')
+
+
 def test_read_glob_pattern_of_netcdf_files():
     """If xarray is old, prompt user to update to use pattern"""
     from intake_xarray.netcdf import NetCDFSource
@@ -61,6 +230,365 @@ def test_to_dask(source, netcdf_source, zarr_source, dataset):
     assert np.all(ds.rh == dataset.rh)
 
 
+def _zarr_format(zarr_format):
+    """to_zarr kwargs for this format; zarr 2 only writes format 2, by
+    default, while zarr 3 writes 3 by default"""
+    zarr = pytest.importorskip('zarr', minversion='3' if zarr_format == 3
+                               else None)
+    if zarr.__version__.startswith('2.'):
+        return {}
+    return {'zarr_format': zarr_format}
+
+
+@pytest.mark.parametrize('zarr_format', [2, 3])
+def test_zarr_consolidated_metadata(dataset, tmp_path, zarr_format):
+    import warnings
+    from intake_xarray import ZarrSource
+    from intake_xarray.xzarr import _has_consolidated
+    path = str(tmp_path / 'data.zarr')
+    dataset.to_zarr(path, consolidated=False, **_zarr_format(zarr_format))
+    mapper = fsspec.get_mapper(path)
+    assert not _has_consolidated(mapper)
+
+    # no attempt at consolidated metadata, so no fallback warning
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        ds = ZarrSource(path).read()
+    assert np.all(ds.temp == dataset.temp)
+    assert not _has_consolidated(mapper)
+
+    ds = ZarrSource(path, consolidate=True).read()
+    assert _has_consolidated(mapper)
+    assert np.all(ds.rh == dataset.rh)
+    with patch('xarray.open_dataset', wraps=xr.open_dataset) as opened:
+        ZarrSource(path).to_dask()
+    assert opened.call_args.kwargs['consolidated'] is True
+
+
+def test_zarr_consolidate_method(dataset, tmp_path):
+    from intake_xarray import ZarrSource
+    from intake_xarray.xzarr import _has_consolidated
+    path = str(tmp_path / 'data.zarr')
+    dataset.to_zarr(path, consolidated=False, **_zarr_format(2))
+    ZarrSource(path).consolidate_metadata()
+    assert _has_consolidated(fsspec.get_mapper(path))
+
+
+@pytest.mark.parametrize('cache', ['decoded', 'compressed'])
+def test_zarr_chunk_cache(dataset, tmp_path, cache):
+    from intake_xarray import ZarrSource
+    from intake_xarray.xzarr import chunk_cache, set_cache_size
+    if cache == 'compressed':
+        pytest.importorskip('zarr', minversion='3')
+    path = str(tmp_path / 'data.zarr')
+    dataset.chunk({'lat': 2}).to_zarr(path)
+    chunk_cache.clear()
+
+    first = ZarrSource(path, cache=cache).to_dask()
+    assert np.all(first.temp.isel(lat=slice(0, 3)) == dataset.temp[:, :3])
+    cached, hits = len(chunk_cache), chunk_cache.hits
+    assert cached and chunk_cache.misses
+    # another source of the same store reads the same chunks from memory
+    second = ZarrSource(path, cache=cache).to_dask()
+    assert np.all(second.temp.isel(lat=slice(1, 3)) == dataset.temp[:, 1:3])
+    assert len(chunk_cache) == cached
+    assert chunk_cache.hits > hits and 0 < chunk_cache.hit_ratio < 1
+    assert np.all(ZarrSource(path, cache=cache).read().rh == dataset.rh)
+
+    set_cache_size(1000)
+    try:
+        assert chunk_cache.nbytes <= 1000
+        assert np.all(ZarrSource(path, cache=cache).read().rh == dataset.rh)
+        assert chunk_cache.nbytes <= 1000
+    finally:
+        set_cache_size(2 ** 28)
+
+
+@pytest.mark.parametrize('cache', ['decoded', 'compressed'])
+def test_zarr_chunk_cache_rewritten_store(dataset, tmp_path, cache):
+    from intake_xarray import ZarrSource
+    if cache == 'compressed':
+        pytest.importorskip('zarr', minversion='3')
+    path = str(tmp_path / 'data.zarr')
+    dataset.chunk({'lat': 2}).to_zarr(path)
+    ds = ZarrSource(path, cache=cache).read()
+    # blocks are the reader's own to modify, not the cache's
+    ds.rh[:] = -1
+    assert np.all(ZarrSource(path, cache=cache).read().rh == dataset.rh)
+
+    dataset.assign(rh=dataset.rh + 1).chunk({'lat': 2}).to_zarr(path,
+                                                                 mode='w')
+    ds = ZarrSource(path, cache=cache).read()
+    assert np.all(ds.rh == dataset.rh + 1)
+
+
+def test_zarr_concurrent_fetch(dataset, monkeypatch):
+    zarr = pytest.importorskip('zarr', minversion='3')
+    from intake_xarray import ZarrSource
+    from fsspec.implementations.memory import MemoryFileSystem
+    dataset.chunk({'lat': 1, 'lon': 2}).to_zarr(
+        'memory://concurrent.zarr', mode='w')
+    calls = []
+    cat = MemoryFileSystem.cat
+
+    def counting_cat(self, path, *args, **kwargs):
+        if isinstance(path, list):
+            calls.append(len(path))
+        return cat(self, path, *args, **kwargs)
+
+    monkeypatch.setattr(MemoryFileSystem, 'cat', counting_cat)
+    limit = zarr.config.get('async.concurrency')
+    source = ZarrSource('memory://concurrent.zarr', concurrency=32,
+                        chunks={'lat': 5, 'lon': 10})
+    ds = source.to_dask()
+    assert ds.temp.data.numblocks[-2:] == (1, 1)
+    assert zarr.config.get('async.concurrency') == limit
+    with zarr.config.set({'async.concurrency': 32}):
+        calls.clear()
+        assert np.all(ds.temp.values == dataset.temp.values)
+    # all 5 x 5 storage chunks of the one dask chunk come in one batch
+    assert calls == [25]
+    # otherwise, in batches of as many as zarr reads at once
+    calls.clear()
+    assert np.all(source.read().temp == dataset.temp)
+    assert calls and max(calls) <= limit < 25
+    assert zarr.config.get('async.concurrency') == limit
+
+
+@pytest.mark.parametrize('fmt', ['netcdf', 'zarr'])
+def test_auto_aligned_chunks(dataset, tmp_path, fmt):
+    import dask
+    import functools
+    from intake_xarray import NetCDFSource, ZarrSource
+    from intake_xarray.base import misaligned_dims
+    stored = {'temp': (1, 2, 5, 3), 'rh': (1, 5, 3)}
+    if fmt == 'netcdf':
+        path = str(tmp_path / 'chunked.nc')
+        dataset.to_netcdf(path, encoding={
+            k: {'chunksizes': c, 'zlib': True} for k, c in stored.items()})
+        source = functools.partial(NetCDFSource, engine='netcdf4')
+    else:
+        path = str(tmp_path / 'chunked.zarr')
+        dataset.to_zarr(path, encoding={
+            k: {'chunks': c} for k, c in stored.items()})
+        source = ZarrSource
+
+    with dask.config.set({'array.chunk-size': '400B'}):
+        ds = source(path, chunks='auto-aligned').to_dask()
+    assert ds.temp.data.npartitions > 1
+    for chunks, size in zip(ds.temp.chunks, stored['temp']):
+        assert all(c % size == 0 for c in chunks[:-1])
+    assert not misaligned_dims(ds)
+    assert np.all(ds.temp.values == dataset.temp.values)
+
+    with pytest.warns(UserWarning) as record:
+        ds = source(path, chunks={'lon': 4}).to_dask()
+    record = [w for w in record if issubclass(w.category, UserWarning)]
+    # once, not again by xarray, and pointing at the caller
+    assert len(record) == 1
+    assert re.search(r"\['lon'\].*\{'lon': 3\}", str(record[0].message))
+    assert record[0].filename == __file__
+    assert misaligned_dims(ds) == ['lon']
+
+
+def test_zarr_concat_stores(dataset, tmp_path):
+    import pandas as pd
+    from intake_xarray import ZarrSource
+    days = ['20200101', '20200102', '20200103']
+    for i, day in enumerate(days):
+        path = str(tmp_path / ('day_%s.zarr' % day))
+        dataset.assign(rh=dataset.rh + i).assign_coords(
+            time=[pd.Timestamp(day)]).to_zarr(
+                path, encoding={'time': {'units': 'days since 2000-01-01'}})
+
+    ds = ZarrSource(str(tmp_path / '*.zarr'), concat_dim='time').to_dask()
+    assert list(ds.time.values) == list(pd.to_datetime(days))
+    assert ds.rh.chunks[0] == (1, 1, 1)
+    assert np.allclose(ds.rh.values[2] - dataset.rh.values[0], 2)
+
+    ds = ZarrSource(str(tmp_path / 'day_{day}.zarr'),
+                    cache='decoded').to_dask()
+    assert ds.rh.dims == ('day', 'time', 'lat', 'lon')
+    assert list(ds.day.values) == days
+
+    # the pattern supplies the time coordinate; the stores' own, now
+    # corrupt, is not read
+    for chunk in tmp_path.glob('day_*.zarr/time/**/*'):
+        if chunk.is_file() and not chunk.name.startswith(('.z', 'zarr.')):
+            chunk.write_bytes(b'corrupt')
+    source = ZarrSource(str(tmp_path / 'day_{time:%Y%m%d}.zarr'))
+    ds = source.to_dask()
+    assert list(ds.time.values) == list(pd.to_datetime(days))
+    assert np.all(ds.lat == dataset.lat) and 'level' in ds.indexes
+    assert np.allclose(source.read().rh.values[1] - dataset.rh.values[0], 1)
+
+
+@pytest.mark.parametrize('zarr_format', [2, 3])
+def test_zarr_consolidated_probed_in_one_batch(dataset, tmp_path,
+                                               zarr_format):
+    from fsspec.implementations.local import LocalFileSystem
+    from intake_xarray import ZarrSource
+    for n in range(3):
+        dataset.to_zarr(str(tmp_path / ('s%d.zarr' % n)),
+                        consolidated=n > 0, **_zarr_format(zarr_format))
+    source = ZarrSource(str(tmp_path / 's{n}.zarr'))
+    with patch.object(LocalFileSystem, 'cat',
+                      wraps=LocalFileSystem().cat) as cat, \
+            patch('xarray.open_dataset', wraps=xr.open_dataset) as opened:
+        source.to_dask()
+    assert cat.call_count == 1 and len(cat.call_args.args[0]) == 6
+    # the stores differ, so xarray is left to try each
+    assert opened.call_args.kwargs['consolidated'] is None
+
+    source = ZarrSource(str(tmp_path / 's{n}.zarr'), consolidate=True)
+    source.to_dask()
+    with patch('xarray.open_dataset', wraps=xr.open_dataset) as opened:
+        ZarrSource(str(tmp_path / 's{n}.zarr')).to_dask()
+    assert opened.call_args.kwargs['consolidated'] is True
+
+
+def test_zarr_concat_stores_without_default_index_option(dataset, tmp_path,
+                                                         monkeypatch):
+    import pandas as pd
+    from intake_xarray import ZarrSource
+    days = ['20200101', '20200102']
+    for day in days:
+        dataset.assign_coords(time=[pd.Timestamp(day)]).to_zarr(
+            str(tmp_path / ('day_%s.zarr' % day)))
+    open_dataset = xr.open_dataset
+
+    def older_open_dataset(filename_or_obj, **kwargs):
+        # as xarray before create_default_indexes
+        assert 'create_default_indexes' not in kwargs
+        return open_dataset(filename_or_obj, **kwargs)
+
+    monkeypatch.setattr(xr, 'open_dataset', older_open_dataset)
+    ds = ZarrSource(str(tmp_path / '*.zarr'), concat_dim='time').to_dask()
+    assert list(ds.time.values) == list(pd.to_datetime(days))
+    assert np.all(ds.rh.values[1] == dataset.rh.values[0])
+
+
+def test_export_zarr(netcdf_source, dataset, tmp_path, monkeypatch):
+    import dask
+    zarr = pytest.importorskip('zarr', minversion='3')
+    import intake_xarray.base
+    target = str(tmp_path / 'export.zarr')
+    write_region = intake_xarray.base._write_region
+    written = []
+
+    def counting(*args):
+        if len(written) == limit:
+            raise KeyboardInterrupt
+        written.append((list(args[0].data_vars), str(args[2])))
+        write_region(*args)
+
+    monkeypatch.setattr(intake_xarray.base, '_write_region', counting)
+    kwargs = dict(chunks={'lat': 2, 'lon': 5},
+                  compressor=zarr.codecs.ZstdCodec(level=1))
+    limit = 3
+    with dask.config.set(scheduler='sync'), pytest.raises(KeyboardInterrupt):
+        netcdf_source.export_zarr(target, **kwargs)
+    # 6 regions of each of temp and rh, of which the 3 written are skipped
+    limit = None
+    with dask.config.set(scheduler='sync'):
+        out = netcdf_source.export_zarr(target, **kwargs)
+    assert len({str(w) for w in written}) == len(written) == 12
+    assert not os.path.exists(target + '.progress')
+
+    ds = out.to_dask()
+    assert ds.temp.chunks[2:] == ((2, 2, 1), (5, 5))
+    assert ds.temp.encoding['compressors'][0].to_dict()['name'] == 'zstd'
+    assert ds.equals(dataset)
+
+
+def test_export_zarr_partial_chunks(dataset, tmp_path):
+    import pandas as pd
+    import xarray as xr
+    from intake_xarray.netcdf import NetCDFSource
+    days = 1
+    for i, n in enumerate((2, 3, 1)):
+        times = pd.date_range('2020-01-01', periods=6)[days - 1:days - 1 + n]
+        dataset.isel(time=[0] * n).assign_coords(time=times).to_netcdf(
+            str(tmp_path / ('part_%d.nc' % i)), engine='scipy')
+        days += n
+    source = NetCDFSource(str(tmp_path / 'part_*.nc'), concat_dim='time',
+                          combine='nested')
+    assert source.to_dask().temp.chunks[0] == (2, 3, 1)
+    # time, not named, is made uniform as well
+    out = source.export_zarr(str(tmp_path / 'export.zarr'),
+                             chunks={'lat': 5})
+    ds = out.to_dask()
+    assert ds.temp.chunks[0] == (3, 3)
+    assert ds.temp.chunks[2] == (5, )
+    xr.testing.assert_equal(ds.load(), source.to_dask().load())
+
+
+def test_export_zarr_region_tasks(netcdf_source, tmp_path, monkeypatch):
+    import dask
+    import dask.array as da
+    import intake_xarray.base
+    write_region = intake_xarray.base._write_region
+    received = []
+
+    def recording(*args):
+        received.append({k: (v.shape, isinstance(v.data, da.Array))
+                         for k, v in args[0].data_vars.items()})
+        write_region(*args)
+
+    monkeypatch.setattr(intake_xarray.base, '_write_region', recording)
+    with dask.config.set(scheduler='sync'):
+        netcdf_source.export_zarr(str(tmp_path / 'export.zarr'),
+                                  chunks={'lat': 1, 'lon': 10})
+    # each task is given its own region of 1 latitude, loaded
+    assert len(received) == 10
+    assert all(r in ({'temp': ((1, 4, 1, 10), False)},
+                     {'rh': ((1, 1, 10), False)}) for r in received)
+
+
+def test_export_zarr_processes(netcdf_source, dataset, tmp_path):
+    out = netcdf_source.export_zarr(str(tmp_path / 'export.zarr'),
+                                    chunks={'lat': 3}, **_zarr_format(2),
+                                    scheduler='processes', max_workers=2)
+    ds = out.read()
+    assert ds.equals(dataset)
+
+
+def test_zarr_sharded(netcdf_source, dataset, monkeypatch):
+    pytest.importorskip('zarr', minversion='3')
+    from fsspec.implementations.memory import MemoryFileSystem
+    from intake_xarray import ZarrSource
+    with pytest.raises(ValueError, match='zarr_format=3'):
+        netcdf_source.export_zarr('memory://sharded.zarr', zarr_format=2,
+                                  shards={'lat': 5})
+    netcdf_source.export_zarr('memory://sharded.zarr', zarr_format=3,
+                              chunks={'lat': 1, 'lon': 2},
+                              shards={'lat': 5, 'lon': 10})
+    fs = MemoryFileSystem()
+    assert len(fs.find('/sharded.zarr/temp')) == 2  # metadata and a shard
+
+    requests = []
+    cat_file = MemoryFileSystem.cat_file
+
+    def recording(self, path, start=None, end=None, **kwargs):
+        requests.append((path, start, end))
+        return cat_file(self, path, start, end, **kwargs)
+
+    monkeypatch.setattr(MemoryFileSystem, 'cat_file', recording)
+    ds = ZarrSource('memory://sharded.zarr').to_dask()
+    assert ds.temp.encoding['shards'] == (1, 4, 5, 10)
+    assert ds.temp.encoding['chunks'] == (1, 4, 1, 2)
+    # a task per shard, not per inner chunk
+    assert ds.temp.data.npartitions == 1
+    requests.clear()
+    assert np.all(ds.temp[0, :, 2, 2:4].values ==
+                  dataset.temp[0, :, 2, 2:4].values)
+    # the shard index, then the one inner chunk, by range requests
+    shard = [r for r in requests if '/temp/' in r[0]]
+    assert shard and all(r[1] is not None for r in shard)
+    assert np.all(ds.temp.values == dataset.temp.values)
+    fs.rm('/sharded.zarr', recursive=True)
+
+
 def test_grib_dask():
     pytest.importorskip('Nio')
     import dask.array as da
@@ -73,6 +601,106 @@ def test_grib_dask():
     assert (values == x2.APCP_P8_L1_GLL0_acc6h.values).all()
 
 
+def test_grib_index(tmp_path, monkeypatch):
+    import shutil
+    import pandas as pd
+    from intake_xarray import grib
+    from intake_xarray.netcdf import NetCDFSource
+
+    for i in (0, 1):
+        name = 'wafsgfs_L_t06z_intdsk6%d.grib2' % i
+        shutil.copy(os.path.join(here, 'data', name), str(tmp_path / name))
+    monkeypatch.setattr(grib, 'CACHE_DIR', str(tmp_path / 'cache'))
+    source = NetCDFSource(str(tmp_path / 'waf*.grib2'), engine='pynio')
+    index = source.grib_index()
+    assert len(index) == 184
+    # nothing written beside the data
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'cache', 'wafsgfs_L_t06z_intdsk60.grib2',
+        'wafsgfs_L_t06z_intdsk61.grib2']
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 2
+    apcp = index[index.parameter == '0.1.8']
+    assert len(apcp) == 2 and (apcp.level_type == 1).all()
+    # accumulated over a period ending at the valid time
+    assert (apcp.valid_time == pd.Timestamp('2007-01-12T18')).all()
+    isobaric = index[index.level_type == 100]
+    assert (isobaric.reference_time == pd.Timestamp('2007-01-10T06')).all()
+    assert 25000. in isobaric.level.values
+
+    # later opens read the index instead of the files
+    def scan(f):
+        raise AssertionError('rescanned')
+    monkeypatch.setattr(grib, 'scan_messages', scan)
+    assert source.grib_index().equals(index)
+
+    rows = grib.select(index, parameter='0.0.0', level=slice(20000, 50000))
+    assert len(rows) and (rows.parameter == '0.0.0').all()
+    monkeypatch.undo()
+    monkeypatch.setattr(grib, 'CACHE_DIR', str(tmp_path / 'cache'))
+    subset = source.select_messages(parameter='0.0.0',
+                                    level=slice(20000, 50000))
+    assert subset.reader.kwargs['engine'] == 'pynio'
+    path = subset.reader.kwargs['args'][0].url
+    assert os.path.getsize(path) == rows.length.sum()
+    with open(path, 'rb') as f:
+        entries = grib.scan_messages(f)
+    assert sorted(e['level'] for e in entries) == sorted(rows.level)
+    with pytest.raises(ValueError):
+        source.select_messages(parameter='9.9.9')
+
+    # a changed file is indexed again
+    with open(str(tmp_path / 'wafsgfs_L_t06z_intdsk61.grib2'), 'ab') as f:
+        f.write(open(path, 'rb').read())
+    assert len(source.grib_index()) == 184 + len(rows)
+
+
+def test_grib_index_path(tmp_path, monkeypatch):
+    import json
+    import shutil
+    from intake_xarray import grib
+    from intake_xarray.netcdf import NetCDFSource
+
+    for i in (0, 1):
+        name = 'wafsgfs_L_t06z_intdsk6%d.grib2' % i
+        shutil.copy(os.path.join(here, 'data', name), str(tmp_path / name))
+    monkeypatch.setattr(grib, 'CACHE_DIR', str(tmp_path / 'cache'))
+    index_path = str(tmp_path / 'grib_index.json')
+    source = NetCDFSource(str(tmp_path / 'waf*.grib2'), engine='pynio',
+                          grib_index_path=index_path)
+    index = source.grib_index()
+    assert len(index) == 184
+    assert not os.path.exists(str(tmp_path / 'cache'))
+    with open(index_path) as f:
+        assert len(json.load(f)) == 2
+
+    scanned = []
+    scan_messages = grib.scan_messages
+
+    def scan(f):
+        scanned.append(f)
+        return scan_messages(f)
+    monkeypatch.setattr(grib, 'scan_messages', scan)
+    assert source.grib_index().equals(index)
+    assert not scanned
+
+    # only the file rewritten is scanned again, even at the same size
+    path = str(tmp_path / 'wafsgfs_L_t06z_intdsk61.grib2')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert source.grib_index().equals(index)
+    assert len(scanned) == 1
+
+    # indexed as the source opens, with the versions of both files from
+    # one listing of their directory rather than a request each
+    os.remove(index_path)
+    monkeypatch.setattr(grib, '_file_version', None)
+    monkeypatch.setattr(type(source.reader), 'read',
+                        lambda self: xr.Dataset())
+    source.to_dask()
+    with open(index_path) as f:
+        assert len(json.load(f)) == 2
+
+
 def test_rasterio():
     import dask.array as da
     pytest.importorskip('rasterio')
@@ -95,6 +723,572 @@ def test_rasterio_glob():
     assert x.band_data.shape == (3, 718, 791)
 
 
+@pytest.mark.parametrize('chunks', ['auto', 'tile_aligned', 'auto-aligned'])
+def test_rasterio_tile_aligned_chunks(chunks):
+    pytest.importorskip('rasterio')
+    from intake_xarray.raster import RasterIOSource
+    # file is stripped, with blocks of 3 rows, pixel-interleaved
+    source = RasterIOSource(os.path.join(here, 'data', 'RGB.byte.tif'),
+                            chunks=chunks, chunk_target_bytes='100kB')
+    x = source.to_dask().band_data
+    band_chunks, y_chunks, x_chunks = x.chunks
+    assert band_chunks == (3,)
+    assert x_chunks == (791,)
+    assert all(c % 3 == 0 for c in y_chunks[:-1])
+    assert max(y_chunks) * 3 * 791 <= 100_000
+
+
+def test_rasterio_tile_aligned_chunks_tiled_pattern():
+    pytest.importorskip('rasterio')
+    from intake_xarray.raster import RasterIOSource
+    # 64x64 files with 16x16 tiles
+    source = RasterIOSource(os.path.join(here, 'data', 'little_{color}.tif'),
+                            chunks='auto', chunk_target_bytes=4 * 16 * 16 * 3)
+    x = source.to_dask().band_data
+    assert x.chunks[-2:] == ((32, 32), (32, 32))
+
+
+def test_rasterio_overview_level(make_geotiff):
+    from intake_xarray.raster import RasterIOSource
+    path = make_geotiff()
+    x = RasterIOSource(path, overview_level=1).read().band_data
+    assert x.shape == (1, 64, 64)
+    # coordinates are pixel centres on the 4x coarser grid
+    assert x.x.values[:2].tolist() == [1020, 1060]
+    assert x.y.values[:2].tolist() == [1980, 1940]
+
+
+@pytest.mark.parametrize('resolution,shape', [
+    (5, (256, 256)), (20, (128, 128)), (35, (128, 128)), ((100, 60), (64, 64)),
+])
+def test_rasterio_target_resolution(make_geotiff, resolution, shape):
+    from intake_xarray.raster import RasterIOSource
+    path = make_geotiff()
+    x = RasterIOSource(path, target_resolution=resolution,
+                       chunks='auto').to_dask().band_data
+    assert x.shape[1:] == shape
+
+
+def test_rasterio_bbox(make_geotiff):
+    from intake_xarray.raster import RasterIOSource
+    path = make_geotiff()
+    full = RasterIOSource(path).read().band_data
+    source = RasterIOSource(path, bbox=(1100, 1500, 1700, 1900),
+                            chunks='auto', chunk_target_bytes=64 * 64 * 2)
+    x = source.to_dask().band_data
+    assert x.shape == (1, 40, 60)
+    # chunk edges stay on the 64-pixel tile grid of the file
+    assert x.chunks[1:] == ((40,), (54, 6))
+    # the graph only covers the window: the lazy file array and two chunks
+    assert len(x.data.dask) == 3
+    expected = full.sel(x=slice(1100, 1700), y=slice(1900, 1500))
+    assert (x.values == expected.values).all()
+    assert (x.x.values == expected.x.values).all()
+
+    x = RasterIOSource(path, bbox=(1100, 1500, 1700, 1900)).read().band_data
+    assert isinstance(x.data, np.ndarray)
+    assert (x.values == expected.values).all()
+
+
+def test_rasterio_bbox_other_crs():
+    pytest.importorskip('rasterio')
+    from intake_xarray.raster import RasterIOSource
+    path = os.path.join(here, 'data', 'RGB.byte.tif')
+    x = RasterIOSource(path, bbox=(-77.5, 24.2, -77.3, 24.4),
+                       bbox_crs='EPSG:4326').read().band_data
+    assert x.shape == (3, 76, 70)
+
+
+def test_rasterio_bbox_pattern():
+    pytest.importorskip('rasterio')
+    from intake_xarray.raster import RasterIOSource
+    path = os.path.join(here, 'data', 'little_{color}.tif')
+    full = RasterIOSource(path).read().band_data
+    x = RasterIOSource(path, bbox=(10, -30, 20, -20),
+                       chunks={}).to_dask().band_data
+    assert x.shape == (2, 3, 20, 20)
+    expected = full.isel(y=slice(40, 60), x=slice(20, 40))
+    assert (x.values == expected.values).all()
+
+
+def test_rasterio_bbox_outside_raises(make_geotiff):
+    from intake_xarray.raster import RasterIOSource
+    path = make_geotiff()
+    with pytest.raises(ValueError, match='does not intersect'):
+        RasterIOSource(path, bbox=(0, 0, 10, 10)).read()
+
+
+@pytest.fixture
+def mosaic_tiles(make_geotiff):
+    """2x3 grid of 50x50 tiles, and the full array they were cut from"""
+    full = np.arange(3 * 100 * 150, dtype='int16').reshape(3, 100, 150)
+    for i in range(2):
+        for j in range(3):
+            path = make_geotiff(
+                'tile_%d_%d.tif' % (i, j), origin=(j * 500, 1000 - i * 500),
+                data=full[:, i * 50:(i + 1) * 50, j * 50:(j + 1) * 50],
+                overviews=None)
+    return os.path.join(os.path.dirname(path), 'tile_*.tif'), full
+
+
+def test_rasterio_mosaic(mosaic_tiles):
+    from intake_xarray.raster import RasterIOSource
+    urlpath, full = mosaic_tiles
+    source = RasterIOSource(urlpath, mosaic=True, chunks={'y': 40, 'x': 40})
+    x = source.to_dask().band_data
+    assert x.dims == ('band', 'y', 'x')
+    assert x.chunks == ((3,), (40, 40, 20), (40, 40, 40, 30))
+    assert (x.values == full).all()
+    assert x.x.values[0] == 5
+    assert x.y.values[0] == 995
+
+    x = RasterIOSource(urlpath, mosaic=True).read().band_data
+    assert isinstance(x.data, np.ndarray)
+    assert (x.values == full).all()
+
+
+@pytest.mark.parametrize('mask_and_scale', [True, False])
+def test_rasterio_mosaic_masks_as_default(make_geotiff, mask_and_scale):
+    import rasterio
+    import xarray as xr
+    from intake_xarray.raster import RasterIOSource
+    data = np.arange(64 * 64, dtype='uint8').reshape(1, 64, 64) % 5
+    path = make_geotiff(data=data, overviews=None)
+    with rasterio.open(path, 'r+') as dst:
+        dst.nodata = 0
+        dst.scales = (2., )
+    kwargs = dict(xarray_kwargs={'mask_and_scale': mask_and_scale})
+    expected = RasterIOSource(path, **kwargs).read().band_data
+    x = RasterIOSource(path, mosaic=True, **kwargs).read().band_data
+    assert x.dtype == expected.dtype
+    assert x.attrs == expected.attrs
+    np.testing.assert_array_equal(x.values, expected.values)
+
+
+def test_rasterio_mosaic_bbox_reads_few_tiles(mosaic_tiles):
+    from intake_xarray.raster import RasterIOSource
+    urlpath, full = mosaic_tiles
+    source = RasterIOSource(urlpath, mosaic=True, chunks={},
+                            bbox=(510, 420, 590, 580))
+    x = source.to_dask().band_data
+    layer, = [v for k, v in x.data.dask.layers.items()
+              if k.startswith('mosaic-')]
+    tasks = list(dict(layer).values())
+    # one chunk per intersecting tile, each opening only that tile
+    assert [len(task[2]) for task in tasks] == [1, 1]
+    assert (x.values == full[:, 42:58, 51:59]).all()
+
+
+def test_rasterio_mosaic_index(mosaic_tiles, make_geotiff, tmp_path):
+    import json
+    from intake_xarray import raster
+    urlpath, full = mosaic_tiles
+    index_path = str(tmp_path / 'tiles.json')
+    source = raster.RasterIOSource(urlpath, mosaic=True,
+                                   mosaic_index=index_path)
+    assert source.read().band_data.shape == (3, 100, 150)
+    with open(index_path) as f:
+        assert len(json.load(f)['tiles']) == 6
+
+    # add a tile to the right; only it has its header read
+    make_geotiff('tile_0_3.tif', origin=(1500, 1000), overviews=None,
+                 data=np.ones((3, 50, 50), dtype='int16'))
+    with patch.object(raster, '_tile_header',
+                      wraps=raster._tile_header) as header:
+        x = source.read().band_data
+    assert header.call_count == 1
+    assert x.shape == (3, 100, 200)
+    assert (x[:, :50, 150:].values == 1).all()
+    # no tile there
+    assert np.isnan(x[:, 50:, 150:].values).all()
+    with open(index_path) as f:
+        assert len(json.load(f)['tiles']) == 7
+
+    # rewrite that tile further right; only it is read again, and the
+    # mosaic takes its new bounds
+    make_geotiff('tile_0_3.tif', origin=(2000, 1000), overviews=None,
+                 data=np.full((3, 50, 50), 2, dtype='int16'))
+    with patch.object(raster, '_tile_header',
+                      wraps=raster._tile_header) as header:
+        x = source.read().band_data
+    assert header.call_count == 1
+    assert x.shape == (3, 100, 250)
+    assert (x[:, :50, 200:].values == 2).all()
+    assert np.isnan(x[:, :50, 150:200].values).all()
+
+
+class _CountingFile(fsspec.spec.AbstractBufferedFile):
+    def _fetch_range(self, start, end):
+        self.fs.requests.append((start, end))
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+class _CountingFileSystem(fsspec.AbstractFileSystem):
+    """Local files, as if remote, recording every byte range fetched and
+    every file asked about"""
+    protocol = 'counting'
+    requests = []
+    infos = []
+
+    @staticmethod
+    def _info(path):
+        kind = 'directory' if os.path.isdir(path) else 'file'
+        return {'name': path, 'size': os.path.getsize(path), 'type': kind}
+
+    def info(self, path, **kwargs):
+        self.infos.append(path)
+        return self._info(path)
+
+    def ls(self, path, detail=True, **kwargs):
+        names = sorted(os.path.join(path, n) for n in os.listdir(path))
+        return [self._info(n) for n in names] if detail else names
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        # one ranged request, as remote filesystems make it
+        size = os.path.getsize(path)
+        start, end = start or 0, size if end is None else min(end, size)
+        self.requests.append((start, end))
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def _open(self, path, mode='rb', block_size=None, autocommit=True,
+              cache_options=None, **kwargs):
+        return _CountingFile(self, path, mode, block_size or 2 ** 12,
+                             cache_options=cache_options, **kwargs)
+
+
+def test_rasterio_mosaic_remote_requests(make_geotiff):
+    from intake_xarray import raster
+    fsspec.register_implementation('counting', _CountingFileSystem,
+                                   clobber=True)
+    full = np.arange(3 * 128 * 128, dtype='int16').reshape(3, 128, 128)
+    path = make_geotiff('tile.tif', data=full, overviews=None)
+    fs = _CountingFileSystem(skip_instance_cache=True)
+    raster._fetch_header.cache_clear()
+
+    with raster._open_dataset(fs, path) as src:
+        assert src.shape == (128, 128)
+    # the whole header in one request
+    assert len(fs.requests) == 1
+    assert fs.requests[0][0] == 0
+
+    source = raster.RasterIOSource('counting://' + os.path.dirname(path)
+                                   + '/tile*.tif', mosaic=True,
+                                   chunks={'y': 128, 'x': 128})
+    x = source.to_dask().band_data
+    fs.requests.clear()
+    assert (x.values == full).all()
+    # header cached; all four 64x64 tiles coalesced into one request
+    assert len(fs.requests) == 1
+
+
+def test_rasterio_remote_header_refetched_when_rewritten(make_geotiff):
+    from intake_xarray import raster
+    path = make_geotiff('tile.tif', data=np.ones((1, 128, 128), 'int16'),
+                        overviews=None)
+    fs = _CountingFileSystem(skip_instance_cache=True)
+    raster._fetch_header.cache_clear()
+    with raster._open_dataset(fs, path) as src:
+        assert src.shape == (128, 128)
+
+    make_geotiff('tile.tif', data=np.full((1, 64, 96), 2, 'int16'),
+                 overviews=None)
+    with raster._open_dataset(fs, path) as src:
+        assert src.shape == (64, 96)
+        assert (src.read() == 2).all()
+
+
+def test_rasterio_remote_versions_gathered_once(make_geotiff):
+    from intake_xarray import raster
+    fsspec.register_implementation('counting', _CountingFileSystem,
+                                   clobber=True)
+    full = np.arange(4 * 64 * 64, dtype='int16').reshape(4, 1, 64, 64)
+    for n in range(4):
+        path = make_geotiff('stack_%d.tif' % n, data=full[n], overviews=None)
+    raster._fetch_header.cache_clear()
+    source = raster.RasterIOSource(
+        'counting://' + os.path.dirname(path) + '/stack_*.tif',
+        assume_same_grid=True, chunks={'y': 16},
+        xarray_kwargs={'mask_and_scale': False})
+    x = source.to_dask().band_data
+    _CountingFileSystem.infos.clear()
+    assert (x.values == full).all()
+    # versions and sizes came with the listing made on opening; none of
+    # the 16 tasks asks about the files again
+    assert _CountingFileSystem.infos == []
+
+
+def test_rasterio_same_grid_opens_first_file_only(make_geotiff):
+    from intake_xarray import raster
+    full = np.arange(4 * 3 * 100 * 80, dtype='int16').reshape(4, 3, 100, 80)
+    for n in range(4):
+        path = make_geotiff('stack_2020010%d.tif' % (n + 1), data=full[n],
+                            overviews=None)
+    urlpath = os.path.join(os.path.dirname(path), 'stack_{date}.tif')
+    with patch.object(raster, '_open_dataset',
+                      wraps=raster._open_dataset) as opened:
+        source = raster.RasterIOSource(urlpath, assume_same_grid=True,
+                                       chunks={'y': 64})
+        x = source.to_dask().band_data
+    assert opened.call_count == 1
+    assert x.dims == ('date', 'band', 'y', 'x')
+    assert x.chunks == ((1, ) * 4, (3, ), (64, 36), (80, ))
+    assert list(x.date.values) == ['2020010%d' % n for n in range(1, 5)]
+    assert (x.values == full).all()
+
+    expected = raster.RasterIOSource(urlpath, chunks={}).to_dask().band_data
+    xr.testing.assert_allclose(x.x, expected.x)
+    xr.testing.assert_allclose(x.y, expected.y)
+
+
+def test_rasterio_same_grid_pattern_fields(make_geotiff):
+    from intake_xarray.raster import RasterIOSource
+    cat = intake.open_catalog(os.path.join(here, 'data', 'catalog.yaml'))
+    expected = cat.pattern_tiff_source_concat_on_new_dim.read().band_data
+    source = RasterIOSource(os.path.join(here, 'data', 'little_{color}.tif'),
+                            assume_same_grid=True, concat_dim='new_dim')
+    x = source.read().band_data
+    assert x.dims == expected.dims
+    assert (x.sel(new_dim=expected.new_dim).values == expected.values).all()
+
+    make_geotiff('a_1_x.tif', overviews=None)
+    make_geotiff('a_2_y.tif', overviews=None)
+    urlpath = os.path.join(os.path.dirname(make_geotiff('a_1_y.tif')),
+                           'a_{n}_{c}.tif')
+    with pytest.raises(ValueError, match='every combination'):
+        RasterIOSource(urlpath, assume_same_grid=True).read()
+    make_geotiff('a_2_x.tif', overviews=None)
+    x = RasterIOSource(urlpath, assume_same_grid=True,
+                       bbox=(1000, 1000, 1500, 1500),
+                       chunks={}).to_dask().band_data
+    assert x.dims == ('n', 'c', 'band', 'y', 'x')
+    assert x.shape == (2, 2, 1, 50, 50)
+
+
+@pytest.mark.parametrize('mask_and_scale', [True, False])
+def test_rasterio_same_grid_masks_as_default(make_geotiff, mask_and_scale):
+    import rasterio
+    import xarray as xr
+    from intake_xarray.raster import RasterIOSource
+    data = np.arange(64 * 64, dtype='uint16').reshape(1, 64, 64) % 7
+    path = make_geotiff(data=data, overviews=None)
+    with rasterio.open(path, 'r+') as dst:
+        dst.nodata = 0
+        dst.scales, dst.offsets = (0.5, ), (10., )
+    kwargs = dict(chunks={}, xarray_kwargs={'mask_and_scale': mask_and_scale})
+    expected = RasterIOSource(path, **kwargs).read().band_data
+    x = RasterIOSource(path, assume_same_grid=True, **kwargs).read().band_data
+    assert x.dtype == expected.dtype
+    assert x.attrs['AREA_OR_POINT'] == 'Area'
+    xr.testing.assert_identical(x.drop_vars('spatial_ref'),
+                                expected.drop_vars('spatial_ref'))
+    if mask_and_scale:
+        assert np.isnan(x.values[0, 0, 0]) and x.values[0, 0, 1] == 10.5
+        assert x.encoding['_FillValue'] == 0
+
+
+@pytest.mark.parametrize('name, kwargs', [
+    ('little_*.tif', {'mosaic': True}),
+    ('little_*.tif', {'assume_same_grid': True}),
+    ('little_{color}.tif', {'assume_same_grid': True}),
+    ('little_red.tif', {'chunks': 'auto', 'bbox': (0, -32, 32, 0)})])
+def test_rasterio_double_slash(name, kwargs):
+    from intake_xarray.raster import RasterIOSource
+    # as '{{ CATALOG_DIR }}/data/...' makes in catalogs
+    urlpath = os.path.join(here, 'data') + '//' + name
+    x = RasterIOSource(urlpath, **kwargs).read().band_data
+    assert x.shape[-2:] == (64, 64)
+
+
+def test_rasterio_reproject_chunks(make_geotiff):
+    import rasterio
+    from rasterio.warp import reproject
+    from intake_xarray.raster import RasterIOSource
+    data = np.arange(256 * 256, dtype='float32').reshape(1, 256, 256)
+    path = make_geotiff(origin=(500000, 4500000), res=30, data=data,
+                        overviews=None)
+    source = RasterIOSource(path, dst_crs='EPSG:4326', dst_resolution=3e-4,
+                            chunks={'y': 64, 'x': 64})
+    x = source.to_dask().band_data
+    assert x.dims == ('band', 'y', 'x')
+    assert x.chunks[1][0] == 64 and x.chunks[2][0] == 64
+    assert x.spatial_ref.attrs['crs_wkt'].endswith('"EPSG","4326"]]')
+    assert (x.y.diff('y') < 0).all() and (x.x.diff('x') > 0).all()
+
+    # as warping the whole image at once, but for nearest-neighbour ties
+    # that GDAL resolves depending on the origin of the destination
+    from affine import Affine
+    transform = Affine.from_gdal(
+        *map(float, x.spatial_ref.attrs['GeoTransform'].split()))
+    expected = np.zeros(x.shape, dtype='float32')
+    with rasterio.open(path) as src:
+        reproject(src.read(), expected, src_transform=src.transform,
+                  src_crs=src.crs, dst_transform=transform,
+                  dst_crs='EPSG:4326', dst_nodata=0, error_threshold=0)
+    # pixels outside the source are masked
+    values = x.values
+    assert np.isnan(values).any() and (expected[np.isnan(values)] == 0).all()
+    diff = np.abs(np.nan_to_num(values) - expected)
+    assert (diff == 0).mean() > 0.95
+    assert np.isin(diff, [0, 1, 255, 256, 257]).all()
+
+    x = RasterIOSource(path, dst_crs='EPSG:4326', dst_resolution=0.001,
+                       bbox=(-74.99, 40.62, -74.98, 40.63)).read().band_data
+    # expanded to whole pixels of the target grid
+    assert x.shape[0] == 1 and set(x.shape[1:]) <= {10, 11}
+    assert x.x.min() - 5e-4 <= -74.99 and x.x.max() + 5e-4 >= -74.98
+    assert (x.values > 0).all()
+
+
+def test_rasterio_handle_pool(make_geotiff):
+    import fsspec
+    from intake_xarray import raster
+    fs = fsspec.filesystem('file')
+    a, b = make_geotiff('a.tif'), make_geotiff('b.tif')
+    raster._handle_pool().clear()
+    with raster._open_dataset(fs, a, handles=1) as src:
+        pass
+    with raster._open_dataset(fs, a, handles=1) as again:
+        assert again is src and not src.closed
+    # least recently used handle closed beyond the limit
+    with raster._open_dataset(fs, b, handles=1):
+        assert src.closed
+    with raster._open_dataset(fs, b) as unpooled:
+        pass
+    assert unpooled.closed
+
+    # a file rewritten since pooled is opened afresh
+    with raster._open_dataset(fs, b, handles=1) as src:
+        assert src.shape != (32, 48)
+    b = make_geotiff('b.tif', data=np.zeros((1, 32, 48), 'int16'),
+                     overviews=None)
+    with raster._open_dataset(fs, b, handles=1) as again:
+        assert again is not src and again.shape == (32, 48)
+
+
+def test_rasterio_thread_handles(make_geotiff):
+    import rasterio
+    from concurrent.futures import ThreadPoolExecutor
+    import dask
+    from intake_xarray.raster import RasterIOSource
+    full = np.random.randint(0, 1000, (2, 1, 256, 256)).astype('int16')
+    for n in range(2):
+        path = make_geotiff('t_%d.tif' % n, data=full[n], overviews=None)
+    urlpath = os.path.join(os.path.dirname(path), 't_{n}.tif')
+
+    def opens(**kwargs):
+        source = RasterIOSource(urlpath, assume_same_grid=True,
+                                chunks={'y': 64, 'x': 64}, gdal_cache=64,
+                                **kwargs)
+        x = source.to_dask().band_data
+        with patch.object(rasterio, 'open', wraps=rasterio.open) as opened, \
+                dask.config.set(pool=ThreadPoolExecutor(4)):
+            assert (x.values == full).all()
+        return opened.call_count
+
+    # at most one handle per file and thread, rather than one per chunk
+    assert opens() <= 2 * 4
+    assert opens(handles_per_thread=0) == 2 * 16
+
+
+def test_rasterio_pool_unhashable_options(make_geotiff):
+    from fsspec.implementations.local import LocalFileSystem
+    from intake_xarray import raster
+    path = make_geotiff('u.tif', overviews=None)
+    fs = LocalFileSystem()
+    options = {'UNUSED_OPTION': ['a', 'b']}
+    with raster._open_dataset(fs, path, handles=1, **options) as src:
+        pass
+    with raster._open_dataset(fs, path, handles=1, **options) as again:
+        assert again is src
+
+
+@pytest.mark.parametrize('option', [{'handles_per_thread': 2},
+                                    {'gdal_cache': 64},
+                                    {'gdal_threads': 2}])
+def test_rasterio_pool_options_need_chunk_tasks(option):
+    from intake_xarray.raster import RasterIOSource
+    path = os.path.join(here, 'data', 'RGB.byte.tif')
+    with pytest.raises(ValueError, match=list(option)[0]):
+        RasterIOSource(path, chunks={}, **option).to_dask()
+    x = RasterIOSource(path, chunks={}, assume_same_grid=True,
+                       **option).to_dask()
+    assert x.band_data.shape == (3, 718, 791)
+
+
+def test_rasterio_stats_exact(make_geotiff):
+    import rasterio
+    from intake_xarray.raster import RasterIOSource
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 5000, (2, 256, 256)).astype('int16')
+    path = make_geotiff(data=data)
+    with rasterio.open(path, 'r+') as dst:
+        dst.nodata = 0
+    source = RasterIOSource(path, chunk_target_bytes=64 * 64 * 2 * 4)
+    stats = source.stats(exact=True, percentiles=[2, 50, 98], bins=10)
+    assert stats.attrs['method'] == 'exact'
+    for b in range(2):
+        valid = data[b][data[b] != 0].astype('float64')
+        assert stats['count'][b] == valid.size
+        assert stats['min'][b] == valid.min()
+        assert stats['max'][b] == valid.max()
+        np.testing.assert_allclose(stats['mean'][b], valid.mean())
+        np.testing.assert_allclose(stats['std'][b], valid.std())
+        np.testing.assert_array_equal(
+            stats['percentile'][b],
+            np.percentile(valid, [2, 50, 98], method='inverted_cdf'))
+        counts, edges = np.histogram(valid, bins=10)
+        np.testing.assert_array_equal(stats['histogram'][b], counts)
+        np.testing.assert_allclose(stats['bin_edges'][b], edges)
+
+
+def test_rasterio_stats_exact_bands_of_different_ranges(make_geotiff):
+    from intake_xarray.raster import RasterIOSource
+    rng = np.random.default_rng(0)
+    data = np.stack([rng.integers(0, 256, (128, 128)),
+                     rng.integers(10, 101, (128, 128))]).astype('uint8')
+    source = RasterIOSource(make_geotiff(data=data))
+    stats = source.stats(exact=True, percentiles=[5, 50, 95], bins=4)
+    for b in range(2):
+        valid = data[b].astype('float64')
+        assert stats['min'][b] == valid.min()
+        assert stats['max'][b] == valid.max()
+        np.testing.assert_array_equal(
+            stats['percentile'][b],
+            np.percentile(valid, [5, 50, 95], method='inverted_cdf'))
+        counts, edges = np.histogram(valid, bins=4)
+        np.testing.assert_array_equal(stats['histogram'][b], counts)
+        np.testing.assert_allclose(stats['bin_edges'][b], edges)
+
+
+def test_rasterio_stats_approximate(make_geotiff):
+    import rasterio
+    from intake_xarray.raster import RasterIOSource
+    y, x = np.mgrid[:512, :512]
+    data = (x + y).astype('uint16')[None]
+    path = make_geotiff(data=data, overviews=(2, 4, 8))
+    source = RasterIOSource(path)
+
+    stats = source.stats(approx_pixels=100 * 100, bins=8)
+    assert stats.attrs['method'] == 'overview'
+    # read from the 4x overview, the coarsest with enough pixels
+    assert stats['count'][0] == 512 * 512
+    np.testing.assert_allclose(stats['mean'][0], data.mean(), rtol=0.01)
+    np.testing.assert_allclose(stats['percentile'][0],
+                               np.percentile(data, [2, 98]), rtol=0.05)
+    assert stats['histogram'][0].sum() == 512 * 512
+
+    with rasterio.open(path, 'r+') as dst:
+        dst.update_tags(1, STATISTICS_MINIMUM=0, STATISTICS_MAXIMUM=1022,
+                        STATISTICS_MEAN=511, STATISTICS_STDDEV=200)
+    stats = source.stats(percentiles=[])
+    assert stats.attrs['method'] == 'stored'
+    assert stats['max'][0] == 1022 and stats['std'][0] == 200
+
+
 def test_rasterio_empty_glob():
     pytest.importorskip('rasterio')
     cat = intake.open_catalog(os.path.join(here, 'data', 'catalog.yaml'))
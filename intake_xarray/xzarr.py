@@ -1,25 +1,589 @@
+import collections
+import json
+import threading
+
+import fsspec
+
 from intake import readers
+from intake.readers.utils import pattern_to_glob
+from intake.source.utils import reverse_formats
+
+from intake_xarray.base import IntakeXarraySourceAdapter, _file_version
+
+
+class ChunkCache:
+    """Thread-safe LRU store of chunks, bounded by their total size
+
+    One instance, ``chunk_cache``, is shared by all ``ZarrSource``s of the
+    process that ask for caching.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Least recently used chunks are dropped to keep the total below this.
+    """
+
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The value stored under ``key``, or None"""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+
+    def put(self, key, value, nbytes):
+        """Store ``value``, of size ``nbytes``, unless larger than the cap"""
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = value, nbytes
+            self.nbytes += nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        """Change the cap, evicting chunks as needed"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._data.popitem(last=False)[1][1]
+
+    @property
+    def hit_ratio(self):
+        """Fraction of lookups that found their chunk"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self):
+        """Drop all chunks and reset the counters"""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<ChunkCache: %d chunks, %d/%d bytes, hit ratio %.2f>' % (
+            len(self), self.nbytes, self.max_bytes, self.hit_ratio)
+
+
+chunk_cache = ChunkCache()
+
+
+def set_cache_size(max_bytes):
+    """Set the maximum total size of ``chunk_cache``, shared by all the
+    sources of the process, evicting chunks as needed"""
+    chunk_cache.resize(max_bytes)
+
+
+def _zarr_major():
+    import zarr
+
+    return int(zarr.__version__.split('.')[0])
+
+
+def _require_zarr3(option):
+    if _zarr_major() < 3:
+        import zarr
+
+        raise ImportError('%s needs zarr>=3, found zarr %s'
+                          % (option, zarr.__version__))
+
+
+def _caching_store(store, prefix):
+    """Wrap a zarr store so that whole-key reads go through ``chunk_cache``,
+    which then holds the stored (compressed) bytes"""
+    from zarr.storage import WrapperStore
+
+    class CachingStore(WrapperStore):
+        async def get(self, key, prototype, byte_range=None):
+            if byte_range is not None:
+                return await self._store.get(key, prototype, byte_range)
+            cached = chunk_cache.get((prefix, key))
+            if cached is not None:
+                return prototype.buffer.from_bytes(cached)
+            buf = await self._store.get(key, prototype)
+            if buf is not None:
+                data = buf.to_bytes()
+                chunk_cache.put((prefix, key), data, len(data))
+            return buf
+
+    return CachingStore(store)
+
+
+def _batching_store(store, concurrency):
+    """Wrap an fsspec-backed zarr store so that whole-key reads issued
+    together, as zarr does for all the chunks of one selection, are fetched
+    by a single ``cat`` of all their paths, at most ``concurrency`` requests
+    at a time"""
+    import asyncio
+    from zarr.storage import WrapperStore
+
+    class BatchingStore(WrapperStore):
+        def __init__(self, store):
+            super().__init__(store)
+            self._pending = {}
+            self._flush_task = None
+
+        async def get(self, key, prototype, byte_range=None):
+            if byte_range is not None:
+                return await self._store.get(key, prototype, byte_range)
+            loop = asyncio.get_running_loop()
+            if key not in self._pending:
+                self._pending[key] = loop.create_future()
+                if self._flush_task is None:
+                    self._flush_task = loop.create_task(self._flush())
+            data = await self._pending[key]
+            return None if data is None else prototype.buffer.from_bytes(data)
+
+        async def _flush(self):
+            # let the other reads started with this one join the batch
+            await asyncio.sleep(0)
+            pending, self._pending = self._pending, {}
+            self._flush_task = None
+            paths = {'%s/%s' % (self._store.path.rstrip('/'), key): key
+                     for key in pending}
+            try:
+                out = await self._store.fs._cat(
+                    list(paths), on_error='return', batch_size=concurrency)
+            except Exception as e:
+                out = {path: e for path in paths}
+            for path, key in paths.items():
+                result = out.get(path, FileNotFoundError(path))
+                if isinstance(result, FileNotFoundError):
+                    pending[key].set_result(None)
+                elif isinstance(result, Exception):
+                    pending[key].set_exception(result)
+                else:
+                    pending[key].set_result(result)
+
+    return BatchingStore(store)
+
+
+class _CachedArray:
+    """Array whose blocks, as requested by dask, are decoded through
+    ``chunk_cache``, held read-only; each request gets its own copy, which
+    it is free to modify"""
+
+    def __init__(self, variable, key):
+        self.variable = variable
+        self.key = key
+        self.shape = variable.shape
+        self.dtype = variable.dtype
+        self.ndim = variable.ndim
+
+    def __getitem__(self, index):
+        import numpy as np
+
+        key = (self.key, tuple((s.start, s.stop, s.step) for s in index))
+        out = chunk_cache.get(key)
+        if out is None:
+            out = np.asarray(self.variable[index].values)
+            out.setflags(write=False)
+            chunk_cache.put(key, out, out.nbytes)
+        return out.copy()
+
 
-from intake_xarray.base import IntakeXarraySourceAdapter
+def _get_block(array, index, asarray=True, lock=None):
+    # not dask's own getter, which later selections get fused into, so
+    # that every read is of a whole block, as cached
+    return array[index]
+
+
+def _cache_decoded(ds, prefix, chunks=None):
+    """Make every array of a lazily opened dataset a dask array in blocks
+    of the stored chunks, read through ``chunk_cache``"""
+    import dask.array as da
+    import numpy as np
+    from dask.base import tokenize
+
+    for name, var in ds.variables.items():
+        if name in ds.indexes or not var.ndim:
+            continue
+        storage = var.encoding.get('chunks') or var.shape
+        key = (prefix, name)
+        data = da.from_array(
+            _CachedArray(var, key), chunks=tuple(storage),
+            name='zarr-cached-%s' % tokenize(key), getitem=_get_block,
+            meta=np.empty((0, ) * var.ndim, dtype=var.dtype))
+        ds[name] = var.copy(data=data)
+    if chunks is None:
+        return ds.load()
+    return ds.chunk(chunks) if chunks else ds
+
+
+def _chunk_by_shards(ds):
+    """Dask arrays of a lazily opened dataset as with ``chunks={}``, except
+    that sharded arrays get a chunk per shard rather than per inner chunk,
+    so that each task reads from one shard object and the graph does not
+    grow with the number of inner chunks"""
+    for name, var in ds.variables.items():
+        if name in ds.indexes or not var.ndim:
+            continue
+        stored = var.encoding.get('shards') or var.encoding.get('chunks') \
+            or var.shape
+        ds[name] = var.chunk(dict(zip(var.dims, stored)))
+    return ds
+
+
+def _has_consolidated(mapper):
+    """Whether the Zarr hierarchy at ``mapper`` has consolidated metadata,
+    as ``.zmetadata`` (v2) or within the root ``zarr.json`` (v3)"""
+    if '.zmetadata' in mapper:
+        return True
+    try:
+        meta = json.loads(mapper['zarr.json'])
+    except KeyError:
+        return False
+    return meta.get('consolidated_metadata') is not None
+
+
+def _have_consolidated(fs, paths):
+    """``_has_consolidated`` for each store of ``paths``, with the metadata
+    of all of them fetched in one batch, concurrently where ``fs`` is
+    asynchronous, rather than one store after another"""
+    keys = {p: (p.rstrip('/') + '/.zmetadata', p.rstrip('/') + '/zarr.json')
+            for p in paths}
+    found = fs.cat([k for pair in keys.values() for k in pair],
+                   on_error='omit')
+    out = []
+    for zmetadata, zarr_json in keys.values():
+        meta = json.loads(found[zarr_json]) if zarr_json in found else {}
+        out.append(zmetadata in found or
+                   meta.get('consolidated_metadata') is not None)
+    return out
+
+
+def _store_version(fs, path):
+    """``_file_version`` of the root metadata of the store at ``path``, which
+    rewriting the store replaces, or None if it has none"""
+    for key in ('zarr.json', '.zmetadata', '.zgroup', '.zarray'):
+        try:
+            return _file_version(fs, path.rstrip('/') + '/' + key)
+        except FileNotFoundError:
+            pass
+
+
+def _store_versions(fs, paths):
+    """``_store_version`` of each of ``paths``, asked concurrently"""
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+
+    with ThreadPoolExecutor(min(len(paths), 16)) as pool:
+        return list(pool.map(partial(_store_version, fs), paths))
+
+
+def _store_paths(url, storage_options=None):
+    """Filesystem and list of store paths for a path, glob, pattern or
+    list; unlike for files, globs match directories"""
+    urls = [url] if isinstance(url, str) else list(url)
+    fs, _ = fsspec.core.url_to_fs(urls[0], **(storage_options or {}))
+    paths = []
+    for url in urls:
+        path = fs._strip_protocol(pattern_to_glob(url))
+        if any(c in path for c in '*?['):
+            paths.extend(sorted(fs.glob(path)))
+        else:
+            paths.append(path)
+    if not paths:
+        raise FileNotFoundError('No stores found matching %s' % (urls, ))
+    return fs, paths
+
+
+def consolidate_metadata(urlpath, storage_options=None):
+    """Write the consolidated metadata of the Zarr hierarchy at ``urlpath``
+
+    Afterwards, opening the store reads the metadata of all of its arrays
+    and groups in one request, instead of one or more per array.
+    """
+    import zarr
+
+    zarr.consolidate_metadata(
+        fsspec.get_mapper(urlpath, **(storage_options or {})))
+
+
+class ZarrReader(readers.XArrayDatasetReader):
+    """Open Zarr stores into an xarray Dataset, with consolidated metadata
+    whenever the stores have it
+
+    Parameters are as for ``ZarrSource``; ``data`` is a
+    ``readers.datatypes.Zarr`` instance.
+    """
+    implements = {readers.datatypes.Zarr}
+
+    def _read(self, data, consolidated=None, consolidate=False, cache=None,
+              concurrency=None, concat_dim=None,
+              path_as_pattern=True, **kw):
+        from dask.base import tokenize
+
+        url, pattern = data.url, None
+        if isinstance(path_as_pattern, str):
+            pattern = path_as_pattern
+        elif path_as_pattern is True and isinstance(url, str) and '{' in url:
+            pattern = url
+        fs, paths = _store_paths(url, data.storage_options)
+        if consolidated is None or consolidate:
+            found = _have_consolidated(fs, paths)
+            if consolidate:
+                for path, has in zip(paths, found):
+                    if not has:
+                        consolidate_metadata(fs.unstrip_protocol(path),
+                                             data.storage_options)
+                found = [True] * len(paths)
+            if consolidated is None and len(set(found)) == 1:
+                # otherwise xarray tries each store with, then without
+                consolidated = found[0]
+        kw['consolidated'] = consolidated
+        if cache not in (None, 'decoded', 'compressed'):
+            raise ValueError("cache must be None, 'decoded' or 'compressed'")
+        if cache == 'compressed':
+            _require_zarr3("cache='compressed'")
+        if concurrency:
+            _require_zarr3('concurrency')
+        # cached chunks are keyed by store version too, so that those of a
+        # store since rewritten are not served
+        versions = _store_versions(fs, paths) if cache else \
+            [None] * len(paths)
+
+        if pattern is not None or (concat_dim is not None and len(paths) > 1):
+            fields = reverse_formats(pattern, paths) if pattern else {}
+            if concat_dim is not None:
+                names = [concat_dim] if isinstance(concat_dim, str) \
+                    else list(concat_dim)
+                fields = dict(zip(names + list(fields)[len(names):],
+                                  fields.values()))
+                dim = names[0]
+            else:
+                dim = next(iter(fields))
+            stores = self._stores(data, fs, paths, cache, concurrency,
+                                  versions)
+            prefixes = [tokenize(fs.unstrip_protocol(p),
+                                 kw.get('group', data.root), v)
+                        for p, v in zip(paths, versions)]
+            return _concat_stores(stores, dim, fields, data.root, cache,
+                                  prefixes, **kw)
+
+        chunks = kw.get('chunks')
+        by_shards = chunks == {} and len(paths) == 1
+        if cache == 'decoded' or by_shards:
+            kw['chunks'] = None
+        if cache == 'compressed' or concurrency:
+            stores = self._stores(data, fs, paths, cache, concurrency,
+                                  versions)
+            ds = _open_stores(stores, data.root, **kw)
+        else:
+            ds = super()._read(data, **kw)
+        if by_shards and cache != 'decoded':
+            return _chunk_by_shards(ds)
+        if cache == 'decoded':
+            prefix = tokenize([fs.unstrip_protocol(p) for p in paths],
+                              kw.get('group', data.root), versions)
+            return _cache_decoded(ds, prefix, chunks)
+        return ds
+
+    @staticmethod
+    def _stores(data, fs, paths, cache=None, concurrency=None,
+                versions=None):
+        """Zarr store objects for the paths, wrapped for caching compressed
+        chunks, under the store ``versions`` if given, and/or batched
+        fetching"""
+        from fsspec.implementations.local import LocalFileSystem
+        from zarr.storage import FsspecStore, LocalStore
+
+        stores = []
+        for path, version in zip(paths, versions or [None] * len(paths)):
+            url = fs.unstrip_protocol(path)
+            if isinstance(fs, LocalFileSystem):
+                store = LocalStore(path, read_only=True)
+            else:
+                store = FsspecStore.from_url(
+                    url, storage_options=data.storage_options, read_only=True)
+                if concurrency:
+                    store = _batching_store(store, concurrency)
+            if cache == 'compressed':
+                store = _caching_store(store, (url, version))
+            stores.append(store)
+        return stores
+
+
+def _open_stores(stores, root=None, **kw):
+    import xarray as xr
+
+    kw.setdefault('engine', 'zarr')
+    if root and 'group' not in kw:
+        kw['group'] = root
+    if len(stores) == 1:
+        return xr.open_dataset(stores[0], **kw)
+    return xr.open_mfdataset(stores, **kw)
+
+
+def _concat_stores(stores, dim, fields=None, root=None, cache=None,
+                   prefixes=None, chunks=None, **kw):
+    """Lazily concatenate Zarr stores along ``dim``
+
+    Opening reads only the metadata of each store, concurrently. Then, in
+    one dask computation, the dimension coordinates of the first store are
+    read, and the ``dim`` coordinate of every store, unless ``fields``
+    (from the path pattern) supplies it: the field named ``dim`` gives its
+    values, and ``dim`` must then be new or of length one in each store.
+    Other fields become coordinates along ``dim``. Variables without
+    ``dim`` and the other coordinates are taken from the first store.
+    """
+    import inspect
+    from concurrent.futures import ThreadPoolExecutor
+
+    import dask
+    import numpy as np
+    import xarray as xr
+
+    fields = fields or {}
+    kw.setdefault('engine', 'zarr')
+    if root and 'group' not in kw:
+        kw['group'] = root
+    if 'create_default_indexes' in inspect.signature(
+            xr.open_dataset).parameters:
+        # xarray>=2025.7: coordinates are only read where needed below;
+        # otherwise, every store's indexes are loaded on opening
+        kw['create_default_indexes'] = False
+    if dim in fields:
+        # never read, nor decoded, which would read some of it
+        drop = kw.get('drop_variables') or []
+        kw['drop_variables'] = [drop] if isinstance(drop, str) else list(drop)
+        kw['drop_variables'].append(dim)
+
+    def open_one(args):
+        store, prefix = args
+        if cache == 'decoded':
+            ds = xr.open_dataset(store, chunks=None, **kw)
+            return _cache_decoded(ds, prefix, {})
+        if chunks is None or chunks == {}:
+            return _chunk_by_shards(xr.open_dataset(store, chunks=None, **kw))
+        return xr.open_dataset(store, chunks=chunks, **kw)
+
+    with ThreadPoolExecutor(min(len(stores), 16)) as pool:
+        dsets = list(pool.map(open_one, zip(stores, prefixes)))
+
+    lengths = [ds.sizes.get(dim, 0) for ds in dsets]
+    if dim in fields and max(lengths) > 1:
+        raise ValueError(
+            'The pattern field %r can only give the coordinate of a '
+            'dimension of length one in each store; pass concat_dim to '
+            'name the dimension to concatenate along' % dim)
+    read_dim = dim not in fields and min(lengths) > 0 and \
+        all(dim in ds.variables for ds in dsets)
+    first = [name for name in dsets[0].dims
+             if name != dim and name in dsets[0].variables]
+    loaded = dask.compute(
+        [dsets[0].variables[name] for name in first],
+        [ds.variables[dim] for ds in dsets] if read_dim else [])
+    coords = dict(zip(first, loaded[0]))
+    if dim in fields:
+        coords[dim] = xr.Variable(dim, np.asarray(fields[dim]))
+    elif read_dim:
+        coords[dim] = xr.Variable.concat(loaded[1], dim)
+    sizes = [max(n, 1) for n in lengths]
+    for name, values in fields.items():
+        if name not in coords:
+            coords[name] = xr.Variable(dim, np.repeat(values, sizes))
+
+    dsets = [ds.drop_vars([name for name in coords if name in ds.variables])
+             for ds in dsets]
+    dsets = [ds if dim in ds.dims else ds.expand_dims(dim) for ds in dsets]
+    ds = xr.concat(dsets, dim, data_vars='minimal', coords='minimal',
+                   compat='override', join='override',
+                   combine_attrs='override')
+    ds = ds.assign_coords(coords)
+    if chunks is None:
+        return ds.load()
+    return ds.chunk(chunks) if cache == 'decoded' and chunks else ds
 
 
 class ZarrSource(IntakeXarraySourceAdapter):
     """Open a xarray dataset.
 
     If the path is passed as a list or a string containing "*", then multifile open
-    will be called automatically.
+    will be called automatically. With ``concat_dim``, or a path pattern such
+    as ``data/day_{time:%Y%m%d}.zarr``, the stores are instead concatenated
+    lazily along one dimension: only their metadata is read on opening, and
+    the coordinates needed are then read from all stores together. A pattern
+    field named after the dimension gives its coordinate, so that the
+    stores' own arrays need not be read at all.
 
     Note that the implicit default value of the ``chunks`` kwarg is ``{}``, i.e., dask
     will be used to open the dataset with chunksize as inherent in the file. To bypass
-    dask (if you only want to use ``.read()``), use ``chunks=None``.
+    dask (if you only want to use ``.read()``), use ``chunks=None``. For Zarr v3
+    sharded arrays, that is a chunk per shard, whose inner chunks are then read
+    with a range request each, located through the shard's index. With
+    ``chunks='auto-aligned'``, chunks are sized as for dask's ``'auto'`` but
+    rounded to whole multiples of the stored chunks; other ``chunks`` that
+    split stored chunks give a warning.
 
     Parameters
     ----------
-    urlpath: str
+    urlpath: str or list
         Path to source. This can be a local directory or a remote data
-        service (i.e., with a protocol specifier like ``'s3://``).
+        service (i.e., with a protocol specifier like ``'s3://``), a glob,
+        a pattern or a list of those.
+    concat_dim: str or list, optional
+        Dimension to concatenate several stores along, new or existing in
+        the stores. With a pattern, names the pattern's fields in order,
+        the first being the dimension; by default, that is the first field.
+        Fields other than the dimension's become coordinates along it.
+    path_as_pattern: bool or str, optional
+        Whether to treat the path as a pattern (ie. ``day_{date}.zarr``).
+        If str, is treated as pattern to match on. Default is True.
     storage_options: dict
         Parameters passed to the backend file-system
+    consolidated: bool or None
+        Whether to read the metadata of all arrays at once from the
+        store's consolidated metadata. By default (None), the store is
+        checked for it and it is used if present; otherwise the metadata
+        of every array and group is read separately, one or more requests
+        each.
+    consolidate: bool
+        If True, write consolidated metadata to any store lacking it before
+        opening, so that this and later opens take the fast path. This
+        needs write access to the store. See also ``consolidate_metadata``.
+    cache: None, 'decoded' or 'compressed'
+        Keep the chunks read in ``intake_xarray.xzarr.chunk_cache``, a
+        least-recently-used cache shared by all sources of the process, so
+        that reading the same chunks again, from this or any other source
+        of the same store, costs neither fetching nor decoding them.
+        Chunks are cached under the version (size, ETag, modification
+        time) of the store's root metadata, so that a store rewritten
+        since is read afresh by new sources; a region written in place,
+        which leaves that metadata as it was, is not noticed.
+        ``'decoded'`` holds the arrays, as blocks of the stored chunks,
+        each read getting a copy of its own;
+        ``'compressed'`` holds the stored bytes, which takes less memory
+        but still decodes them on every read. The cache's ``hit_ratio``,
+        ``hits`` and ``misses`` tell how well it is doing. Its maximum
+        size, 256MiB by default, is set for the process with
+        ``intake_xarray.xzarr.set_cache_size``. ``'compressed'`` needs
+        zarr>=3.
+    concurrency: int, optional
+        For remote stores, gather the chunk reads of each selection (so of
+        each dask task) and fetch them with one ``cat`` of all their keys,
+        with up to this many requests in flight, so that a dask chunk
+        spanning up to this many Zarr chunks loads in about one round trip.
+        Since zarr itself issues at most ``async.concurrency`` reads at a
+        time (10 by default), batches are no larger than that; raise it for
+        the process or around the reads, with
+        ``zarr.config.set({'async.concurrency': n})``. Needs zarr>=3.
     kwargs:
         Further parameters are passed to xarray
     """
@@ -28,4 +592,12 @@ class ZarrSource(IntakeXarraySourceAdapter):
     def __init__(self, urlpath, storage_options=None, metadata=None, **kwargs):
         data = readers.datatypes.Zarr(urlpath, storage_options=storage_options,
                                       metadata=metadata)
-        self.reader = readers.XArrayDatasetReader(data, **kwargs)
+        self.reader = ZarrReader(data, **kwargs)
+
+    def consolidate_metadata(self):
+        """Write consolidated metadata for the store(s) of this source"""
+        data = self.reader.kwargs['args'][0]
+        fs, paths = _store_paths(data.url, data.storage_options)
+        for path in paths:
+            consolidate_metadata(fs.unstrip_protocol(path),
+                                 data.storage_options)
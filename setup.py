@@ -29,6 +29,7 @@ setup(
             'zarr = intake_xarray.xzarr:ZarrSource',
             'opendap = intake_xarray.opendap:OpenDapSource',
             'xarray_image = intake_xarray.image:ImageSource',
+            'xarray_video = intake_xarray.image:VideoSource',
             'rasterio = intake_xarray.raster:RasterIOSource',
         ]
     },